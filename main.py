@@ -3,6 +3,7 @@ import json
 import uuid
 import time
 import base64
+import binascii
 import tomllib  # Python 3.11+; 如果是Python < 3.11，需要使用tomli第三方库
 import aiohttp
 import asyncio
@@ -15,13 +16,18 @@ import copy
 import threading
 import urllib.parse
 from io import BytesIO
-from typing import Dict, Any, Optional, List, Tuple, Union, Set
-from collections import defaultdict
+from typing import Dict, Any, Optional, List, Tuple, Union, Set, Callable, Awaitable, AsyncIterator
+from collections import defaultdict, OrderedDict, deque
 import random
 import string
 import hashlib
+import heapq
 import re
+import unicodedata
+import sqlite3
 import logging
+import email.utils
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 
 from PIL import Image
 from loguru import logger
@@ -33,6 +39,1843 @@ from WechatAPI import WechatAPIClient
 # 设置日志
 logger = logging.getLogger('gemini_image')
 
+
+# 解码图片允许的最大像素数，避免超大图片占用过多内存
+DEFAULT_MAX_DECODED_PIXELS = 40_000_000
+# 缩放时先用reduce整数倍缩小，保留到目标尺寸的倍数，再用LANCZOS重采样
+REDUCING_GAP = 2
+
+
+class ImageTooLargeError(ValueError):
+    """图片解码后的像素数超出限制"""
+
+
+def _compress_image_sync(image_data: bytes, max_size: int, quality: int, format: str,
+                         max_pixels: int = DEFAULT_MAX_DECODED_PIXELS) -> Tuple[bytes, Tuple[int, int], Tuple[int, int]]:
+    """在图片处理池中执行的图片压缩（解码、缩放、编码）
+    
+    定义在模块级别，以便进程池可以序列化调用。需要缩小的JPEG使用draft模式由解码器直接按
+    1/2、1/4、1/8缩小解码，其他格式先用reduce整数倍缩小，最后再用LANCZOS缩放到目标尺寸。
+    透明通道的合成和RGB转换在缩小之后进行。
+    
+    Args:
+        image_data: 原始图片二进制数据
+        max_size: 图片的最大尺寸（宽度或高度的最大值）
+        quality: JPEG压缩质量 (1-100)
+        format: 输出格式 ('JPEG', 'PNG', etc.)
+        max_pixels: 解码后允许的最大像素数
+        
+    Returns:
+        Tuple[bytes, Tuple[int, int], Tuple[int, int]]: 压缩后的图片数据, 原始尺寸, 压缩后尺寸
+        
+    Raises:
+        ImageTooLargeError: 图片解码后的像素数超出max_pixels
+    """
+    # 使用PIL打开图片，此时只读取了文件头
+    try:
+        img = Image.open(BytesIO(image_data))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError("图片尺寸过大，请缩小后重新发送") from e
+    
+    # 计算目标尺寸，保持纵横比
+    width, height = img.size
+    new_size = None
+    if width > max_size or height > max_size:
+        if width > height:
+            new_size = (max_size, max(1, int(height * (max_size / width))))
+        else:
+            new_size = (max(1, int(width * (max_size / height))), max_size)
+        # JPEG由解码器直接缩小解码，不需要分配原图大小的内存
+        if img.format == 'JPEG':
+            img.draft(img.mode, new_size)
+    
+    # 在真正解码之前检查像素数
+    if img.size[0] * img.size[1] > max_pixels:
+        raise ImageTooLargeError(f"图片尺寸过大 ({width}x{height})，请缩小后重新发送")
+    
+    # 调色板等模式不能直接重采样，先展开为RGB或RGBA，透明通道保留到缩小之后再处理
+    if img.mode not in ('RGB', 'RGBA', 'L', 'LA') and (new_size is not None or format == 'JPEG'):
+        has_alpha = img.mode == 'PA' or (img.mode == 'P' and 'transparency' in img.info)
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+    
+    # 调整大小：先整数倍缩小，再高质量重采样
+    if new_size is not None:
+        factor = min(img.size[0] // new_size[0], img.size[1] // new_size[1]) // REDUCING_GAP
+        if factor >= 2:
+            img = img.reduce(factor)
+        if img.size != new_size:
+            img = img.resize(new_size, Image.LANCZOS)
+    
+    # 转换为RGB模式，解决透明PNG和调色板图片（GIF等）无法保存为JPEG的问题，
+    # 在缩小后的图片上与白色背景合成
+    if format == 'JPEG' and img.mode != 'RGB':
+        if img.mode in ('RGBA', 'LA'):
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        else:
+            img = img.convert('RGB')
+    
+    # 将图片保存到BytesIO对象中
+    output = BytesIO()
+    if format == 'JPEG':
+        img.save(output, format=format, quality=quality, optimize=True)
+    else:
+        img.save(output, format=format, optimize=True)
+    
+    return output.getvalue(), (width, height), img.size
+
+
+# 只读取文件头即可确定尺寸的图片格式，JPEG需要扫描到SOF段
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _probe_image(image_data: bytes) -> Optional[Tuple[str, int, int]]:
+    """只解析文件头，获取图片的MIME类型和尺寸，不解码像素数据
+    
+    支持PNG、JPEG、GIF和WEBP，其他格式或文件头损坏时返回None。
+    
+    Args:
+        image_data: 图片二进制数据
+        
+    Returns:
+        Optional[Tuple[str, int, int]]: (MIME类型, 宽度, 高度)
+    """
+    size = len(image_data)
+    if size >= 24 and image_data.startswith(b"\x89PNG\r\n\x1a\n") and image_data[12:16] == b"IHDR":
+        width, height = int.from_bytes(image_data[16:20], "big"), int.from_bytes(image_data[20:24], "big")
+        return "image/png", width, height
+    if size >= 10 and image_data[:6] in (b"GIF87a", b"GIF89a"):
+        width, height = int.from_bytes(image_data[6:8], "little"), int.from_bytes(image_data[8:10], "little")
+        return "image/gif", width, height
+    if size >= 30 and image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+        chunk = image_data[12:16]
+        if chunk == b"VP8 ":
+            width = int.from_bytes(image_data[26:28], "little") & 0x3FFF
+            height = int.from_bytes(image_data[28:30], "little") & 0x3FFF
+        elif chunk == b"VP8L":
+            bits = int.from_bytes(image_data[21:25], "little")
+            width, height = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        elif chunk == b"VP8X":
+            width = int.from_bytes(image_data[24:27], "little") + 1
+            height = int.from_bytes(image_data[27:30], "little") + 1
+        else:
+            return None
+        return "image/webp", width, height
+    if size >= 4 and image_data[:2] == b"\xff\xd8":
+        pos = 2
+        while pos + 9 <= size:
+            if image_data[pos] != 0xFF:
+                return None
+            marker = image_data[pos + 1]
+            if marker == 0xFF:
+                # 段之间的填充字节
+                pos += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                # 没有长度字段的标记
+                pos += 2
+                continue
+            if marker in (0xD9, 0xDA):
+                # 图像结束或扫描数据开始之前都没有找到SOF段
+                return None
+            if marker in _JPEG_SOF_MARKERS:
+                height = int.from_bytes(image_data[pos + 5:pos + 7], "big")
+                width = int.from_bytes(image_data[pos + 7:pos + 9], "big")
+                return "image/jpeg", width, height
+            pos += 2 + int.from_bytes(image_data[pos + 2:pos + 4], "big")
+    return None
+
+
+def _parse_retry_after(value: Optional[str], body: str = "") -> Optional[float]:
+    """解析上游要求的重试等待时间（秒）
+    
+    优先使用Retry-After响应头（秒数或HTTP日期），其次使用Gemini错误详情中的retryDelay。
+    
+    Args:
+        value: Retry-After响应头的值
+        body: 响应正文
+        
+    Returns:
+        Optional[float]: 等待秒数，没有提供时返回None
+    """
+    if value:
+        value = value.strip()
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                retry_time = email.utils.parsedate_to_datetime(value)
+                return max(0.0, retry_time.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    if body:
+        match = re.search(r'"retryDelay"\s*:\s*"([\d.]+)s"', body)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+class RetryableStatusError(Exception):
+    """上游返回可重试的状态码"""
+    
+    def __init__(self, status: int, retry_after: Optional[float] = None, body: str = ""):
+        super().__init__(f"上游返回状态码 {status}")
+        self.status = status
+        self.retry_after = retry_after
+        self.body = body
+
+
+class CircuitOpenError(Exception):
+    """上游线路已熔断，请求直接失败"""
+    
+    def __init__(self, route: str, retry_in: float):
+        super().__init__(f"上游服务暂时不可用，请约 {max(1, int(retry_in))} 秒后再试")
+        self.route = route
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """单条上游线路的熔断器
+    
+    关闭状态下连续失败 failure_threshold 次后打开，打开期间请求直接失败；
+    open_seconds 秒后进入半开状态，只放行一个探测请求，探测成功则关闭，失败则重新打开。
+    只有连接错误、超时和503以外的5xx算作失败；429和503表示上游过载，线路本身可用，
+    由自适应并发限制、密钥池和重试策略处理。
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, name: str, failure_threshold: int = 5, open_seconds: float = 30):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self.failures = 0          # 连续失败次数
+        self.opened_at = 0.0
+        self.probe_started = 0.0   # 半开状态下探测请求的开始时间，0表示没有探测请求
+        self.trips = 0
+        self.rejected = 0
+    
+    def allow(self) -> bool:
+        """判断是否可以发送请求"""
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.open_seconds:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+            self.probe_started = 0.0
+        if self.state == self.HALF_OPEN:
+            # 探测请求没有返回结果（例如被取消）时，超过open_seconds后允许新的探测
+            if self.probe_started and now - self.probe_started < self.open_seconds:
+                self.rejected += 1
+                return False
+            self.probe_started = now
+            logger.info(f"线路 {self.name} 熔断期满，发送探测请求")
+        return True
+    
+    def retry_in(self) -> float:
+        """距离下一次允许探测的秒数"""
+        start = self.opened_at if self.state == self.OPEN else self.probe_started
+        return max(0.0, start + self.open_seconds - time.monotonic())
+    
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"线路 {self.name} 已恢复，关闭熔断")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.probe_started = 0.0
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probe_started = 0.0
+            self.trips += 1
+            logger.warning(f"线路 {self.name} 连续失败 {self.failures} 次，熔断 {self.open_seconds} 秒")
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected
+        }
+
+
+class RetryBudget:
+    """进程级重试预算（令牌桶）
+    
+    每个请求存入 ratio 个令牌，每次重试消耗1个令牌，另外每秒补充 min_per_second 个令牌，
+    保证上游故障时重试总量不超过正常请求量的固定比例，避免重试放大故障。
+    """
+    
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 0.2, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.last_refill = time.monotonic()
+        self.exhausted_count = 0
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self.last_refill) * self.min_per_second)
+        self.last_refill = now
+    
+    def deposit(self):
+        """记录一次新请求"""
+        self._refill()
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+    
+    def try_withdraw(self) -> bool:
+        """尝试为一次重试扣除令牌，预算不足时返回False"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.exhausted_count += 1
+        return False
+
+
+class RetryPolicy:
+    """统一的重试策略
+    
+    指数退避加完全抖动，按状态码和异常类型判断是否可重试，遵循Retry-After，
+    每个请求有总截止时间，所有请求共享同一个重试预算。
+    """
+    
+    RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+    RETRYABLE_EXCEPTIONS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+    
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1.0, max_delay: float = 10.0,
+                 deadline: float = 90.0, budget: Optional[RetryBudget] = None):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.budget = budget or RetryBudget()
+    
+    def is_retryable_status(self, status: int) -> bool:
+        return status in self.RETRYABLE_STATUSES
+    
+    def is_retryable_exception(self, error: BaseException) -> bool:
+        return isinstance(error, RetryableStatusError) or isinstance(error, self.RETRYABLE_EXCEPTIONS)
+    
+    def backoff(self, attempt: int) -> float:
+        """第attempt次失败后的等待时间（完全抖动）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+    
+    async def run(self, attempt_func: Callable[[float], Awaitable[Any]], label: str = "请求") -> Any:
+        """按重试策略执行请求
+        
+        Args:
+            attempt_func: 执行一次请求的协程函数，参数为剩余可用时间（秒）；
+                          遇到可重试状态码时应抛出RetryableStatusError
+            label: 日志中使用的请求名称
+            
+        Returns:
+            attempt_func的返回值；重试结束仍失败时抛出最后一次的异常
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        self.budget.deposit()
+        
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = deadline - loop.time()
+            try:
+                return await asyncio.wait_for(attempt_func(remaining), timeout=remaining)
+            except Exception as e:
+                if not self.is_retryable_exception(e):
+                    raise
+                reason = f"状态码 {e.status}" if isinstance(e, RetryableStatusError) else f"{type(e).__name__}: {e}"
+                if attempt >= self.max_attempts:
+                    logger.error(f"{label}失败 ({reason})，已达到最大尝试次数 {self.max_attempts}")
+                    raise
+                
+                retry_after = e.retry_after if isinstance(e, RetryableStatusError) else None
+                delay = retry_after if retry_after is not None else self.backoff(attempt)
+                if delay >= deadline - loop.time():
+                    logger.error(f"{label}失败 ({reason})，剩余时间不足以等待 {delay:.1f} 秒后重试")
+                    raise
+                if not self.budget.try_withdraw():
+                    logger.error(f"{label}失败 ({reason})，全局重试预算已耗尽，不再重试")
+                    raise
+                
+                logger.warning(f"{label}失败 ({reason})，{delay:.1f} 秒后进行第 {attempt + 1}/{self.max_attempts} 次尝试")
+                await asyncio.sleep(delay)
+
+
+class ApiKey:
+    """密钥池中的单个API密钥及其统计信息"""
+    
+    def __init__(self, key: str, model: Optional[str] = None, endpoint: Optional[str] = None):
+        self.key = key
+        self.model = model          # 该密钥使用的图像模型，为空时使用全局配置
+        self.endpoint = endpoint    # 该密钥使用的接口地址，为空时使用全局配置
+        self.in_flight = 0          # 正在进行的请求数
+        self.requests = 0           # 总请求数
+        self.successes = 0          # 成功次数
+        self.failures = 0           # 失败次数
+        self.ejections = 0          # 被暂时移出的次数
+        self.ejected_until = 0.0    # 暂停使用的截止时间，0表示健康
+        self.eject_seconds = 0.0    # 下一次移出的时长
+        self.probing = False        # 暂停结束后是否正在进行探测请求
+        self.last_status = None     # 最后一次响应状态码
+    
+    @property
+    def masked(self) -> str:
+        """用于日志的脱敏密钥"""
+        return f"{self.key[:4]}...{self.key[-4:]}" if len(self.key) > 8 else "****"
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "key": self.masked,
+            "model": self.model,
+            "endpoint": self.endpoint,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "ejected": self.ejected_until > 0,
+            "last_status": self.last_status
+        }
+
+
+class ApiKeyPool:
+    """API密钥池
+    
+    按正在进行的请求数最少的原则分配密钥；密钥遇到配额或过载错误时暂时移出，
+    暂停期满后先放行一个探测请求，探测成功才重新加入，失败则加倍暂停时间。
+    """
+    
+    EJECT_STATUSES = (429, 503)      # 配额或过载，暂时移出
+    INVALID_STATUSES = (401, 403)    # 密钥无效或无权限，按最长时间移出
+    
+    def __init__(self, base_eject_seconds: float = 30, max_eject_seconds: float = 600):
+        self.base_eject_seconds = base_eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.keys: List[ApiKey] = []
+    
+    def add(self, key: str, model: Optional[str] = None, endpoint: Optional[str] = None):
+        if key and all(k.key != key for k in self.keys):
+            self.keys.append(ApiKey(key, model or None, endpoint or None))
+    
+    def __len__(self) -> int:
+        return len(self.keys)
+    
+    def has_other_available(self, current: ApiKey) -> bool:
+        """是否还有其他未被移出的密钥"""
+        now = time.time()
+        return any(k is not current and (k.ejected_until == 0 or (k.ejected_until <= now and not k.probing)) for k in self.keys)
+    
+    def acquire(self) -> ApiKey:
+        """选择一个密钥并计入正在进行的请求"""
+        now = time.time()
+        chosen = None
+        
+        # 暂停期满的密钥优先发送一个探测请求
+        for k in self.keys:
+            if k.ejected_until and k.ejected_until <= now and not k.probing:
+                k.probing = True
+                chosen = k
+                logger.info(f"密钥 {k.masked} 暂停期满，发送探测请求")
+                break
+        
+        if chosen is None:
+            healthy = [k for k in self.keys if k.ejected_until == 0]
+            if healthy:
+                chosen = min(healthy, key=lambda k: (k.in_flight, k.requests))
+            else:
+                # 所有密钥都被移出时，使用最早恢复的密钥，不直接拒绝请求
+                chosen = min(self.keys, key=lambda k: k.ejected_until)
+                logger.warning(f"所有API密钥都处于暂停状态，临时使用密钥 {chosen.masked}")
+        
+        chosen.in_flight += 1
+        chosen.requests += 1
+        return chosen
+    
+    def cancel(self, api_key: ApiKey):
+        """撤销一次没有发出请求的acquire，不计入成功或失败
+        
+        Args:
+            api_key: acquire返回的密钥
+        """
+        api_key.in_flight -= 1
+        api_key.requests -= 1
+        # 占用的探测名额交还给下一个请求
+        api_key.probing = False
+    
+    def release(self, api_key: ApiKey, status: Optional[int]):
+        """请求结束后更新密钥状态
+        
+        Args:
+            api_key: acquire返回的密钥
+            status: 响应状态码，网络异常时为None
+        """
+        api_key.in_flight -= 1
+        api_key.last_status = status
+        if status is not None and 200 <= status < 300:
+            api_key.successes += 1
+            if api_key.ejected_until:
+                logger.info(f"密钥 {api_key.masked} 探测成功，重新加入密钥池")
+            api_key.ejected_until = 0.0
+            api_key.eject_seconds = 0.0
+            api_key.probing = False
+            return
+        
+        api_key.failures += 1
+        if status in self.INVALID_STATUSES:
+            self._eject(api_key, self.max_eject_seconds)
+        elif status in self.EJECT_STATUSES:
+            self._eject(api_key, min(self.max_eject_seconds, max(self.base_eject_seconds, api_key.eject_seconds * 2)))
+        elif api_key.probing:
+            # 探测请求因其他原因失败，继续暂停
+            self._eject(api_key, max(self.base_eject_seconds, api_key.eject_seconds))
+    
+    def _eject(self, api_key: ApiKey, seconds: float):
+        # 只有一个密钥时移出没有意义，仍然记录状态码即可
+        if len(self.keys) <= 1:
+            api_key.probing = False
+            return
+        api_key.eject_seconds = seconds
+        api_key.ejected_until = time.time() + seconds
+        api_key.probing = False
+        api_key.ejections += 1
+        logger.warning(f"密钥 {api_key.masked} 暂停使用 {seconds:.0f} 秒 (状态码: {api_key.last_status})")
+    
+    def stats(self) -> List[Dict[str, Any]]:
+        return [k.stats() for k in self.keys]
+
+
+class JobScheduler:
+    """有界任务队列和工作协程池
+    
+    Gemini请求在固定数量的工作协程中执行，消息处理函数只负责入队，
+    队列已满时直接拒绝新任务，避免突发流量压垮事件循环和API配额。
+    """
+    
+    def __init__(self, workers: int = 3, max_queue: int = 20):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.queue = None
+        self.worker_tasks = []
+        self.active = 0       # 正在执行的任务数
+        self.completed = 0    # 已完成的任务数
+        self.rejected = 0     # 因队列已满被拒绝的任务数
+    
+    def start(self):
+        """启动工作协程（已启动时忽略）"""
+        if self.worker_tasks:
+            return
+        # 容量由submit按 执行中+排队中 的任务总数控制
+        self.queue = asyncio.Queue()
+        self.worker_tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"任务队列已启动: 工作协程 {self.workers} 个，队列长度 {self.max_queue}")
+    
+    async def stop(self):
+        """停止工作协程，丢弃尚未执行的任务"""
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+        self.queue = None
+        self.active = 0
+    
+    def submit(self, job: Callable[[], Awaitable[Any]], label: str = "任务") -> Optional[int]:
+        """提交任务
+        
+        Args:
+            job: 返回协程的函数，在工作协程中调用
+            label: 日志中使用的任务名称
+            
+        Returns:
+            Optional[int]: 任务在等待队列中的位置（0表示立即执行），队列已满时返回None
+        """
+        self.start()
+        busy = self.active + self.queue.qsize()
+        if busy >= self.workers + self.max_queue:
+            self.rejected += 1
+            logger.warning(f"任务队列已满，拒绝{label}任务")
+            return None
+        self.queue.put_nowait((job, label))
+        return 0 if busy < self.workers else busy - self.workers + 1
+    
+    async def _worker(self, index: int):
+        while True:
+            job, label = await self.queue.get()
+            self.active += 1
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"执行{label}任务异常: {str(e)}")
+                logger.exception(e)
+            finally:
+                self.active -= 1
+                self.completed += 1
+                self.queue.task_done()
+
+
+class AdaptiveLimiter:
+    """AIMD自适应并发限制
+    
+    每个成功的请求使并发上限增加 1/上限（约每轮请求加1），遇到过载信号（429、503、超时）
+    时上限乘以 backoff_ratio。上一次下调之前发出的请求再失败不会重复下调，
+    避免一批同时失败的请求把上限压到最低。超出上限的请求按到达顺序排队等待。
+    """
+    
+    SUCCESS = "success"
+    OVERLOAD = "overload"
+    
+    def __init__(self, initial: int = 3, min_limit: int = 1, max_limit: int = 16, backoff_ratio: float = 0.5):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.backoff_ratio = backoff_ratio
+        self.in_flight = 0
+        self.waiters = deque()
+        self.last_decrease = 0.0  # 上一次下调上限的时间（事件循环时间）
+        self.decreases = 0
+        self.avg_wait = 0.0       # 排队时间的指数移动平均(秒)
+        self.max_wait = 0.0
+    
+    async def acquire(self) -> float:
+        """等待可用的并发名额
+        
+        Returns:
+            float: 获得名额的时间，释放时传回
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+        else:
+            waiter = loop.create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # 名额已分配给这个请求，交给下一个等待者
+                    self.in_flight -= 1
+                    self._wake()
+                else:
+                    self.waiters.remove(waiter)
+                raise
+        now = loop.time()
+        wait = now - start
+        self.avg_wait = 0.9 * self.avg_wait + 0.1 * wait
+        self.max_wait = max(self.max_wait, wait)
+        return now
+    
+    def release(self, acquired_at: float, outcome: Optional[str] = None):
+        """释放名额并根据请求结果调整上限
+        
+        Args:
+            acquired_at: acquire返回的时间
+            outcome: SUCCESS、OVERLOAD，其他结果为None，不调整上限
+        """
+        self.in_flight -= 1
+        if outcome == self.OVERLOAD:
+            if acquired_at >= self.last_decrease:
+                self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                self.last_decrease = asyncio.get_running_loop().time()
+                self.decreases += 1
+                logger.warning(f"Gemini上游过载，并发上限降低到 {int(self.limit)}")
+        elif outcome == self.SUCCESS:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._wake()
+    
+    def _wake(self):
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "waiting": len(self.waiters),
+            "avg_wait_ms": round(self.avg_wait * 1000, 1),
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "decreases": self.decreases
+        }
+
+
+def _inline_data_bytes(value: Union[str, bytes]) -> bytes:
+    """取得inlineData中的图片数据，兼容InlineDataDecoder已解码的bytes和原始Base64字符串"""
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    return base64.b64decode(value)
+
+
+def _estimate_json_size(obj: Any, key: Optional[str] = None) -> int:
+    """计算json.dumps(obj)（默认参数）的长度，不生成序列化结果
+    
+    inlineData中的data字段是Base64字符串，不含需要转义的字符，直接按长度计算，
+    避免为了判断请求体大小而复制数MB的图片数据。
+    
+    Args:
+        obj: 待计算的对象
+        key: obj在父对象中的键名
+        
+    Returns:
+        int: 序列化后的字节数
+    """
+    if isinstance(obj, dict):
+        if not obj:
+            return 2
+        # 花括号，以及每个键值对之间的 ", " 和键后的 ": "
+        return 2 + 2 * (len(obj) - 1) + sum(
+            len(json.dumps(k)) + 2 + _estimate_json_size(v, k) for k, v in obj.items()
+        )
+    if isinstance(obj, list):
+        if not obj:
+            return 2
+        return 2 + 2 * (len(obj) - 1) + sum(_estimate_json_size(item) for item in obj)
+    if isinstance(obj, str) and key == "data":
+        return len(obj) + 2
+    return len(json.dumps(obj))
+
+
+class InlineDataDecoder:
+    """增量解析Gemini响应的JSON解码器
+    
+    逐块扫描响应正文，inlineData.data 字段的Base64字符串不进入JSON文本，
+    而是边读边解码到每张图片各自的缓冲区中；其余较小的JSON骨架解析后，
+    再把图片字节填回对应的 data 字段。这样内存中只保留解码后的图片数据，
+    不会同时存在原始正文、字符串和解码结果多份副本。
+    """
+    
+    INLINE_KEYS = (b"inlineData", b"inline_data")
+    _SPECIAL = re.compile(rb'[{}\[\]":,]')
+    _STRING_SPECIAL = re.compile(rb'["\\]')
+    _BASE64_CHARS = frozenset(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=")
+    # JSON中单字符转义对应的字符，\uXXXX 单独处理
+    _SIMPLE_ESCAPES = {ord('"'): ord('"'), ord("\\"): ord("\\"), ord("/"): ord("/"), ord("b"): 8,
+                       ord("f"): 12, ord("n"): 10, ord("r"): 13, ord("t"): 9}
+    
+    def __init__(self):
+        self.skeleton = bytearray()  # 去掉图片数据后的JSON文本
+        self.images = []             # 每张图片的解码缓冲区
+        self.size = 0                # 已读取的正文字节数
+        self._stack = []             # 容器栈: [是否对象, 容器在父对象中的键, 当前键, 是否等待键]
+        self._in_string = False
+        self._escape = False
+        self._unicode = None         # 正在读取的 \uXXXX 转义中的十六进制字符
+        self._is_key = False
+        self._key = bytearray()
+        self._divert = None          # 当前正在解码的图片缓冲区
+        self._pending = bytearray()  # 尚未凑满4个字符的Base64数据
+    
+    def feed(self, data: bytes):
+        """写入一段响应正文
+        
+        Raises:
+            json.JSONDecodeError: 图片数据中有无效的转义或Base64数据
+        """
+        self.size += len(data)
+        pos = 0
+        length = len(data)
+        try:
+            while pos < length:
+                if self._divert is not None:
+                    pos = self._feed_inline(data, pos)
+                elif self._in_string:
+                    pos = self._feed_string(data, pos)
+                else:
+                    pos = self._feed_structure(data, pos)
+        except binascii.Error as e:
+            raise self._error(f"Invalid base64 data: {e}")
+    
+    def _error(self, message: str) -> json.JSONDecodeError:
+        """创建解析错误，doc中是去掉图片数据后的正文"""
+        return json.JSONDecodeError(message, self.skeleton.decode("utf-8", "replace"), len(self.skeleton))
+    
+    def _feed_structure(self, data: bytes, pos: int) -> int:
+        match = self._SPECIAL.search(data, pos)
+        if not match:
+            self.skeleton += data[pos:]
+            return len(data)
+        index = match.start()
+        self.skeleton += data[pos:index]
+        char = data[index:index + 1]
+        top = self._stack[-1] if self._stack else None
+        
+        if char == b'"':
+            if top is not None and top[0] and top[3]:
+                self._is_key = True
+                self._key.clear()
+            elif top is not None and top[0] and top[2] == b"data" and top[1] in self.INLINE_KEYS:
+                # 图片数据：不写入JSON骨架，改为写入图片序号
+                self._divert = BytesIO()
+                self._pending.clear()
+                return index + 1
+            else:
+                self._is_key = False
+            self._in_string = True
+        elif char in (b"{", b"["):
+            parent_key = top[2] if top is not None and top[0] else None
+            self._stack.append([char == b"{", parent_key, None, char == b"{"])
+        elif char in (b"}", b"]"):
+            if self._stack:
+                self._stack.pop()
+        elif char == b":":
+            if top is not None:
+                top[3] = False
+        elif char == b",":
+            if top is not None and top[0]:
+                top[3] = True
+        self.skeleton += char
+        return index + 1
+    
+    def _feed_string(self, data: bytes, pos: int) -> int:
+        if self._escape:
+            self._escape = False
+            self.skeleton += data[pos:pos + 1]
+            if self._is_key:
+                self._key += data[pos:pos + 1]
+            return pos + 1
+        match = self._STRING_SPECIAL.search(data, pos)
+        end = match.start() if match else len(data)
+        self.skeleton += data[pos:end]
+        if self._is_key:
+            self._key += data[pos:end]
+        if not match:
+            return end
+        self.skeleton += data[end:end + 1]
+        if data[end:end + 1] == b"\\":
+            self._escape = True
+            if self._is_key:
+                self._key += b"\\"
+        else:
+            self._in_string = False
+            if self._is_key:
+                key = bytes(self._key)
+                if b"\\" in key:
+                    # 键中包含转义时按JSON规则还原
+                    key = json.loads(b'"' + key + b'"').encode()
+                self._stack[-1][2] = key
+        return end + 1
+    
+    def _feed_inline(self, data: bytes, pos: int) -> int:
+        if self._unicode is not None:
+            # \uXXXX 转义，十六进制字符可能分在多个数据块中
+            take = min(4 - len(self._unicode), len(data) - pos)
+            self._unicode += data[pos:pos + take]
+            if len(self._unicode) == 4:
+                try:
+                    code = int(self._unicode, 16)
+                except ValueError:
+                    raise self._error("Invalid \\uXXXX escape")
+                self._add_escaped(code)
+                self._unicode = None
+            return pos + take
+        if self._escape:
+            self._escape = False
+            char = data[pos]
+            if char == ord("u"):
+                self._unicode = bytearray()
+            elif char in self._SIMPLE_ESCAPES:
+                self._add_escaped(self._SIMPLE_ESCAPES[char])
+            else:
+                raise self._error("Invalid \\escape")
+            return pos + 1
+        match = self._STRING_SPECIAL.search(data, pos)
+        end = match.start() if match else len(data)
+        self._pending += data[pos:end]
+        usable = len(self._pending) // 4 * 4
+        if usable:
+            self._divert.write(binascii.a2b_base64(self._pending[:usable]))
+            del self._pending[:usable]
+        if not match:
+            return end
+        if data[end:end + 1] == b"\\":
+            self._escape = True
+        else:
+            if self._pending:
+                self._divert.write(binascii.a2b_base64(self._pending))
+                self._pending.clear()
+            self.skeleton += str(len(self.images)).encode()
+            self.images.append(self._divert)
+            self._divert = None
+        return end + 1
+    
+    def _add_escaped(self, code: int):
+        """写入转义得到的字符，Base64解码忽略的空白等字符直接丢弃"""
+        if code in self._BASE64_CHARS:
+            self._pending.append(code)
+    
+    def close(self) -> Any:
+        """结束解析并返回结果，inlineData.data 的值为解码后的bytes
+        
+        Raises:
+            json.JSONDecodeError: 响应不是完整的JSON
+        """
+        result = json.loads(self.skeleton)
+        self._restore(result)
+        return result
+    
+    def _restore(self, node: Any):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key in ("inlineData", "inline_data") and isinstance(value, dict) and isinstance(value.get("data"), int):
+                    value["data"] = self.images[value["data"]].getvalue()
+                else:
+                    self._restore(value)
+        elif isinstance(node, list):
+            for item in node:
+                self._restore(item)
+
+
+class EncodedPartCache:
+    """已编码图片部分的LRU缓存
+    
+    按 (图片SHA-256, 最大尺寸, 质量, 格式) 缓存压缩并Base64编码后的数据及其MIME类型，
+    多轮编辑时历史图片只需压缩编码一次。缓存按Base64数据的总字节数限制大小。
+    """
+    
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max(0, max_bytes)
+        self.entries = OrderedDict()  # 缓存键 -> (MIME类型, Base64字符串)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def make_key(image_data: bytes, max_size: int, quality: int, format: str) -> Tuple[str, int, int, str]:
+        return hashlib.sha256(image_data).hexdigest(), max_size, quality, format.upper()
+    
+    def get(self, key: Tuple[str, int, int, str]) -> Optional[Tuple[str, str]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+    
+    def put(self, key: Tuple[str, int, int, str], mime_type: str, encoded: str):
+        if len(encoded) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.total_bytes -= len(old[1])
+        self.entries[key] = (mime_type, encoded)
+        self.total_bytes += len(encoded)
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.total_bytes -= len(evicted)
+            self.evictions += 1
+    
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+
+class SingleFlight:
+    """合并相同键的并发调用
+    
+    同一个键同时只执行一次调用，其他调用者等待同一个结果。调用在独立的任务中执行，
+    某个调用者被取消不会影响其他调用者。
+    """
+    
+    def __init__(self):
+        self.calls = {}  # 键 -> 正在执行的任务
+        self.shared = 0  # 等待其他调用结果的次数
+    
+    def _done(self, key: Any, task: asyncio.Task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        # 所有调用者都已取消时，避免出现未读取异常的警告
+        if not task.cancelled():
+            task.exception()
+    
+    async def do(self, key: Any, func: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self.calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+
+class TranslationCache:
+    """提示词翻译的LRU缓存
+    
+    按规范化后的提示词和翻译模型缓存翻译结果，可以保存到JSON文件，重启后继续使用。
+    """
+    
+    def __init__(self, max_entries: int = 1000, path: Optional[str] = None):
+        self.max_entries = max(0, max_entries)
+        self.path = path
+        self.entries = OrderedDict()  # 缓存键 -> 翻译结果
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        if self.path:
+            self.load()
+    
+    # 中文等非ASCII字符两侧的空白不影响语义
+    _WIDE_SPACE = re.compile(r"\s+(?=[^\x00-\x7f])|(?<=[^\x00-\x7f])\s+")
+    
+    @classmethod
+    def make_key(cls, prompt: str, model: str) -> str:
+        """规范化提示词：统一全角半角字符、合并空白并忽略大小写"""
+        normalized = " ".join(unicodedata.normalize("NFKC", prompt).split()).lower()
+        normalized = cls._WIDE_SPACE.sub("", normalized)
+        return f"{model}\n{normalized}"
+    
+    def get(self, key: str) -> Optional[str]:
+        translated = self.entries.get(key)
+        if translated is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return translated
+    
+    def put(self, key: str, translated: str):
+        if not self.max_entries:
+            return
+        self.entries[key] = translated
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self.dirty = True
+    
+    def load(self):
+        """从文件加载缓存，文件不存在或损坏时从空缓存开始"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"加载翻译缓存失败: {e}")
+            return
+        if self.max_entries:
+            for key, translated in list(entries.items())[-self.max_entries:]:
+                self.entries[key] = translated
+    
+    def save(self):
+        """有新的翻译结果时写入文件，先写临时文件再替换"""
+        if not self.path or not self.dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(dict(self.entries), f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+
+class ResultCache:
+    """带过期时间的结果缓存
+    
+    缓存识图、反推等请求的结果，短时间内重复的请求直接返回之前的结果。
+    条数超出上限时淘汰最久未使用的结果。
+    """
+    
+    def __init__(self, max_entries: int = 256, ttl: float = 300):
+        self.max_entries = max(0, max_entries)
+        self.ttl = ttl
+        self.entries = OrderedDict()  # 缓存键 -> (过期时间, 结果)
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: Any) -> Any:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+    
+    def put(self, key: Any, value: Any):
+        if not self.max_entries or self.ttl <= 0:
+            return
+        self.entries[key] = (time.time() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+
+class GenerationCache:
+    """图片生成结果缓存
+    
+    按 (模型, 提示词, 生成参数, 会话历史摘要) 缓存生成的图片和文本，结果在ttl秒后过期，
+    按图片和文本的总字节数限制大小，超出时淘汰最久未使用的结果。
+    """
+    
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: float = 86400):
+        self.max_bytes = max(0, max_bytes)
+        self.ttl = ttl
+        self.entries = OrderedDict()  # 缓存键 -> (过期时间, 图片和文本列表, 最终文本, 字节数)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def make_key(model: str, prompt: str, generation_config: Dict[str, Any], history: List[Any]) -> str:
+        # history 中的图片只包含内容摘要，序列化的数据量很小，可以直接在事件循环中计算
+        key_data = json.dumps([model, prompt, generation_config, history], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[Tuple[List[Tuple[bytes, str]], Optional[str]]]:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return list(entry[1]), entry[2]
+    
+    def put(self, key: str, image_text_pairs: List[Tuple[bytes, str]], final_text: Optional[str]):
+        if self.ttl <= 0:
+            return
+        size = sum(len(image_data) + len(text or "") for image_data, text in image_text_pairs) + len(final_text or "")
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.time() + self.ttl, list(image_text_pairs), final_text, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+    
+    def _remove(self, key: str):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry[3]
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+
+class ImageStore:
+    """按内容寻址的图片存储
+    
+    图片以SHA-256命名保存在同一目录下，相同内容只写入一次，写入时先写临时文件再原子替换。
+    每张图片记录引用它的会话，总大小超出配额时按最近使用顺序删除未被引用的图片。
+    """
+    
+    def __init__(self, root: str, max_bytes: int = 500 * 1024 * 1024, suffix: str = ".png"):
+        self.root = root
+        self.max_bytes = max(0, max_bytes)
+        self.suffix = suffix
+        self.entries = OrderedDict()  # 摘要 -> [文件大小, 最近使用时间]，按最近使用排序
+        self.total_bytes = 0
+        self.refs = defaultdict(set)  # 摘要 -> 引用该图片的会话
+        self.owned = {}               # 会话 -> 该会话引用的摘要集合
+        self.writes = 0
+        self.dedup_hits = 0
+        self.evictions = 0
+        os.makedirs(self.root, exist_ok=True)
+        self._scan()
+    
+    def _scan(self):
+        """加载目录中已有的图片，删除上次未完成写入的临时文件"""
+        files = []
+        for filename in os.listdir(self.root):
+            path = os.path.join(self.root, filename)
+            if filename.endswith(".tmp"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if not filename.endswith(self.suffix) or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, filename[:-len(self.suffix)], stat.st_size))
+        for mtime, digest, size in sorted(files):
+            self.entries[digest] = [size, mtime]
+            self.total_bytes += size
+    
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.root, digest + self.suffix)
+    
+    def digest_of(self, path: Optional[str]) -> Optional[str]:
+        """从存储路径取得摘要，不是本存储中的路径时返回None"""
+        if not path or os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.root):
+            return None
+        filename = os.path.basename(path)
+        return filename[:-len(self.suffix)] if filename.endswith(self.suffix) else None
+    
+    def put(self, image_data: bytes) -> str:
+        """保存图片并返回路径，内容已存在时不重复写入"""
+        digest = hashlib.sha256(image_data).hexdigest()
+        path = self.path_for(digest)
+        entry = self.entries.get(digest)
+        if entry is not None and os.path.exists(path):
+            entry[1] = time.time()
+            self.entries.move_to_end(digest)
+            self.dedup_hits += 1
+            return path
+        
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(image_data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        
+        if entry is not None:
+            self.total_bytes -= entry[0]
+        self.entries[digest] = [len(image_data), time.time()]
+        self.entries.move_to_end(digest)
+        self.total_bytes += len(image_data)
+        self.writes += 1
+        self._evict()
+        return path
+    
+    def read(self, path: str) -> Optional[bytes]:
+        """读取图片并更新最近使用时间，文件不存在时返回None"""
+        try:
+            with open(path, "rb") as f:
+                image_data = f.read()
+        except FileNotFoundError:
+            return None
+        digest = self.digest_of(path)
+        if digest in self.entries:
+            self.entries[digest][1] = time.time()
+            self.entries.move_to_end(digest)
+        return image_data
+    
+    def last_used(self, path: str) -> Optional[float]:
+        """返回图片的最近使用时间，不在存储中时返回None"""
+        entry = self.entries.get(self.digest_of(path))
+        return entry[1] if entry else None
+    
+    def set_refs(self, owner: str, paths: List[str]):
+        """设置会话当前引用的全部图片，传入空列表表示释放该会话的所有引用"""
+        digests = {d for d in (self.digest_of(p) for p in paths) if d}
+        old = self.owned.pop(owner, set())
+        for digest in old - digests:
+            self.refs[digest].discard(owner)
+            if not self.refs[digest]:
+                del self.refs[digest]
+        for digest in digests - old:
+            self.refs[digest].add(owner)
+        if digests:
+            self.owned[owner] = digests
+    
+    def _remove(self, digest: str):
+        size, _ = self.entries.pop(digest)
+        self.total_bytes -= size
+        try:
+            os.remove(self.path_for(digest))
+        except FileNotFoundError:
+            pass
+    
+    def _evict(self):
+        """超出配额时按最近使用顺序删除未被引用的图片"""
+        if self.total_bytes <= self.max_bytes:
+            return
+        for digest in list(self.entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if digest in self.refs:
+                continue
+            self._remove(digest)
+            self.evictions += 1
+        if self.total_bytes > self.max_bytes:
+            logger.warning(f"图片存储超出配额: {self.total_bytes} 字节，剩余图片均被会话引用")
+    
+    def prune(self, max_age: float) -> int:
+        """删除超过max_age秒未使用且未被引用的图片
+        
+        Returns:
+            int: 删除的图片数量
+        """
+        cutoff = time.time() - max_age
+        removed = 0
+        for digest, (_, last_used) in list(self.entries.items()):
+            if last_used >= cutoff:
+                # 按最近使用排序，之后的图片都更新
+                break
+            if digest not in self.refs:
+                self._remove(digest)
+                removed += 1
+        return removed
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "files": len(self.entries),
+            "bytes": self.total_bytes,
+            "referenced": len(self.refs),
+            "writes": self.writes,
+            "dedup_hits": self.dedup_hits,
+            "evictions": self.evictions
+        }
+
+
+class ImageCache:
+    """按总字节数限制大小的图片内存缓存
+    
+    图片按内容摘要只保存一份，会话ID、用户ID等多个键以别名方式共享同一份数据。
+    超出预算时按最近使用顺序淘汰图片；固定的别名（如融图的第一张图片、追问用的识图图片）
+    所指向的图片不会被淘汰，直到别名被删除。
+    """
+    
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024):
+        self.max_bytes = max(0, max_bytes)
+        self.blobs = OrderedDict()  # 摘要 -> {"data": 图片数据, "aliases": 别名集合, "pins": 固定别名数}
+        self.aliases = {}           # 键 -> {"digest": 摘要, "timestamp": 时间戳, "pinned": 是否固定}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def put(self, key: str, image_data: bytes, timestamp: Optional[float] = None, pinned: bool = False):
+        """缓存图片，同一内容只保存一份
+        
+        Args:
+            key: 缓存键
+            image_data: 图片数据
+            timestamp: 图片时间戳，默认为当前时间
+            pinned: 是否固定，固定的图片不会因超出预算被淘汰
+        """
+        digest = hashlib.sha256(image_data).hexdigest()
+        self.remove(key)
+        blob = self.blobs.get(digest)
+        if blob is None:
+            blob = {"data": image_data, "aliases": set(), "pins": 0}
+            self.blobs[digest] = blob
+            self.total_bytes += len(image_data)
+        self.blobs.move_to_end(digest)
+        blob["aliases"].add(key)
+        if pinned:
+            blob["pins"] += 1
+        self.aliases[key] = {
+            "digest": digest,
+            "timestamp": timestamp if timestamp is not None else time.time(),
+            "pinned": pinned
+        }
+        self._evict()
+    
+    def lookup(self, key: str) -> Optional[Tuple[bytes, float]]:
+        """获取图片数据和时间戳，不存在时返回None"""
+        alias = self.aliases.get(key)
+        if alias is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.blobs.move_to_end(alias["digest"])
+        return self.blobs[alias["digest"]]["data"], alias["timestamp"]
+    
+    def get(self, key: str) -> Optional[bytes]:
+        """获取图片数据，不存在时返回None"""
+        entry = self.lookup(key)
+        return entry[0] if entry else None
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self.aliases
+    
+    def remove(self, key: str):
+        """删除一个键，没有其他键引用的图片随之释放"""
+        alias = self.aliases.pop(key, None)
+        if alias is None:
+            return
+        blob = self.blobs[alias["digest"]]
+        blob["aliases"].discard(key)
+        if alias["pinned"]:
+            blob["pins"] -= 1
+        if not blob["aliases"]:
+            del self.blobs[alias["digest"]]
+            self.total_bytes -= len(blob["data"])
+    
+    def pop(self, key: str) -> Optional[bytes]:
+        """取出并删除一个键的图片数据"""
+        image_data = self.get(key)
+        self.remove(key)
+        return image_data
+    
+    def expire(self, max_age: float, now: Optional[float] = None) -> int:
+        """删除超过max_age秒的未固定键
+        
+        Returns:
+            int: 删除的键数量
+        """
+        now = now or time.time()
+        expired = [key for key, alias in self.aliases.items()
+                   if not alias["pinned"] and now - alias["timestamp"] > max_age]
+        for key in expired:
+            self.remove(key)
+        return len(expired)
+    
+    def _evict(self):
+        """超出预算时按最近使用顺序淘汰未固定的图片"""
+        if self.total_bytes <= self.max_bytes:
+            return
+        for digest in list(self.blobs):
+            if self.total_bytes <= self.max_bytes:
+                break
+            blob = self.blobs[digest]
+            if blob["pins"]:
+                continue
+            for key in list(blob["aliases"]):
+                self.remove(key)
+            self.evictions += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "images": len(self.blobs),
+            "keys": len(self.aliases),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+
+class UserSession:
+    """单个用户的全部会话状态
+    
+    使用__slots__减小空闲用户的内存占用；会话历史等字段只在使用时创建。
+    """
+    
+    __slots__ = (
+        "key",              # 会话标识（用户ID）
+        "messages",         # 会话历史，没有会话时为None
+        "conversation_id",  # 会话ID
+        "session_type",     # 会话类型
+        "last_active",      # 会话最后交互时间
+        "last_image",       # 最后一张图片的存储路径
+        "last_image_time",  # 最后一张图片的时间
+        "waiting",          # 正在等待图片的命令类型
+        "waiting_data",     # 等待时保存的提示词或问题
+        "waiting_since",    # 开始等待的时间
+        "merge_received",   # 融图已接收的图片数量
+        "analysis_time",    # 最近一次识图的时间，用于追问
+        "expires_at",       # 在过期索引中登记的时间
+    )
+    
+    # 持久化保存的字段
+    PERSISTED_FIELDS = (
+        "messages", "conversation_id", "session_type", "last_active",
+        "last_image", "last_image_time", "waiting", "waiting_data",
+        "waiting_since", "merge_received", "analysis_time",
+    )
+    
+    def __init__(self, key: str):
+        self.key = key
+        self.messages = None
+        self.conversation_id = ""
+        self.session_type = None
+        self.last_active = 0.0
+        self.last_image = None
+        self.last_image_time = 0.0
+        self.waiting = None
+        self.waiting_data = None
+        self.waiting_since = 0.0
+        self.merge_received = 0
+        self.analysis_time = None
+        self.expires_at = None
+    
+    def has_conversation(self) -> bool:
+        return self.messages is not None or self.session_type is not None
+    
+    def clear_conversation(self):
+        self.messages = None
+        self.conversation_id = ""
+        self.session_type = None
+    
+    def clear_waiting(self):
+        self.waiting = None
+        self.waiting_data = None
+        self.waiting_since = 0.0
+        self.merge_received = 0
+    
+    def has_saved_state(self) -> bool:
+        """是否有需要持久化的状态"""
+        return (self.has_conversation() or self.last_image is not None or self.waiting is not None
+                or self.analysis_time is not None)
+    
+    def is_empty(self) -> bool:
+        return not self.has_saved_state()
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.PERSISTED_FIELDS}
+    
+    @classmethod
+    def from_dict(cls, key: str, data: Dict[str, Any]) -> "UserSession":
+        session = cls(key)
+        for name in cls.PERSISTED_FIELDS:
+            if name in data:
+                setattr(session, name, data[name])
+        return session
+
+
+class SessionBackend:
+    """会话持久化后端接口
+    
+    会话以JSON字符串保存，purge_at 是会话所有状态都过期的时间，后端据此删除冷会话。
+    """
+    
+    persistent = False
+    
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        """读取会话数据，不存在时返回None"""
+        return None
+    
+    def write(self, rows: List[Tuple[str, str, Optional[float]]], deleted: List[str], now: float):
+        """在一个事务中删除过期会话，写入 (会话标识, 数据, purge_at) 并删除指定会话"""
+    
+    def load_settings(self, name: str) -> Dict[str, Any]:
+        """读取一组用户设置"""
+        return {}
+    
+    def save_settings(self, name: str, settings: Dict[str, Any]):
+        """保存一组用户设置"""
+
+
+class MemorySessionBackend(SessionBackend):
+    """内存会话后端，会话只保存在内存中，重启后丢失"""
+
+
+class SqliteSessionBackend(SessionBackend):
+    """SQLite会话后端
+    
+    使用WAL模式，写入在后台线程中批量提交，读取单个会话只需一次主键查询，
+    启动时不加载任何会话。
+    """
+    
+    persistent = True
+    
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, data TEXT NOT NULL, purge_at REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS sessions_purge_at ON sessions (purge_at)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM sessions WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def write(self, rows: List[Tuple[str, str, Optional[float]]], deleted: List[str], now: float):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("DELETE FROM sessions WHERE purge_at <= ?", (now,))
+                self.conn.executemany("INSERT OR REPLACE INTO sessions (key, data, purge_at) VALUES (?, ?, ?)", rows)
+                self.conn.executemany("DELETE FROM sessions WHERE key = ?", [(key,) for key in deleted])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def load_settings(self, name: str) -> Dict[str, Any]:
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM settings WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else {}
+    
+    def save_settings(self, name: str, settings: Dict[str, Any]):
+        data = json.dumps(settings, ensure_ascii=False)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO settings (name, data) VALUES (?, ?)", (name, data))
+
+
+class SessionStore:
+    """用户会话表和过期索引
+    
+    过期索引是按过期时间排序的最小堆，会话更新后重新登记，旧的登记项在出堆时按
+    expires_at 判断并丢弃。清理时只处理已到期的会话，不需要遍历所有用户。
+    
+    使用持久化后端时，内存中只保留最近使用的 max_hot 个会话，其余会话写入后端，
+    下次访问时再加载。修改过的会话由 flush 批量写入后端。
+    
+    后端中不存在的会话标识记录在 absent 中，群聊里没有会话的用户反复发图片时
+    不会每次都查询后端。
+    """
+    
+    def __init__(self, deadline_func: Callable[[UserSession], List[float]],
+                 backend: Optional[SessionBackend] = None, max_hot: int = 0,
+                 on_load: Optional[Callable[[UserSession], None]] = None,
+                 on_unload: Optional[Callable[[str], None]] = None,
+                 max_absent: int = 10000):
+        self.sessions = OrderedDict()  # 会话标识 -> UserSession，按最近使用排序
+        self.heap = []                 # (过期时间, 会话标识)
+        self.deadline_func = deadline_func
+        self.backend = backend or MemorySessionBackend()
+        self.max_hot = max(0, max_hot) if self.backend.persistent else 0
+        self.on_load = on_load
+        self.on_unload = on_unload
+        self.dirty = set()             # 内存中修改过、尚未写入后端的会话
+        self.unsaved = {}              # 已移出内存、尚未写入后端的会话 -> (数据, purge_at)，None表示删除
+        self.writing = {}              # 正在写入后端的会话，格式同 unsaved
+        self.absent = OrderedDict()    # 后端中不存在的会话标识，按最近使用排序
+        self.max_absent = max(0, max_absent)
+        self.flush_lock = asyncio.Lock()
+        self.loads = 0
+        self.unloads = 0
+    
+    def __len__(self) -> int:
+        return len(self.sessions)
+    
+    def __contains__(self, key: str) -> bool:
+        return key in self.sessions
+    
+    def get(self, key: str) -> Optional[UserSession]:
+        session = self.sessions.get(key)
+        if session is not None:
+            self.sessions.move_to_end(key)
+            return session
+        if not self.backend.persistent:
+            return None
+        return self._load(key)
+    
+    def get_or_create(self, key: str) -> UserSession:
+        session = self.get(key)
+        if session is None:
+            session = UserSession(key)
+            self.sessions[key] = session
+        return session
+    
+    def values(self):
+        return self.sessions.values()
+    
+    def _load(self, key: str) -> Optional[UserSession]:
+        """从后端加载会话，尚未写入后端的数据优先"""
+        if key in self.absent:
+            self.absent.move_to_end(key)
+            return None
+        if key in self.unsaved:
+            entry = self.unsaved[key]
+            if entry is None:
+                return None
+            # 数据还没有写入后端，加载后仍需写入
+            del self.unsaved[key]
+            self.dirty.add(key)
+            data = json.loads(entry[0])
+        elif key in self.writing:
+            entry = self.writing[key]
+            data = json.loads(entry[0]) if entry else None
+        else:
+            try:
+                data = self.backend.load(key)
+            except Exception as e:
+                logger.error(f"加载会话 {key} 失败: {e}")
+                return None
+            if data is None:
+                self._mark_absent(key)
+        if data is None:
+            return None
+        session = UserSession.from_dict(key, data)
+        self.sessions[key] = session
+        self.loads += 1
+        self._index(session)
+        if self.on_load is not None:
+            self.on_load(session)
+        self._evict()
+        return self.sessions.get(key)
+    
+    def _mark_absent(self, key: str):
+        """记录后端中不存在的会话标识，超出上限时丢弃最久未使用的记录"""
+        if not self.max_absent:
+            return
+        self.absent[key] = None
+        self.absent.move_to_end(key)
+        while len(self.absent) > self.max_absent:
+            self.absent.popitem(last=False)
+    
+    def _index(self, session: UserSession):
+        """在过期索引中登记会话"""
+        deadlines = self.deadline_func(session)
+        deadline = min(deadlines) if deadlines else None
+        if deadline != session.expires_at:
+            session.expires_at = deadline
+            if deadline is not None:
+                heapq.heappush(self.heap, (deadline, session.key))
+        # 失效的登记项过多时重建索引
+        if len(self.heap) > 2 * len(self.sessions) + 64:
+            self.heap = [(s.expires_at, s.key) for s in self.sessions.values() if s.expires_at is not None]
+            heapq.heapify(self.heap)
+    
+    def _serialize(self, session: UserSession) -> Optional[Tuple[str, Optional[float]]]:
+        """序列化会话，没有需要保存的状态时返回None"""
+        if not session.has_saved_state():
+            return None
+        deadlines = self.deadline_func(session)
+        return json.dumps(session.to_dict(), ensure_ascii=False), (max(deadlines) if deadlines else None)
+    
+    def _evict(self):
+        """内存中的会话超出上限时，将最久未使用的会话移出内存"""
+        if not self.max_hot:
+            return
+        while len(self.sessions) > self.max_hot:
+            key, session = self.sessions.popitem(last=False)
+            session.expires_at = None
+            if key in self.dirty:
+                self.dirty.discard(key)
+                try:
+                    self.unsaved[key] = self._serialize(session)
+                except (TypeError, ValueError) as e:
+                    logger.error(f"序列化会话 {key} 失败: {e}")
+            self.unloads += 1
+            if self.on_unload is not None:
+                self.on_unload(key)
+    
+    def schedule(self, session: UserSession):
+        """会话状态变化后重新登记过期时间，没有任何状态的会话直接删除
+        
+        从未写入后端的会话删除时不需要再删除后端中的数据。
+        """
+        key = session.key
+        if session.is_empty():
+            if self.sessions.get(key) is session:
+                del self.sessions[key]
+            if self.backend.persistent:
+                self.dirty.discard(key)
+                if key not in self.absent:
+                    self.unsaved[key] = None
+                    self._mark_absent(key)
+            session.expires_at = None
+            return
+        if key not in self.sessions:
+            # 会话已被移出内存，调用方持有的对象是最新状态
+            self.sessions[key] = session
+            self.unsaved.pop(key, None)
+        if self.backend.persistent:
+            self.absent.pop(key, None)
+            self.dirty.add(key)
+        self._index(session)
+        self._evict()
+    
+    def pop_due(self, now: float) -> List[UserSession]:
+        """取出所有已到期的会话"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, key = heapq.heappop(self.heap)
+            session = self.sessions.get(key)
+            if session is not None and session.expires_at == deadline:
+                session.expires_at = None
+                due.append(session)
+        return due
+    
+    async def flush(self) -> int:
+        """将修改过的会话批量写入后端，同时删除后端中已过期的会话
+        
+        Returns:
+            int: 写入或删除的会话数量
+        """
+        if not self.backend.persistent:
+            return 0
+        async with self.flush_lock:
+            changes = self.unsaved
+            self.unsaved = {}
+            for key in self.dirty:
+                session = self.sessions.get(key)
+                if session is None:
+                    continue
+                try:
+                    changes[key] = self._serialize(session)
+                except (TypeError, ValueError) as e:
+                    logger.error(f"序列化会话 {key} 失败: {e}")
+            self.dirty = set()
+            
+            rows = [(key, entry[0], entry[1]) for key, entry in changes.items() if entry is not None]
+            deleted = [key for key, entry in changes.items() if entry is None]
+            self.writing = changes
+            try:
+                await asyncio.to_thread(self.backend.write, rows, deleted, time.time())
+            except Exception as e:
+                logger.error(f"写入会话失败: {e}")
+                # 保留未写入的修改，下次再写
+                for key, entry in changes.items():
+                    if key in self.sessions:
+                        self.dirty.add(key)
+                    elif key not in self.unsaved:
+                        self.unsaved[key] = entry
+                return 0
+            finally:
+                self.writing = {}
+            return len(changes)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hot": len(self.sessions),
+            "dirty": len(self.dirty) + len(self.unsaved),
+            "loads": self.loads,
+            "unloads": self.unloads,
+            "absent": len(self.absent),
+            "backend": type(self.backend).__name__
+        }
+
+
 class GeminiImageXXX(PluginBase):
     """基于Google Gemini的图像生成插件 (XXXBot移植版)
     
@@ -49,6 +1892,23 @@ class GeminiImageXXX(PluginBase):
     
     # 请求体大小限制常量（单位：字节）- 限制为4MB，避免413错误
     MAX_REQUEST_SIZE = 4 * 1024 * 1024
+    # 请求体超出限制时，历史图片依次尝试的 (最大尺寸, JPEG质量)
+    HISTORY_IMAGE_LEVELS = [(512, 70), (384, 60), (256, 50)]
+    # 融图请求中输入图片依次尝试的 (最大尺寸, JPEG质量)，直到每张图片都不超过分摊的预算
+    MERGE_IMAGE_LEVELS = [(1024, 90), (800, 85), (640, 80)] + HISTORY_IMAGE_LEVELS
+    # 生成图片请求中历史图片的最大尺寸和JPEG质量
+    GENERATE_HISTORY_MAX_SIZE = 600
+    GENERATE_HISTORY_QUALITY = 80
+    # 编辑图片请求中图片的最大尺寸和JPEG质量，没有会话历史时使用SOURCE尺寸
+    EDIT_IMAGE_MAX_SIZE = 800
+    EDIT_IMAGE_QUALITY = 85
+    EDIT_SOURCE_MAX_SIZE = 2048
+    EDIT_SOURCE_QUALITY = 92
+    # 没有会话历史时，当前图片超出请求体预算后依次尝试的 (最大尺寸, JPEG质量)
+    EDIT_SOURCE_LEVELS = [(EDIT_SOURCE_MAX_SIZE, EDIT_SOURCE_QUALITY), (1536, 88)] + MERGE_IMAGE_LEVELS
+    # 可以不重新编码直接发送的图片格式，以及此时每像素（按最大尺寸计算）允许的平均字节数
+    PASSTHROUGH_MIME_TYPES = ("image/jpeg", "image/png", "image/webp")
+    PASSTHROUGH_BYTES_PER_PIXEL = 0.5
     # 会话中保留的最大消息数量
     MAX_CONVERSATION_MESSAGES = 10
     
@@ -59,7 +1919,19 @@ class GeminiImageXXX(PluginBase):
     SESSION_TYPE_MERGE = "merge"        # 融图模式
     SESSION_TYPE_ANALYSIS = "analysis"   # 图片分析模式
     
+    # 等待图片的命令类型
+    WAIT_REVERSE = "reverse"      # 反推提示词
+    WAIT_REFERENCE = "reference"  # 参考图编辑
+    WAIT_ANALYSIS = "analysis"    # 识图
+    WAIT_MERGE = "merge"          # 融图
+    # 等待超时后保留状态的时间(秒)，期间收到图片会提示超时
+    WAIT_EXPIRE_GRACE = 600
+    
     PAD_API_BASE_URL = "http://127.0.0.1:9011/api" # Base URL for Pad API calls
+    GEMINI_API_BASE_URL = "https://generativelanguage.googleapis.com" # Google官方API地址
+    ANALYSIS_MODEL = "gemini-2.0-flash" # 识图使用的模型
+    # 反推图片使用的提示词
+    REVERSE_PROMPT = "请详细分析这张图片的内容，包括主要对象、场景、风格、颜色等关键特征。如果图片包含文字，也请提取出来。请用简洁清晰的中文进行描述。"
     
     def __init__(self):
         """初始化插件配置"""
@@ -67,6 +1939,9 @@ class GeminiImageXXX(PluginBase):
         
         # 初始化API相关变量
         self.api_key = ""
+        self.api_key_configs = []  # 密钥池配置列表 [{key, model, endpoint}]
+        self.key_eject_seconds = 30       # 密钥遇到配额错误后的初始暂停时间(秒)
+        self.key_max_eject_seconds = 600  # 密钥最长暂停时间(秒)
         self.model = "gemini-2.0-flash-exp-image-generation"
         self.base_url = "https://generativelanguage.googleapis.com/v1"
         self.enable = False
@@ -75,10 +1950,12 @@ class GeminiImageXXX(PluginBase):
         self.max_conversation_messages = 10
         self.reference_image_wait_timeout = 180  # 参考图片等待超时时间(秒)
         self.merge_image_wait_timeout = 180      # 融图等待超时时间(秒)
+        self.merge_max_images = 4                # 一次融图最多使用的图片数量
         self.reverse_image_wait_timeout = 180    # 反推图片等待超时时间(秒)
         self.analysis_image_wait_timeout = 180   # 识图等待超时时间(秒)
         self.follow_up_timeout = 180             # 追问超时时间(秒)
         self.image_cache_timeout = 300           # 图片缓存超时时间(秒)
+        self.stream_generate = False             # 生成图片时是否使用流式接口
         
         # 初始化代理相关变量
         self.proxy_url = ""
@@ -86,11 +1963,74 @@ class GeminiImageXXX(PluginBase):
         self.use_proxy_service = False
         self.proxy_service_url = ""
         
+        # HTTP连接池配置
+        self.http_pool_limit = 100           # 连接池总连接数上限
+        self.http_pool_limit_per_host = 20   # 每个主机的连接数上限
+        self.http_dns_cache_ttl = 300        # DNS缓存时间(秒)
+        self.http_keepalive_timeout = 60     # 空闲连接保持时间(秒)
+        self.http_session = None             # 插件共享的HTTP会话，在async_init中创建
+        
+        # 图片处理池配置
+        self.image_worker_type = "thread"    # 图片处理池类型: thread 或 process
+        self.image_max_workers = 2           # 图片处理并发数
+        self.image_max_queue = 16            # 图片处理最大排队数量
+        self.image_executor = None           # 图片处理池，首次使用时创建
+        self.image_slots = None              # 限制提交到图片处理池的任务数量
+        self.vision_max_edge = 1024          # 识图/追问/反推图片的最大边长
+        self.vision_quality = 85             # 识图/追问/反推图片的JPEG质量
+        self.precompute_images = True        # 收到图片后是否在后台预先压缩编码
+        self.image_max_pixels = DEFAULT_MAX_DECODED_PIXELS  # 解码图片允许的最大像素数
+        
+        # 任务队列配置
+        self.queue_workers = 3               # 同时处理的Gemini请求数
+        self.queue_max_size = 20             # 最大排队任务数，超出时拒绝新请求
+        
+        # 熔断配置
+        self.breaker_failure_threshold = 5   # 连续失败多少次后熔断
+        self.breaker_open_seconds = 30       # 熔断持续时间(秒)
+        self.breaker_fallback_direct = True  # 代理线路熔断时是否改为直接调用Google API
+        self.breakers = {}                   # 线路名称 -> CircuitBreaker
+        
+        # 自适应并发限制配置
+        self.limiter_initial = 3             # 初始并发上限
+        self.limiter_min = 1                 # 最小并发上限
+        self.limiter_max = 16                # 最大并发上限
+        self.limiter_backoff_ratio = 0.5     # 上游过载时并发上限的缩小比例
+        
+        # 缓存配置
+        self.encoded_part_cache_mb = 64      # 已编码历史图片缓存大小(MB)
+        self.image_cache_mb = 128            # 图片内存缓存大小(MB)
+        self.image_store_max_mb = 500        # 图片存储磁盘配额(MB)
+        self.image_store_max_age = 3600      # 未被会话引用的图片保留时间(秒)
+        self.vision_result_ttl = 300         # 识图/反推结果缓存时间(秒)，0表示不缓存
+        self.vision_result_cache_size = 256  # 识图/反推结果缓存条数
+        
+        # 生成结果缓存配置
+        self.generation_cache_enable = False # 是否缓存生成结果，相同的请求直接返回之前的结果
+        self.generation_cache_commands = ["g画"]  # 使用生成结果缓存的命令
+        self.generation_cache_mb = 64        # 生成结果缓存大小(MB)
+        self.generation_cache_ttl = 86400    # 生成结果缓存时间(秒)
+        
+        # 会话存储配置
+        self.session_backend = "memory"      # 会话存储后端：memory 或 sqlite
+        self.session_db_path = "data/sessions.db"  # SQLite数据库路径，相对于插件目录
+        self.session_max_hot = 1000          # 使用持久化后端时内存中保留的会话数量
+        
+        # 重试策略配置
+        self.retry_max_attempts = 5          # 每个请求的最大尝试次数
+        self.retry_base_delay = 1.0          # 退避基础延迟(秒)
+        self.retry_max_delay = 10.0          # 单次退避最大延迟(秒)
+        self.retry_deadline = 90             # 每个请求的总截止时间(秒)
+        self.retry_budget_ratio = 0.2        # 每个请求增加的重试预算
+        self.retry_budget_min_per_second = 0.2  # 每秒补充的最低重试预算
+        
         # 初始化翻译相关变量
         self.enable_translate = False
         self.translate_api_base = ""
         self.translate_api_key = ""
         self.translate_model = ""
+        self.translate_cache_size = 1000     # 翻译缓存条数
+        self.translate_cache_file = ""       # 翻译缓存文件，为空时不保存
         
         # 积分相关配置
         self.enable_points = False
@@ -111,43 +2051,78 @@ class GeminiImageXXX(PluginBase):
         self.translate_on_commands = ["g开启翻译"]
         self.translate_off_commands = ["g关闭翻译"]
         
-        # 会话数据结构
-        self.conversations = {}  # 会话ID -> 会话内容
-        self.last_conversation_time = {}  # 会话ID -> 最后交互时间
-        self.conversation_session_types = {}  # 会话ID -> 会话类型
-        self.last_images = {}  # 会话ID -> 最后图片路径
-        
-        # 图片缓存
-        self.image_cache = {}  # 会话ID -> {content: 二进制数据, timestamp: 时间戳}
+        # 图片缓存（会话ID/用户ID -> 图片数据），在加载配置后创建
+        self.image_cache = None
         
         # 用户翻译设置
         self.user_translate_settings = {}  # 用户ID -> 是否翻译
         
-        # 图片分析相关
-        self.last_analysis_image = {}  # 用户ID -> 图片数据
-        self.last_analysis_time = {}  # 用户ID -> 分析时间戳
-        
-        # 等待状态
-        self.waiting_for_reference_image = {}  # 用户ID -> 等待参考图片的提示词
-        self.waiting_for_reference_image_time = {}  # 用户ID -> 开始等待参考图片的时间戳
-        self.waiting_for_reverse_image = {}  # 用户ID -> 是否等待反推图片
-        self.waiting_for_reverse_image_time = {}  # 用户ID -> 开始等待反推图片的时间戳
-        self.waiting_for_analysis_image = {}  # 用户ID -> 等待识图的问题
-        self.waiting_for_analysis_image_time = {}  # 用户ID -> 开始等待识图的时间戳
-        self.waiting_for_merge_image = {}  # 用户ID -> 等待的融图提示词
-        self.waiting_for_merge_image_time = {}  # 用户ID -> 开始等待融图的时间戳
-        
-        # 融图相关变量
-        self.waiting_for_merge_image_first = {}  # 用户ID -> 是否等待第一张融图图片
-        self.waiting_for_merge_image_first_time = {}  # 用户ID -> 开始等待第一张融图图片的时间戳
-        self.waiting_for_merge_image_second = {}  # 用户ID -> 是否等待第二张融图图片
-        self.waiting_for_merge_image_second_time = {}  # 用户ID -> 开始等待第二张融图图片的时间戳
-        self.merge_image_first = {}  # 用户ID -> 第一张融图图片数据
-        self.merge_first_image = {}  # 用户ID -> 第一张融图图片数据
-        
         # 加载配置
         self._load_config()
         
+        # API密钥池
+        self.api_key_pool = ApiKeyPool(self.key_eject_seconds, self.key_max_eject_seconds)
+        for key_config in self.api_key_configs:
+            self.api_key_pool.add(key_config["key"], key_config.get("model"), key_config.get("endpoint"))
+        if len(self.api_key_pool) > 1:
+            logger.info(f"已加载 {len(self.api_key_pool)} 个Gemini API密钥")
+        
+        # 用户会话（会话历史、等待状态、最后图片等）和过期索引
+        session_backend = self._create_session_backend()
+        self.sessions = SessionStore(self._session_deadlines, session_backend, self.session_max_hot,
+                                     on_load=self._on_session_load, on_unload=self._on_session_unload)
+        # 尚未下载的图片消息：会话标识 -> {bot, message, timestamp}，按登记时间排序，
+        # 其中包含客户端对象，只保存在内存中，也不为只发了图片的用户创建会话
+        self.pending_images = {}
+        try:
+            self.user_translate_settings = session_backend.load_settings("translate")
+        except Exception as e:
+            logger.error(f"加载用户翻译设置失败: {e}")
+        
+        # 图片内存缓存，用户和会话共享同一份图片数据
+        self.image_cache = ImageCache(int(self.image_cache_mb * 1024 * 1024))
+        
+        # 已编码的历史图片缓存
+        self.encoded_part_cache = EncodedPartCache(int(self.encoded_part_cache_mb * 1024 * 1024))
+        self.encode_flight = SingleFlight()
+        self.encode_passthrough = 0  # 未重新编码直接发送的图片数量
+        
+        # 延迟下载的图片，命令和后台预处理同时需要时只下载一次
+        self.download_flight = SingleFlight()
+        
+        # 收到图片后的后台预处理，同时只执行一个，前台任务排队时跳过
+        self.precompute_tasks = set()
+        self.precompute_slots = asyncio.Semaphore(1)
+        self.precompute_done = 0
+        self.precompute_skipped = 0
+        
+        # 提示词翻译缓存，相同提示词的并发翻译请求只调用一次翻译接口
+        translate_cache_path = os.path.join(os.path.dirname(__file__), self.translate_cache_file) if self.translate_cache_file else None
+        self.translate_cache = TranslationCache(self.translate_cache_size, translate_cache_path)
+        self.translate_flight = SingleFlight()
+        
+        # 图片生成结果缓存，只用于配置中启用的命令
+        self.generation_cache = GenerationCache(int(self.generation_cache_mb * 1024 * 1024), self.generation_cache_ttl)
+        
+        # 识图和反推结果缓存，同一张图片的相同请求并发时只调用一次API
+        self.vision_result_cache = ResultCache(self.vision_result_cache_size, self.vision_result_ttl)
+        self.vision_flight = SingleFlight()
+        
+        # Gemini请求任务队列
+        self.job_scheduler = JobScheduler(self.queue_workers, self.queue_max_size)
+        
+        # Gemini请求的自适应并发限制
+        self.gemini_limiter = AdaptiveLimiter(self.limiter_initial, self.limiter_min, self.limiter_max, self.limiter_backoff_ratio)
+        
+        # 所有Gemini请求共享的重试策略和重试预算
+        self.retry_policy = RetryPolicy(
+            max_attempts=self.retry_max_attempts,
+            base_delay=self.retry_base_delay,
+            max_delay=self.retry_max_delay,
+            deadline=self.retry_deadline,
+            budget=RetryBudget(self.retry_budget_ratio, self.retry_budget_min_per_second)
+        )
+        
         # 确保保存目录存在
         self.save_dir = os.path.join(os.path.dirname(__file__), self.save_dir)
         os.makedirs(self.save_dir, exist_ok=True)
@@ -164,6 +2139,9 @@ class GeminiImageXXX(PluginBase):
         self.temp_dir = os.path.join(os.path.dirname(__file__), "temp")
         os.makedirs(self.temp_dir, exist_ok=True)
         logger.info(f"GeminiImageXXX插件临时目录已创建: {self.temp_dir}")
+        
+        # 按内容寻址的图片存储
+        self.image_store = ImageStore(os.path.join(self.temp_dir, "images"), int(self.image_store_max_mb * 1024 * 1024))
 
     async def async_init(self):
         """异步初始化，在插件启动时被调用"""
@@ -171,8 +2149,10 @@ class GeminiImageXXX(PluginBase):
             return
         
         logger.info("GeminiImageXXX插件异步初始化...")
-        # 此处可以添加需要异步执行的初始化操作
-        # 例如检查API密钥有效性等
+        # 创建共享的HTTP会话，所有上游请求复用同一个连接池
+        self._get_http_session()
+        # 启动Gemini请求任务队列
+        self.job_scheduler.start()
         
     async def on_enable(self, bot=None):
         """插件启用时调用"""
@@ -181,7 +2161,30 @@ class GeminiImageXXX(PluginBase):
     async def on_disable(self):
         """插件禁用时调用"""
         logger.info(f"{self.__class__.__name__} 插件已禁用")
-        # 关闭可能的网络会话等
+        # 停止任务队列和后台图片预处理
+        await self.job_scheduler.stop()
+        for task in list(self.precompute_tasks):
+            task.cancel()
+        await asyncio.gather(*self.precompute_tasks, return_exceptions=True)
+        # 关闭共享的HTTP会话
+        if self.http_session is not None and not self.http_session.closed:
+            await self.http_session.close()
+        self.http_session = None
+        # 关闭图片处理池
+        if self.image_executor is not None:
+            self.image_executor.shutdown(wait=False, cancel_futures=True)
+            self.image_executor = None
+            self.image_slots = None
+        # 写入所有修改过的会话，重启后可以继续之前的会话
+        await self.sessions.flush()
+        self._save_translate_cache()
+        
+    @schedule('interval', seconds=30)
+    async def flush_sessions(self, bot: WechatAPIClient):
+        """定期将修改过的会话写入会话存储"""
+        if not self.enable:
+            return
+        await self.sessions.flush()
         
     @schedule('interval', minutes=5)
     async def cleanup_tasks(self, bot: WechatAPIClient):
@@ -192,8 +2195,19 @@ class GeminiImageXXX(PluginBase):
         logger.debug("执行GeminiImageXXX定期清理任务...")
         self._cleanup_expired_conversations()
         self._cleanup_image_cache()
+        self._save_translate_cache()
+        self._log_runtime_stats()
+        
+        # 清理图片存储
+        try:
+            removed = self.image_store.prune(self.image_store_max_age)
+            if removed > 0:
+                logger.info(f"清理了 {removed} 张过期的存储图片")
+        except Exception as e:
+            logger.error(f"清理图片存储时发生错误: {e}")
+            logger.exception(e)
         
-        # 清理临时目录中的旧文件
+        # 清理临时目录中的旧文件（旧版本遗留的临时图片）
         try:
             now = time.time()
             temp_files_cleaned = 0
@@ -214,6 +2228,57 @@ class GeminiImageXXX(PluginBase):
             logger.error(f"清理临时文件时发生错误: {e}")
             logger.exception(e)
     
+    def get_runtime_stats(self) -> Dict[str, Any]:
+        """获取插件运行统计信息"""
+        return {
+            "api_keys": self.api_key_pool.stats(),
+            "queue": {
+                "active": self.job_scheduler.active,
+                "waiting": self.job_scheduler.queue.qsize() if self.job_scheduler.queue else 0,
+                "completed": self.job_scheduler.completed,
+                "rejected": self.job_scheduler.rejected
+            },
+            "gemini_limiter": self.gemini_limiter.stats(),
+            "breakers": {route: breaker.stats() for route, breaker in self.breakers.items()},
+            "image_cache": self.image_cache.stats(),
+            "encoded_part_cache": dict(self.encoded_part_cache.stats(), coalesced=self.encode_flight.shared,
+                                       passthrough=self.encode_passthrough),
+            "precompute": {
+                "running": len(self.precompute_tasks),
+                "done": self.precompute_done,
+                "skipped": self.precompute_skipped
+            },
+            "image_store": self.image_store.stats(),
+            "sessions": self.sessions.stats(),
+            "translate_cache": dict(self.translate_cache.stats(), coalesced=self.translate_flight.shared),
+            "vision_result_cache": dict(self.vision_result_cache.stats(), coalesced=self.vision_flight.shared),
+            "generation_cache": self.generation_cache.stats()
+        }
+    
+    def _log_runtime_stats(self):
+        """将运行统计信息写入日志"""
+        stats = self.get_runtime_stats()
+        for key_stats in stats["api_keys"]:
+            logger.info(f"密钥统计: {key_stats}")
+        logger.info(f"任务队列统计: {stats['queue']}")
+        logger.info(f"Gemini并发限制统计: {stats['gemini_limiter']}")
+        logger.info(f"线路熔断统计: {stats['breakers']}")
+        logger.info(f"图片缓存统计: {stats['image_cache']}")
+        logger.info(f"历史图片编码缓存统计: {stats['encoded_part_cache']}")
+        logger.info(f"图片预处理统计: {stats['precompute']}")
+        logger.info(f"图片存储统计: {stats['image_store']}")
+        logger.info(f"会话存储统计: {stats['sessions']}")
+        logger.info(f"翻译缓存统计: {stats['translate_cache']}")
+        logger.info(f"识图/反推结果缓存统计: {stats['vision_result_cache']}")
+        logger.info(f"生成结果缓存统计: {stats['generation_cache']}")
+    
+    def _save_translate_cache(self):
+        """保存翻译缓存文件"""
+        try:
+            self.translate_cache.save()
+        except Exception as e:
+            logger.error(f"保存翻译缓存失败: {e}")
+    
     def _load_config(self):
         """加载插件配置"""
         config_path = os.path.join(os.path.dirname(__file__), "config.toml")
@@ -224,19 +2289,32 @@ class GeminiImageXXX(PluginBase):
             # 读取基本配置
             basic_config = config.get("basic", {})
             self.enable = basic_config.get("enable", True)
-            self.api_key = basic_config.get("gemini_api_key", "")
+            # gemini_api_key 可以是单个密钥，也可以是密钥列表
+            api_keys = basic_config.get("gemini_api_key", "")
+            if isinstance(api_keys, str):
+                api_keys = [api_keys] if api_keys else []
+            self.api_key_configs = [{"key": k} for k in api_keys if k]
+            # [[api_keys]] 中可以为每个密钥单独指定模型和接口地址
+            for key_config in config.get("api_keys", []):
+                if key_config.get("key"):
+                    self.api_key_configs.append(key_config)
+            self.api_key = self.api_key_configs[0]["key"] if self.api_key_configs else ""
             self.model = basic_config.get("model", "gemini-2.0-flash-exp-image-generation")
             self.save_dir = basic_config.get("save_path", "temp_images")
             self.conversation_expire_seconds = basic_config.get("conversation_expire_seconds", 180)
             self.max_conversation_messages = basic_config.get("max_conversation_messages", 10)
+            self.key_eject_seconds = basic_config.get("key_eject_seconds", 30)
+            self.key_max_eject_seconds = basic_config.get("key_max_eject_seconds", 600)
             
             # 超时配置
             self.reference_image_wait_timeout = basic_config.get("reference_image_wait_timeout", 180)
             self.merge_image_wait_timeout = basic_config.get("merge_image_wait_timeout", 180)
+            self.merge_max_images = max(2, basic_config.get("merge_max_images", 4))
             self.reverse_image_wait_timeout = basic_config.get("reverse_image_wait_timeout", 180)
             self.analysis_image_wait_timeout = basic_config.get("analysis_image_wait_timeout", 180)
             self.follow_up_timeout = basic_config.get("follow_up_timeout", 180)
             self.image_cache_timeout = basic_config.get("image_cache_timeout", 300)
+            self.stream_generate = basic_config.get("stream_generate", False)
             
             # 命令配置
             cmd_config = config.get("commands", {})
@@ -266,12 +2344,80 @@ class GeminiImageXXX(PluginBase):
             self.use_proxy_service = proxy_config.get("use_proxy_service", True)
             self.proxy_service_url = proxy_config.get("proxy_service_url", "")
             
+            # HTTP连接池配置
+            http_config = config.get("http", {})
+            self.http_pool_limit = http_config.get("pool_limit", 100)
+            self.http_pool_limit_per_host = http_config.get("pool_limit_per_host", 20)
+            self.http_dns_cache_ttl = http_config.get("dns_cache_ttl", 300)
+            self.http_keepalive_timeout = http_config.get("keepalive_timeout", 60)
+            
+            # 图片处理池配置
+            image_config = config.get("image", {})
+            self.image_worker_type = image_config.get("worker_type", "thread")
+            self.image_max_workers = max(1, image_config.get("max_workers", 2))
+            self.image_max_queue = max(0, image_config.get("max_queue", 16))
+            self.vision_max_edge = max(64, image_config.get("vision_max_edge", 1024))
+            self.vision_quality = min(100, max(1, image_config.get("vision_quality", 85)))
+            self.precompute_images = image_config.get("precompute", True)
+            self.image_max_pixels = image_config.get("max_decoded_pixels", DEFAULT_MAX_DECODED_PIXELS)
+            
+            # 任务队列配置
+            queue_config = config.get("queue", {})
+            self.queue_workers = queue_config.get("workers", 3)
+            self.queue_max_size = queue_config.get("max_size", 20)
+            
+            # 熔断配置
+            breaker_config = config.get("breaker", {})
+            self.breaker_failure_threshold = breaker_config.get("failure_threshold", 5)
+            self.breaker_open_seconds = breaker_config.get("open_seconds", 30)
+            self.breaker_fallback_direct = breaker_config.get("fallback_direct", True)
+            
+            # 自适应并发限制配置
+            limiter_config = config.get("limiter", {})
+            self.limiter_initial = limiter_config.get("initial", 3)
+            self.limiter_min = limiter_config.get("min", 1)
+            self.limiter_max = limiter_config.get("max", 16)
+            self.limiter_backoff_ratio = limiter_config.get("backoff_ratio", 0.5)
+            
+            # 缓存配置
+            cache_config = config.get("cache", {})
+            self.encoded_part_cache_mb = cache_config.get("encoded_part_cache_mb", 64)
+            self.image_cache_mb = cache_config.get("image_cache_mb", 128)
+            self.image_store_max_mb = cache_config.get("image_store_max_mb", 500)
+            self.image_store_max_age = cache_config.get("image_store_max_age", 3600)
+            self.vision_result_ttl = cache_config.get("vision_result_ttl", 300)
+            self.vision_result_cache_size = cache_config.get("vision_result_cache_size", 256)
+            
+            # 生成结果缓存配置
+            generation_cache_config = config.get("generation_cache", {})
+            self.generation_cache_enable = generation_cache_config.get("enable", False)
+            self.generation_cache_commands = generation_cache_config.get("commands", ["g画"])
+            self.generation_cache_mb = generation_cache_config.get("max_mb", 64)
+            self.generation_cache_ttl = generation_cache_config.get("ttl", 86400)
+            
+            # 会话存储配置
+            session_config = config.get("session", {})
+            self.session_backend = session_config.get("backend", "memory")
+            self.session_db_path = session_config.get("db_path", "data/sessions.db")
+            self.session_max_hot = session_config.get("max_hot", 1000)
+            
+            # 重试策略配置
+            retry_config = config.get("retry", {})
+            self.retry_max_attempts = retry_config.get("max_attempts", 5)
+            self.retry_base_delay = retry_config.get("base_delay", 1.0)
+            self.retry_max_delay = retry_config.get("max_delay", 10.0)
+            self.retry_deadline = retry_config.get("deadline_seconds", 90)
+            self.retry_budget_ratio = retry_config.get("budget_ratio", 0.2)
+            self.retry_budget_min_per_second = retry_config.get("budget_min_per_second", 0.2)
+            
             # 翻译配置
             translate_config = config.get("translate", {})
             self.enable_translate = translate_config.get("enable", True)
             self.translate_api_base = translate_config.get("api_base", "https://open.bigmodel.cn/api/paas/v4")
             self.translate_api_key = translate_config.get("api_key", "")
             self.translate_model = translate_config.get("model", "glm-4-flash")
+            self.translate_cache_size = translate_config.get("cache_size", 1000)
+            self.translate_cache_file = translate_config.get("cache_file", "")
             
             # 设置基本API URL
             self.base_url = "https://generativelanguage.googleapis.com/v1"
@@ -281,6 +2427,235 @@ class GeminiImageXXX(PluginBase):
             logger.error(f"加载配置文件失败: {str(e)}")
             logger.exception(e)
     
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        """获取插件共享的HTTP会话，不存在或已关闭时重新创建
+        
+        所有上游请求（Gemini、代理服务、翻译API、Pad API）复用同一个连接池，
+        按主机维护keep-alive连接并缓存DNS结果，避免每次请求重新握手。
+        
+        Returns:
+            aiohttp.ClientSession: 共享的HTTP会话
+        """
+        if self.http_session is None or self.http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.http_pool_limit,
+                limit_per_host=self.http_pool_limit_per_host,
+                use_dns_cache=True,
+                ttl_dns_cache=self.http_dns_cache_ttl,
+                keepalive_timeout=self.http_keepalive_timeout
+            )
+            self.http_session = aiohttp.ClientSession(connector=connector)
+            logger.info(f"已创建共享HTTP连接池: 总上限 {self.http_pool_limit}，单主机上限 {self.http_pool_limit_per_host}")
+        return self.http_session
+    
+    def _get_image_executor(self) -> Executor:
+        """获取图片处理池，首次调用时按配置创建线程池或进程池"""
+        if self.image_executor is None:
+            if self.image_worker_type == "process":
+                self.image_executor = ProcessPoolExecutor(max_workers=self.image_max_workers)
+            else:
+                self.image_executor = ThreadPoolExecutor(
+                    max_workers=self.image_max_workers,
+                    thread_name_prefix="gemini_image"
+                )
+            # 正在处理和排队的任务总数不超过 并发数+队列长度，超出时调用方等待
+            self.image_slots = asyncio.Semaphore(self.image_max_workers + self.image_max_queue)
+            logger.info(f"已创建图片处理池: 类型 {self.image_worker_type}，并发数 {self.image_max_workers}，队列长度 {self.image_max_queue}")
+        return self.image_executor
+    
+    def _effective_models(self, model: Optional[str] = None) -> List[str]:
+        """获取请求实际可能使用的模型
+        
+        指定了模型时只使用该模型，否则每个密钥使用自己配置的模型，未配置时使用全局模型。
+        
+        Args:
+            model: 请求指定的模型名称
+            
+        Returns:
+            List[str]: 去重后的模型名称列表，按密钥顺序排列
+        """
+        if model:
+            return [model]
+        models = []
+        for api_key in self.api_key_pool.keys:
+            effective = api_key.model or self.model
+            if effective not in models:
+                models.append(effective)
+        return models or [self.model]
+    
+    def _get_gemini_endpoint(self, api_key: "ApiKey", model: str, direct: bool = False, stream: bool = False) -> Tuple[str, Dict[str, str], Optional[str]]:
+        """根据密钥和配置确定Gemini请求地址
+        
+        Args:
+            api_key: 本次使用的API密钥
+            model: 模型名称
+            direct: 是否跳过代理服务直接调用Google API
+            stream: 是否使用streamGenerateContent流式接口
+            
+        Returns:
+            Tuple[str, Dict[str, str], Optional[str]]: 请求URL, URL参数, HTTP代理地址
+        """
+        if api_key.endpoint and not direct:
+            # 密钥单独指定的接口地址
+            base_url = api_key.endpoint
+        elif self.use_proxy_service and self.proxy_service_url and not direct:
+            # 使用代理服务调用API
+            base_url = self.proxy_service_url
+        else:
+            base_url = self.GEMINI_API_BASE_URL
+        if stream:
+            url = f"{base_url.rstrip('/')}/v1beta/models/{model}:streamGenerateContent"
+            params = {"key": api_key.key, "alt": "sse"}
+        else:
+            url = f"{base_url.rstrip('/')}/v1beta/models/{model}:generateContent"
+            params = {"key": api_key.key}
+        
+        # 只有直接调用Google API时才使用HTTP代理
+        proxy = None
+        if base_url == self.GEMINI_API_BASE_URL and self.enable_proxy and self.proxy_url:
+            proxy = self.proxy_url
+        return url, params, proxy
+    
+    def _get_breaker(self, route: str) -> CircuitBreaker:
+        """获取上游线路的熔断器，首次使用时创建"""
+        breaker = self.breakers.get(route)
+        if breaker is None:
+            breaker = CircuitBreaker(route, self.breaker_failure_threshold, self.breaker_open_seconds)
+            self.breakers[route] = breaker
+        return breaker
+    
+    def _select_gemini_route(self, api_key: "ApiKey", direct: bool = False) -> Tuple[CircuitBreaker, bool]:
+        """选择本次Gemini请求的线路
+        
+        线路熔断时，如果配置允许并且直连线路可用，改为直接调用Google API，否则抛出CircuitOpenError。
+        
+        Args:
+            api_key: 本次使用的API密钥
+            direct: 是否跳过代理服务直接调用Google API
+            
+        Returns:
+            Tuple[CircuitBreaker, bool]: 线路的熔断器, 是否直接调用Google API
+        """
+        if direct:
+            route = "direct"
+        elif api_key.endpoint:
+            route = f"endpoint:{api_key.endpoint}"
+        elif self.use_proxy_service and self.proxy_service_url:
+            route = "proxy"
+        else:
+            route = "direct"
+        
+        breaker = self._get_breaker(route)
+        if breaker.allow():
+            return breaker, direct
+        if route != "direct" and self.breaker_fallback_direct:
+            direct_breaker = self._get_breaker("direct")
+            if direct_breaker.allow():
+                logger.warning(f"线路 {route} 已熔断，改为直接调用Google API")
+                return direct_breaker, True
+        raise CircuitOpenError(route, breaker.retry_in())
+    
+    async def _call_gemini(self, request_body: str, handler: Callable[[aiohttp.ClientResponse], Awaitable[Any]],
+                           label: str = "Gemini请求", model: Optional[str] = None, timeout: float = 60, direct: bool = False,
+                           stream: bool = False) -> Any:
+        """向Gemini发送generateContent请求，按统一的重试策略处理失败
+        
+        每次尝试都从密钥池中选择当前负载最低的健康密钥，因此重试会自动切换到其他密钥。
+        
+        Args:
+            request_body: 已序列化的请求体，重试时复用
+            handler: 处理最终响应的协程函数，返回值作为本函数的返回值
+            label: 日志中使用的请求名称
+            model: 模型名称，为空时使用密钥配置的图像模型
+            timeout: 单次请求超时时间(秒)
+            direct: 是否跳过代理服务直接调用Google API
+            stream: 是否使用streamGenerateContent流式接口（SSE）
+            
+        Returns:
+            handler的返回值；重试结束仍失败时抛出RetryableStatusError或网络异常，线路熔断时抛出CircuitOpenError
+        """
+        if not len(self.api_key_pool):
+            raise ValueError("未配置Gemini API密钥")
+        headers = {"Content-Type": "application/json"}
+        session = self._get_http_session()
+        
+        async def attempt(remaining: float) -> Any:
+            # 并发上限根据上游的过载反馈自动调整
+            acquired_at = await self.gemini_limiter.acquire()
+            api_key = self.api_key_pool.acquire()
+            status = None
+            outcome = None
+            breaker = None
+            try:
+                # 线路熔断时直接失败，或按配置改为直接调用Google API
+                breaker, use_direct = self._select_gemini_route(api_key, direct)
+                effective_model = model or api_key.model or self.model
+                url, params, proxy = self._get_gemini_endpoint(api_key, effective_model, use_direct, stream)
+                async with session.post(
+                    url,
+                    headers=headers,
+                    params=params,
+                    data=request_body,
+                    proxy=proxy,
+                    timeout=aiohttp.ClientTimeout(total=min(timeout, remaining))
+                ) as response:
+                    status = response.status
+                    logger.info(f"{label} Gemini API响应状态码: {status} (密钥 {api_key.masked}，模型 {effective_model})")
+                    if status in (429, 503):
+                        outcome = AdaptiveLimiter.OVERLOAD
+                    elif status == 200:
+                        outcome = AdaptiveLimiter.SUCCESS
+                    if status >= 500 and status not in ApiKeyPool.EJECT_STATUSES:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    if self.retry_policy.is_retryable_status(status):
+                        body = await response.text()
+                        retry_after = _parse_retry_after(response.headers.get("Retry-After"), body)
+                        if status in ApiKeyPool.EJECT_STATUSES and self.api_key_pool.has_other_available(api_key):
+                            # 还有其他可用密钥时立即换密钥重试，不必等待这个密钥的配额恢复
+                            retry_after = 0.0
+                        raise RetryableStatusError(status, retry_after, body)
+                    return await handler(response)
+            except asyncio.TimeoutError:
+                outcome = AdaptiveLimiter.OVERLOAD
+                if breaker is not None and status is None:
+                    breaker.record_failure()
+                raise
+            except aiohttp.ClientConnectionError:
+                if breaker is not None and status is None:
+                    breaker.record_failure()
+                raise
+            finally:
+                if breaker is None:
+                    # 线路熔断，请求没有发出，不影响密钥状态
+                    self.api_key_pool.cancel(api_key)
+                else:
+                    self.api_key_pool.release(api_key, status)
+                self.gemini_limiter.release(acquired_at, outcome)
+        
+        return await self.retry_policy.run(attempt, label)
+    
+    async def _submit_job(self, bot: WechatAPIClient, message: dict, job: Callable[[], Awaitable[Any]], label: str) -> bool:
+        """将Gemini请求加入任务队列，并告知用户排队情况
+        
+        Args:
+            bot: 微信API客户端
+            message: 触发请求的消息
+            job: 返回处理协程的函数
+            label: 任务名称
+            
+        Returns:
+            bool: 是否成功入队
+        """
+        position = self.job_scheduler.submit(job, label)
+        if position is None:
+            await bot.send_text_message(message["FromWxid"], "当前请求较多，请稍后再试")
+            return False
+        if position > 0:
+            await bot.send_text_message(message["FromWxid"], f"已加入处理队列，前面还有 {position} 个任务，请稍候...")
+        return True
+    
     def _get_user_id(self, message: dict) -> str:
         """从消息中获取用户ID"""
         # 获取用户ID，优先使用wxid
@@ -312,80 +2687,199 @@ class GeminiImageXXX(PluginBase):
         # 默认行为 - 默认启用翻译
         return True
     
+    def _get_history(self, conversation_key: str) -> List[Dict]:
+        """获取会话历史，没有会话时返回空列表"""
+        session = self.sessions.get(conversation_key)
+        return session.messages if session is not None and session.messages is not None else []
+    
+    def _get_session_type(self, conversation_key: str) -> Optional[str]:
+        """获取会话类型"""
+        session = self.sessions.get(conversation_key)
+        return session.session_type if session is not None else None
+    
+    def _wait_timeout(self, waiting: str) -> float:
+        """获取等待图片命令的超时时间"""
+        return {
+            self.WAIT_REVERSE: self.reverse_image_wait_timeout,
+            self.WAIT_REFERENCE: self.reference_image_wait_timeout,
+            self.WAIT_ANALYSIS: self.analysis_image_wait_timeout,
+            self.WAIT_MERGE: self.merge_image_wait_timeout,
+        }.get(waiting, 180)
+    
+    def _set_waiting(self, user_id: str, waiting: str, data: Any = None):
+        """设置用户等待图片的状态，会替换之前未完成的等待"""
+        session = self.sessions.get_or_create(user_id)
+        if session.waiting and session.waiting != waiting:
+            logger.info(f"用户 {user_id} 之前的等待状态 {session.waiting} 被新的命令替换")
+        if session.waiting == self.WAIT_MERGE:
+            self._remove_merge_images(user_id)
+        session.clear_waiting()
+        session.waiting = waiting
+        session.waiting_data = data
+        session.waiting_since = time.time()
+        self.sessions.schedule(session)
+    
+    def _clear_waiting(self, user_id: str):
+        """清除用户等待图片的状态"""
+        session = self.sessions.get(user_id)
+        if session is None or session.waiting is None:
+            return
+        if session.waiting == self.WAIT_MERGE:
+            self._remove_merge_images(user_id)
+        session.clear_waiting()
+        self.sessions.schedule(session)
+    
+    def _remove_merge_images(self, user_id: str):
+        """删除用户融图过程中暂存的图片"""
+        for index in range(self.merge_max_images):
+            self.image_cache.remove(f"merge:{user_id}:{index}")
+    
+    def _create_session_backend(self) -> SessionBackend:
+        """根据配置创建会话存储后端，SQLite打开失败时使用内存后端"""
+        if self.session_backend == "sqlite":
+            db_path = os.path.join(os.path.dirname(__file__), self.session_db_path)
+            try:
+                backend = SqliteSessionBackend(db_path)
+                logger.info(f"会话存储使用SQLite: {db_path}")
+                return backend
+            except Exception as e:
+                logger.error(f"打开会话数据库失败，改用内存存储: {e}")
+        elif self.session_backend != "memory":
+            logger.warning(f"未知的会话存储后端 {self.session_backend}，使用内存存储")
+        return MemorySessionBackend()
+    
+    def _on_session_load(self, session: UserSession):
+        """会话从后端加载后，清除加载前已过期的状态并恢复图片引用"""
+        now = time.time()
+        if session.expires_at is not None and session.expires_at <= now:
+            self._expire_session(session, now)
+            return
+        if self._store_history_images(session):
+            self.sessions.schedule(session)
+        self._sync_image_refs(session.key)
+    
+    def _store_history_images(self, session: UserSession) -> bool:
+        """将旧版本保存在会话历史中的Base64图片移入图片存储，历史中只保留路径
+        
+        Returns:
+            bool: 会话历史是否有修改
+        """
+        changed = False
+        for msg in session.messages or []:
+            for index, part in enumerate(msg.get("parts", [])):
+                if "inline_data" not in part:
+                    continue
+                try:
+                    path = self._store_image(base64.b64decode(part["inline_data"]["data"]))
+                except (binascii.Error, ValueError, KeyError, TypeError) as e:
+                    logger.error(f"转换会话 {session.key} 的历史图片失败: {e}")
+                    continue
+                if path:
+                    msg["parts"][index] = {"image_url": path}
+                    changed = True
+        return changed
+    
+    def _on_session_unload(self, conversation_key: str):
+        """会话移出内存后释放它持有的图片引用"""
+        self.image_store.set_refs(conversation_key, [])
+    
+    def _set_translate_setting(self, user_id: str, enabled: bool):
+        """保存用户的翻译设置"""
+        self.user_translate_settings[user_id] = enabled
+        try:
+            self.sessions.backend.save_settings("translate", self.user_translate_settings)
+        except Exception as e:
+            logger.error(f"保存用户翻译设置失败: {e}")
+    
+    def _session_deadlines(self, session: UserSession) -> List[float]:
+        """计算会话中各项状态的过期时间"""
+        deadlines = []
+        if session.has_conversation():
+            deadlines.append(session.last_active + self.conversation_expire_seconds)
+        if session.last_image is not None:
+            deadlines.append(session.last_image_time + self.image_store_max_age)
+        if session.waiting is not None:
+            # 超时后再保留一段时间，用户超时后发送图片时可以收到超时提示
+            deadlines.append(session.waiting_since + self._wait_timeout(session.waiting) + self.WAIT_EXPIRE_GRACE)
+        if session.analysis_time is not None:
+            deadlines.append(session.analysis_time + self.follow_up_timeout)
+        return deadlines
+    
+    def _expire_session(self, session: UserSession, now: float):
+        """清除会话中已过期的状态"""
+        key = session.key
+        if session.has_conversation() and now - session.last_active > self.conversation_expire_seconds:
+            session.clear_conversation()
+        if session.last_image is not None and now - session.last_image_time > self.image_store_max_age:
+            session.last_image = None
+        if session.waiting is not None and now - session.waiting_since > self._wait_timeout(session.waiting) + self.WAIT_EXPIRE_GRACE:
+            if session.waiting == self.WAIT_MERGE:
+                self._remove_merge_images(key)
+            session.clear_waiting()
+        if session.analysis_time is not None and now - session.analysis_time > self.follow_up_timeout:
+            session.analysis_time = None
+            self.image_cache.remove(f"analysis:{key}")
+        self._sync_image_refs(key)
+        self.sessions.schedule(session)
+    
     def _cleanup_expired_conversations(self):
-        """清理过期会话"""
+        """清理过期会话，只处理过期索引中已到期的会话"""
         current_time = time.time()
-        expired_keys = []
-        
-        for key, last_time in list(self.last_conversation_time.items()):
-            if current_time - last_time > self.conversation_expire_seconds:
-                expired_keys.append(key)
-                
-        for key in expired_keys:
-            if key in self.conversations:
-                del self.conversations[key]
-            if key in self.last_conversation_time:
-                del self.last_conversation_time[key]
-            if key in self.conversation_session_types:
-                del self.conversation_session_types[key]
-        
-        # 检查并清理过长的会话，防止请求体过大
-        for key, conversation in list(self.conversations.items()):
-            messages = conversation.get("messages", [])
-            if len(messages) > self.max_conversation_messages:
-                # 保留最近的消息
-                excess = len(messages) - self.max_conversation_messages
-                self.conversations[key]["messages"] = messages[excess:]
-                logger.info(f"会话 {key} 长度超过限制，已裁剪为最新的 {self.max_conversation_messages} 条消息")
+        due_sessions = self.sessions.pop_due(current_time)
+        for session in due_sessions:
+            self._expire_session(session, current_time)
+        if due_sessions:
+            logger.debug(f"处理了 {len(due_sessions)} 个到期会话，剩余 {len(self.sessions)} 个")
     
     def _cleanup_image_cache(self):
         """清理过期的图片缓存"""
-        current_time = time.time()
-        expired_keys = []
-        
-        for key, cache_data in self.image_cache.items():
-            if current_time - cache_data["timestamp"] > self.image_cache_timeout:
-                expired_keys.append(key)
-        
-        for key in expired_keys:
-            del self.image_cache[key]
-            logger.debug(f"清理过期图片缓存: {key}")
+        expired_count = self.image_cache.expire(self.image_cache_timeout)
+        if expired_count:
+            logger.debug(f"清理过期图片缓存: {expired_count} 个")
+        # 待下载图片按登记时间排序，只需检查最前面的
+        deadline = time.time() - self.image_cache_timeout
+        while self.pending_images:
+            key = next(iter(self.pending_images))
+            if self.pending_images[key]["timestamp"] > deadline:
+                break
+            del self.pending_images[key]
     
     def _clear_conversation(self, conversation_key):
         """清除指定会话的所有数据"""
-        if conversation_key in self.conversations:
-            del self.conversations[conversation_key]
-        if conversation_key in self.last_conversation_time:
-            del self.last_conversation_time[conversation_key]
-        if conversation_key in self.last_images:
-            del self.last_images[conversation_key]
-        if conversation_key in self.conversation_session_types:
-            del self.conversation_session_types[conversation_key]
+        session = self.sessions.get(conversation_key)
+        if session is not None:
+            session.clear_conversation()
+            session.last_image = None
+            self._sync_image_refs(conversation_key)
+            self.sessions.schedule(session)
         
         logger.info(f"已清空会话 {conversation_key} 的数据")
     
     def _add_message_to_conversation(self, conversation_key, role, parts):
         """添加消息到会话历史，并进行长度控制"""
-        if conversation_key not in self.conversations:
-            self.conversations[conversation_key] = {"messages": [], "conversation_id": ""}
+        session = self.sessions.get_or_create(conversation_key)
+        if session.messages is None:
+            session.messages = []
         
         # 添加新消息
-        self.conversations[conversation_key]["messages"].append({
+        session.messages.append({
             "role": role,
             "parts": parts
         })
         
         # 更新最后交互时间
-        self.last_conversation_time[conversation_key] = time.time()
+        session.last_active = time.time()
         
         # 控制会话长度，保留最近的消息
-        if len(self.conversations[conversation_key]["messages"]) > self.max_conversation_messages:
+        if len(session.messages) > self.max_conversation_messages:
             # 移除最旧的消息，保留最新的max_conversation_messages条
-            excess = len(self.conversations[conversation_key]["messages"]) - self.max_conversation_messages
-            self.conversations[conversation_key]["messages"] = self.conversations[conversation_key]["messages"][excess:]
+            excess = len(session.messages) - self.max_conversation_messages
+            session.messages = session.messages[excess:]
             logger.info(f"会话 {conversation_key} 长度超过限制，已裁剪为最新的 {self.max_conversation_messages} 条消息")
         
-        return self.conversations[conversation_key]["messages"]
+        self._sync_image_refs(conversation_key)
+        self.sessions.schedule(session)
+        return session.messages
     
     def _create_or_reset_conversation(self, conversation_key: str, session_type: str, preserve_id: bool = False) -> None:
         """创建新会话或重置现有会话
@@ -395,51 +2889,65 @@ class GeminiImageXXX(PluginBase):
             session_type: 会话类型（使用会话类型常量）
             preserve_id: 是否保留现有会话ID
         """
+        session = self.sessions.get_or_create(conversation_key)
+        
         # 检查是否需要保留会话ID
-        conversation_id = ""
-        if preserve_id and conversation_key in self.conversations:
-            conversation_id = self.conversations[conversation_key].get("conversation_id", "")
+        conversation_id = session.conversation_id if preserve_id else ""
             
         # 创建新的空会话
-        self.conversations[conversation_key] = {
-            "messages": [],
-            "conversation_id": conversation_id
-        }
+        session.messages = []
+        session.conversation_id = conversation_id
         
         # 更新会话类型和时间戳
-        self.conversation_session_types[conversation_key] = session_type
-        self.last_conversation_time[conversation_key] = time.time()
+        session.session_type = session_type
+        session.last_active = time.time()
+        self._sync_image_refs(conversation_key)
+        self.sessions.schedule(session)
         
         logger.info(f"已创建/重置会话 {conversation_key}，类型: {session_type}")
     
-    def _save_temp_image(self, image_data: bytes, prefix: str = "gem_img") -> Optional[str]:
-        """保存临时图片文件
+    def _store_image(self, image_data: bytes) -> Optional[str]:
+        """保存图片到图片存储，相同内容只写入一次
         
         Args:
             image_data: 图片二进制数据
-            prefix: 文件名前缀
             
         Returns:
             str: 保存的图片路径，失败则返回None
         """
         try:
-            # 确保临时目录存在
-            os.makedirs(self.temp_dir, exist_ok=True)
-            
-            timestamp = int(time.time())
-            random_str = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-            filename = f"{prefix}_{timestamp}_{random_str}.png"
-            filepath = os.path.join(self.temp_dir, filename)
-            
-            with open(filepath, "wb") as f:
-                f.write(image_data)
-                
-            logger.info(f"已保存临时图片: {filepath}")
-            return filepath
+            return self.image_store.put(image_data)
         except Exception as e:
-            logger.error(f"保存临时图片失败: {e}")
+            logger.error(f"保存图片失败: {e}")
             return None
     
+    def _get_last_image_path(self, conversation_key: str) -> Optional[str]:
+        """获取会话最后一张图片的存储路径"""
+        session = self.sessions.get(conversation_key)
+        return session.last_image if session is not None else None
+    
+    def _set_last_image(self, conversation_key: str, image_path: Optional[str]):
+        """记录会话最后的图片，并让该会话持有图片引用"""
+        if not image_path:
+            return
+        session = self.sessions.get_or_create(conversation_key)
+        session.last_image = image_path
+        session.last_image_time = time.time()
+        self._sync_image_refs(conversation_key)
+        self.sessions.schedule(session)
+    
+    def _sync_image_refs(self, conversation_key: str):
+        """根据会话历史和最后图片更新该会话持有的图片引用"""
+        paths = []
+        for msg in self._get_history(conversation_key):
+            for part in msg.get("parts", []):
+                if "image_url" in part:
+                    paths.append(part["image_url"])
+        last_image = self._get_last_image_path(conversation_key)
+        if last_image:
+            paths.append(last_image)
+        self.image_store.set_refs(conversation_key, paths)
+    
     @on_text_message(priority=60)
     async def handle_text_commands(self, bot: WechatAPIClient, message: dict):
         """处理文本消息命令"""
@@ -459,17 +2967,11 @@ class GeminiImageXXX(PluginBase):
                 # 记录更详细的日志
                 logger.info(f"收到反推图片命令: {cmd}，用户ID: {user_id}")
                 
-                # 重置之前可能存在的等待状态
-                if user_id in self.waiting_for_reverse_image:
-                    logger.info(f"重置已存在的反推图片等待状态: {user_id}")
-                
-                # 使用时间戳作为值，而不仅仅是True，这样更容易调试
-                current_time = time.time()
-                self.waiting_for_reverse_image[user_id] = current_time
-                self.waiting_for_reverse_image_time[user_id] = current_time
+                # 设置等待状态，会重置之前可能存在的等待状态
+                self._set_waiting(user_id, self.WAIT_REVERSE)
                 
                 # 立即记录设置的等待状态
-                logger.info(f"已设置反推图片等待状态: user_id={user_id}, timestamp={current_time}")
+                logger.info(f"已设置反推图片等待状态: user_id={user_id}")
                 
                 # 发送更明确的提示消息
                 await bot.send_text_message(
@@ -477,9 +2979,6 @@ class GeminiImageXXX(PluginBase):
                     "请在3分钟内发送需要反推提示词的图片"
                 )
                 
-                # 检查并记录当前的等待状态
-                logger.info(f"当前等待反推图片的用户列表: {list(self.waiting_for_reverse_image.keys())}")
-                
                 return False  # 阻止其他插件处理
         
         # 2. 识图命令
@@ -488,8 +2987,7 @@ class GeminiImageXXX(PluginBase):
                 question = content[len(cmd):].strip()
                 
                 # 设置等待图片状态，并保存问题
-                self.waiting_for_analysis_image[user_id] = question if question else "分析这张图片的内容，包括主要对象、场景、风格、颜色等关键特征，用简洁清晰的中文进行描述。"
-                self.waiting_for_analysis_image_time[user_id] = time.time()
+                self._set_waiting(user_id, self.WAIT_ANALYSIS, question if question else "分析这张图片的内容，包括主要对象、场景、风格、颜色等关键特征，用简洁清晰的中文进行描述。")
                 
                 await bot.send_text_message(message["FromWxid"], "请在3分钟内发送需要分析的图片")
                 return False  # 阻止其他插件处理
@@ -498,19 +2996,19 @@ class GeminiImageXXX(PluginBase):
         for cmd in ["g追问"]:
             if content.startswith(cmd):
                 question = content[len(cmd):].strip()
-                await self._process_follow_up(bot, message, user_id, question)
+                await self._submit_job(bot, message, lambda: self._process_follow_up(bot, message, user_id, question), "追问")
                 return False  # 阻止其他插件处理
                 
         # 4. 翻译控制命令
         for cmd in ["g开启翻译", "g启用翻译"]:
             if content == cmd:
-                self.user_translate_settings[user_id] = True
+                self._set_translate_setting(user_id, True)
                 await bot.send_text_message(message["FromWxid"], "已开启前置翻译功能，接下来的图像生成和编辑将自动将中文提示词翻译成英文")
                 return False  # 阻止其他插件处理
                 
         for cmd in ["g关闭翻译", "g禁用翻译"]:
             if content == cmd:
-                self.user_translate_settings[user_id] = False
+                self._set_translate_setting(user_id, False)
                 await bot.send_text_message(message["FromWxid"], "已关闭前置翻译功能，接下来的图像生成和编辑将直接使用原始中文提示词")
                 return False  # 阻止其他插件处理
                 
@@ -530,7 +3028,8 @@ class GeminiImageXXX(PluginBase):
                     return False  # 阻止其他插件处理
                 
                 # 处理生成图片请求
-                await self._process_generate_image(bot, message, user_id, conversation_key, prompt)
+                use_cache = self.generation_cache_enable and cmd in self.generation_cache_commands
+                await self._submit_job(bot, message, lambda: self._process_generate_image(bot, message, user_id, conversation_key, prompt, use_cache), "生成图片")
                 return False  # 阻止其他插件处理
                 
         # 7. 编辑图片命令
@@ -542,7 +3041,7 @@ class GeminiImageXXX(PluginBase):
                     return False  # 阻止其他插件处理
                 
                 # 处理编辑图片请求
-                await self._process_edit_image(bot, message, user_id, conversation_key, prompt)
+                await self._submit_job(bot, message, lambda: self._process_edit_image(bot, message, user_id, conversation_key, prompt), "编辑图片")
                 return False  # 阻止其他插件处理
                 
         # 8. 参考图编辑命令
@@ -554,8 +3053,7 @@ class GeminiImageXXX(PluginBase):
                     return False  # 阻止其他插件处理
                 
                 # 设置等待参考图片状态
-                self.waiting_for_reference_image[user_id] = prompt
-                self.waiting_for_reference_image_time[user_id] = time.time()
+                self._set_waiting(user_id, self.WAIT_REFERENCE, prompt)
                 
                 # 提示用户上传图片
                 await bot.send_text_message(message["FromWxid"], "请发送需要编辑的参考图片")
@@ -565,17 +3063,25 @@ class GeminiImageXXX(PluginBase):
         for cmd in ["g融图"]:
             if content.startswith(cmd):
                 prompt = content[len(cmd):].strip()
+                
+                # 描述前可以指定图片数量，如 "g融图 3 描述"，默认两张
+                count = 2
+                match = re.match(r"(\d+)\s+(.*)", prompt, re.S)
+                if match:
+                    count = int(match.group(1))
+                    prompt = match.group(2).strip()
+                    if not 2 <= count <= self.merge_max_images:
+                        await bot.send_text_message(message["FromWxid"], f"融图图片数量需要在 2 到 {self.merge_max_images} 之间")
+                        return False  # 阻止其他插件处理
                 if not prompt:
-                    await bot.send_text_message(message["FromWxid"], f"请提供融图描述，格式：{cmd} [描述]")
+                    await bot.send_text_message(message["FromWxid"], f"请提供融图描述，格式：{cmd} [图片数量] [描述]")
                     return False  # 阻止其他插件处理
                 
-                # 设置等待融图图片状态
-                self.waiting_for_merge_image[user_id] = prompt
-                self.waiting_for_merge_image_time[user_id] = time.time()
-                self.waiting_for_merge_image_first[user_id] = True
+                # 设置等待融图图片状态，保存提示词和图片数量
+                self._set_waiting(user_id, self.WAIT_MERGE, [prompt, count])
                 
                 # 提示用户上传图片
-                await bot.send_text_message(message["FromWxid"], "请发送融图的第一张图片")
+                await bot.send_text_message(message["FromWxid"], f"请发送融图的第一张图片（共 {count} 张）")
                 return False  # 阻止其他插件处理
                 
         # 如果没有匹配到任何命令，允许其他插件处理
@@ -584,15 +3090,17 @@ class GeminiImageXXX(PluginBase):
     async def _process_follow_up(self, bot: WechatAPIClient, message: dict, user_id: str, question: str):
         """处理追问请求"""
         # 检查是否有最近的识图记录
-        if user_id not in self.last_analysis_image or user_id not in self.last_analysis_time:
+        session = self.sessions.get(user_id)
+        if f"analysis:{user_id}" not in self.image_cache or session is None or session.analysis_time is None:
             await bot.send_text_message(message["FromWxid"], "没有找到最近的识图记录，请先使用识图功能")
             return
         
         # 检查是否超时
-        if time.time() - self.last_analysis_time[user_id] > self.follow_up_timeout:
+        if time.time() - session.analysis_time > self.follow_up_timeout:
             # 清理状态
-            del self.last_analysis_image[user_id]
-            del self.last_analysis_time[user_id]
+            self.image_cache.remove(f"analysis:{user_id}")
+            session.analysis_time = None
+            self.sessions.schedule(session)
             
             await bot.send_text_message(message["FromWxid"], "追问超时，请重新使用识图功能")
             return
@@ -605,10 +3113,11 @@ class GeminiImageXXX(PluginBase):
             await bot.send_text_message(message["FromWxid"], "正在分析图片，请稍候...")
             
             # 调用API分析图片
-            analysis_result = await self._analyze_image(self.last_analysis_image[user_id], question)
+            analysis_result = await self._analyze_image(self.image_cache.get(f"analysis:{user_id}"), question)
             if analysis_result:
                 # 更新时间戳
-                self.last_analysis_time[user_id] = time.time()
+                session.analysis_time = time.time()
+                self.sessions.schedule(session)
                 
                 # 添加追问提示
                 analysis_result += "\n💬3min内输入g追问+问题，可继续追问"
@@ -620,91 +3129,122 @@ class GeminiImageXXX(PluginBase):
             logger.exception(e)
             await bot.send_text_message(message["FromWxid"], f"图片分析失败: {str(e)}")
             
-    async def _process_generate_image(self, bot: WechatAPIClient, message: dict, user_id: str, conversation_key: str, prompt: str):
-        """处理生成图片请求"""
+    async def _process_generate_image(self, bot: WechatAPIClient, message: dict, user_id: str, conversation_key: str, prompt: str,
+                                      use_cache: bool = False):
+        """处理生成图片请求，use_cache为True时使用生成结果缓存"""
         # 检查API密钥是否配置
         if not self.api_key:
             await bot.send_text_message(message["FromWxid"], "请先在配置文件中设置Gemini API密钥")
             return
         
         # 检查当前会话类型，如果不是生成图片模式或不存在，则创建/重置会话
-        current_session_type = self.conversation_session_types.get(conversation_key)
+        current_session_type = self._get_session_type(conversation_key)
         if current_session_type != self.SESSION_TYPE_GENERATE:
             logger.info(f"检测到会话类型变更: {current_session_type} -> {self.SESSION_TYPE_GENERATE}，自动重置会话")
             self._create_or_reset_conversation(conversation_key, self.SESSION_TYPE_GENERATE, False)
         
         # 获取会话历史
-        conversation_history = self.conversations.get(conversation_key, {}).get("messages", [])
-        
-        # 翻译提示词
-        try:
-            if self._should_translate_for_user(user_id):
-                translated_prompt = await self._translate_prompt(prompt)
-                if translated_prompt and translated_prompt != prompt:
-                    logger.info(f"翻译成功: {prompt} -> {translated_prompt}")
-                    prompt = translated_prompt
-                else:
-                    logger.warning("翻译失败或未发生变化，使用原始提示词")
-            else:
-                logger.info("用户未启用翻译，使用原始提示词")
-        except Exception as e:
-            logger.error(f"翻译提示词失败: {e}")
-            logger.error(traceback.format_exc())
-            await bot.send_text_message(message["FromWxid"], "翻译配置不完整，使用原始提示词")
+        conversation_history = self._get_history(conversation_key)
         
         # 移除这行提示消息，避免与_send_alternating_content中的重复
         # await bot.send_text_message(message["FromWxid"], "正在生成图片，请稍候...")
             
         # 生成图片
         try:
-            image_text_pairs, final_text, error_message = await self._generate_image(prompt, conversation_history)
+            # 翻译提示词和读取、压缩历史图片同时进行，都完成后再发送请求
+            prompt, prepared_history = await asyncio.gather(
+                self._translate_for_user(bot, message, user_id, prompt),
+                self._prepare_history(conversation_history, self.GENERATE_HISTORY_MAX_SIZE, self.GENERATE_HISTORY_QUALITY)
+            )
             
-            if error_message:
-                await bot.send_text_message(message["FromWxid"], error_message)
-                return
+            if self.stream_generate:
+                # 流式模式：每收到一张完整图片就立即发送。发送在单独的任务中进行，
+                # 微信上传较慢时不会占用Gemini响应的读取时间和并发名额
+                sent_contents = set()
+                send_queue = asyncio.Queue()
                 
-            if not image_text_pairs and not final_text:
-                await bot.send_text_message(message["FromWxid"], "生成图片失败，请稍后再试")
-                return
+                async def send_images():
+                    while True:
+                        item = await send_queue.get()
+                        if item is None:
+                            return
+                        try:
+                            await self._send_image_pair(bot, message["FromWxid"], *item, sent_contents)
+                        except Exception as e:
+                            logger.error(f"发送流式生成的图片失败: {e}")
+                
+                async def deliver(image_data: bytes, text: str, index: int):
+                    send_queue.put_nowait((image_data, text, index))
+                
+                sender = asyncio.create_task(send_images())
+                try:
+                    image_text_pairs, final_text, error_message = await self._generate_image(
+                        prompt, conversation_history, on_image=deliver, prepared_history=prepared_history, use_cache=use_cache)
+                except BaseException:
+                    sender.cancel()
+                    raise
+                # 等待已收到的图片全部发送完成
+                send_queue.put_nowait(None)
+                await sender
+                
+                if error_message and not image_text_pairs:
+                    await bot.send_text_message(message["FromWxid"], error_message)
+                    return
+                
+                if not image_text_pairs and not final_text:
+                    await bot.send_text_message(message["FromWxid"], "生成图片失败，请稍后再试")
+                    return
+                
+                if final_text and final_text not in sent_contents:
+                    await bot.send_text_message(message["FromWxid"], final_text)
                 
-            # 使用交替发送功能处理文本和图片
-            await self._send_alternating_content(bot, message, image_text_pairs, final_text)
+                # 保存最后一张图片用于后续编辑，非流式模式由_send_alternating_content保存
+                if image_text_pairs:
+                    self._set_last_image(conversation_key, self._store_image(image_text_pairs[-1][0]))
+            else:
+                image_text_pairs, final_text, error_message = await self._generate_image(
+                    prompt, conversation_history, prepared_history=prepared_history, use_cache=use_cache)
+                
+                if error_message:
+                    await bot.send_text_message(message["FromWxid"], error_message)
+                    return
+                    
+                if not image_text_pairs and not final_text:
+                    await bot.send_text_message(message["FromWxid"], "生成图片失败，请稍后再试")
+                    return
+                    
+                # 使用交替发送功能处理文本和图片
+                await self._send_alternating_content(bot, message, image_text_pairs, final_text)
             
             # 更新会话历史
-            if conversation_key not in self.conversations:
-                self.conversations[conversation_key] = {"messages": [], "conversation_id": ""}
-                self.conversation_session_types[conversation_key] = self.SESSION_TYPE_GENERATE
+            if self._get_session_type(conversation_key) is None:
+                self._create_or_reset_conversation(conversation_key, self.SESSION_TYPE_GENERATE, False)
             
             # 添加新消息到会话历史    
             self._add_message_to_conversation(conversation_key, "user", [{"text": prompt}])
             self._add_message_to_conversation(conversation_key, "assistant", [{"text": "已生成图片"}])
-            
-            # 保存最后一张图片的路径(如果有多张图片)
-            if image_text_pairs:
-                try:
-                    # 创建临时目录
-                    temp_dir = os.path.join(os.path.dirname(__file__), "temp")
-                    os.makedirs(temp_dir, exist_ok=True)
-                    
-                    # 保存最后一张图片用于后续编辑
-                    last_image_data = image_text_pairs[-1][0]
-                    timestamp = int(time.time())
-                    random_str = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-                    safe_filename = f"gemini_last_{timestamp}_{random_str}.png"
-                    image_path = os.path.join(temp_dir, safe_filename)
-                    
-                    with open(image_path, "wb") as f:
-                        f.write(last_image_data)
-                    
-                    # 保存最后生成的图片路径
-                    self.last_images[conversation_key] = image_path
-                except Exception as e:
-                    logger.error(f"保存最后一张图片失败: {e}")
         except Exception as e:
             logger.error(f"生成图片过程中出错: {e}")
             logger.error(traceback.format_exc())
             await bot.send_text_message(message["FromWxid"], f"生成图片时出错: {str(e)}")
 
+    async def _translate_for_user(self, bot: WechatAPIClient, message: dict, user_id: str, prompt: str) -> str:
+        """按用户的翻译设置翻译提示词，翻译失败时返回原始提示词"""
+        try:
+            if self._should_translate_for_user(user_id):
+                translated_prompt = await self._translate_prompt(prompt)
+                if translated_prompt and translated_prompt != prompt:
+                    logger.info(f"翻译成功: {prompt} -> {translated_prompt}")
+                    return translated_prompt
+                logger.warning("翻译失败或未发生变化，使用原始提示词")
+            else:
+                logger.info("用户未启用翻译，使用原始提示词")
+        except Exception as e:
+            logger.error(f"翻译提示词失败: {e}")
+            logger.error(traceback.format_exc())
+            await bot.send_text_message(message["FromWxid"], "翻译配置不完整，使用原始提示词")
+        return prompt
+
     async def _process_edit_image(self, bot: WechatAPIClient, message: dict, user_id: str, conversation_key: str, prompt: str):
         """处理编辑图片请求"""
         # 检查API密钥是否配置
@@ -713,21 +3253,19 @@ class GeminiImageXXX(PluginBase):
             return
         
         # 尝试获取最近图片
-        image_data = self._get_recent_image(conversation_key)
+        image_data = await self._get_recent_image(conversation_key)
         if not image_data:
             # 检查是否有最后生成的图片
-            if conversation_key in self.last_images:
-                last_image_path = self.last_images[conversation_key]
-                if os.path.exists(last_image_path):
-                    try:
-                        # 读取图片数据
-                        with open(last_image_path, "rb") as f:
-                            image_data = f.read()
-                    except Exception as e:
-                        logger.error(f"读取图片文件失败: {e}")
-                        await bot.send_text_message(message["FromWxid"], "读取图片文件失败，请重新生成图片后再编辑")
-                        return
-                else:
+            last_image_path = self._get_last_image_path(conversation_key)
+            if last_image_path:
+                try:
+                    # 读取图片数据
+                    image_data = self.image_store.read(last_image_path)
+                except Exception as e:
+                    logger.error(f"读取图片文件失败: {e}")
+                    await bot.send_text_message(message["FromWxid"], "读取图片文件失败，请重新生成图片后再编辑")
+                    return
+                if not image_data:
                     # 图片文件已丢失
                     await bot.send_text_message(message["FromWxid"], "找不到之前生成的图片，请重新生成图片后再编辑")
                     return
@@ -737,7 +3275,7 @@ class GeminiImageXXX(PluginBase):
                 return
         
         # 检查当前会话类型，如果不是编辑图片模式则创建/重置会话
-        current_session_type = self.conversation_session_types.get(conversation_key)
+        current_session_type = self._get_session_type(conversation_key)
         if current_session_type != self.SESSION_TYPE_EDIT:
             logger.info(f"检测到会话类型变更: {current_session_type} -> {self.SESSION_TYPE_EDIT}，保留会话ID并重置")
             self._create_or_reset_conversation(conversation_key, self.SESSION_TYPE_EDIT, True)
@@ -756,7 +3294,7 @@ class GeminiImageXXX(PluginBase):
         await bot.send_text_message(message["FromWxid"], "正在编辑图片，请稍候...")
         
         # 获取会话历史
-        conversation_history = self.conversations.get(conversation_key, {}).get("messages", [])
+        conversation_history = self._get_history(conversation_key)
         
         try:
             # 调用API编辑图片
@@ -766,17 +3304,14 @@ class GeminiImageXXX(PluginBase):
                 logger.info(f"图片编辑成功，结果大小: {len(result_image)} 字节")
                 
                 # 保存编辑后的图片
-                image_path = self._save_temp_image(result_image, "edited")
+                image_path = self._store_image(result_image)
                 if not image_path:
                     await bot.send_text_message(message["FromWxid"], "保存编辑后的图片失败")
                     return
                 
                 # 更新最后图片记录和图片缓存
-                self.last_images[conversation_key] = image_path
-                self.image_cache[conversation_key] = {
-                    "content": result_image,
-                    "timestamp": time.time()
-                }
+                self._set_last_image(conversation_key, image_path)
+                self.image_cache.put(conversation_key, result_image)
                 
                 # 添加用户提示到会话历史
                 self._add_message_to_conversation(
@@ -796,7 +3331,7 @@ class GeminiImageXXX(PluginBase):
                     model_parts)
                 
                 # 准备回复文本 - 仅在新会话时提供额外指导
-                if len(self.conversations[conversation_key]["messages"]) <= 2:  # 如果是新会话
+                if len(self._get_history(conversation_key)) <= 2:  # 如果是新会话
                     reply_text = f"图片编辑成功！（已开始图像对话，可以继续发送命令修改图片。需要结束时请发送\"{self.exit_commands[0]}\"）"
                     await bot.send_text_message(message["FromWxid"], reply_text)
                 
@@ -836,226 +3371,420 @@ class GeminiImageXXX(PluginBase):
             logger.exception(e)
             await bot.send_text_message(message["FromWxid"], f"编辑图片失败: {str(e)}")
 
-    async def _edit_image(self, prompt: str, image_data: bytes, conversation_history: List[Dict] = None) -> Tuple[Optional[bytes], Optional[str]]:
-        """调用Gemini API编辑图片，返回图片数据和文本响应"""
-        # 根据配置决定使用直接调用还是通过代理服务调用
-        if self.use_proxy_service and self.proxy_service_url:
-            # 使用代理服务调用API
-            url = f"{self.proxy_service_url.rstrip('/')}/v1beta/models/{self.model}:generateContent?key={self.api_key}"
-            headers = {
-                "Content-Type": "application/json"
+    async def _get_encoded_part(self, image_data: bytes, max_size: int = 800, quality: int = 85, format: str = 'JPEG') -> Dict[str, Any]:
+        """获取压缩并Base64编码后的inlineData请求部分，相同图片和参数只处理一次
+        
+        图片尺寸和大小已经符合要求时直接使用原始数据，不重新编码。
+        
+        Args:
+            image_data: 原始图片二进制数据
+            max_size: 图片的最大尺寸
+            quality: JPEG压缩质量 (1-100)
+            format: 输出格式
+            
+        Returns:
+            Dict[str, Any]: 新的inlineData部分，调用方可以修改
+        """
+        key = EncodedPartCache.make_key(image_data, max_size, quality, format)
+        entry = self.encoded_part_cache.get(key)
+        if entry is None:
+            # 后台预处理正在处理同一张图片时等待其结果
+            entry = await self.encode_flight.do(key, lambda: self._encode_part(key, image_data, max_size, quality, format))
+        mime_type, encoded = entry
+        return {
+            "inlineData": {
+                "mimeType": mime_type,
+                "data": encoded
             }
-            params = {}  # 不需要在URL参数中传递API密钥
+        }
+    
+    async def _encode_part(self, key: Tuple[str, int, int, str], image_data: bytes, max_size: int, quality: int,
+                           format: str) -> Tuple[str, str]:
+        """压缩并Base64编码图片，结果写入编码缓存
+        
+        先只解析文件头，格式可以直接发送、尺寸不超过max_size且文件不大于
+        PASSTHROUGH_BYTES_PER_PIXEL * max_size² 时跳过解码和重新编码。
+        
+        Returns:
+            Tuple[str, str]: (MIME类型, Base64字符串)
+        """
+        info = _probe_image(image_data)
+        if (info and info[0] in self.PASSTHROUGH_MIME_TYPES and max(info[1], info[2]) <= max_size
+                and len(image_data) <= self.PASSTHROUGH_BYTES_PER_PIXEL * max_size * max_size):
+            self.encode_passthrough += 1
+            mime_type, data = info[0], image_data
         else:
-            # 直接调用Google API
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:generateContent"
-            headers = {
-                "Content-Type": "application/json",
-            }
-            params = {
-                "key": self.api_key
-            }
+            data = await self._compress_image(image_data, max_size=max_size, quality=quality, format=format)
+            if data is image_data:
+                # 压缩失败时发送原始数据，使用其真实格式
+                mime_type = info[0] if info else f"image/{format.lower()}"
+            else:
+                mime_type = f"image/{format.lower()}"
+        entry = (mime_type, base64.b64encode(data).decode("utf-8"))
+        self.encoded_part_cache.put(key, *entry)
+        return entry
+    
+    async def _get_vision_part(self, image_data: bytes) -> Dict[str, Any]:
+        """获取识图/追问/反推请求的图片部分，图片缩小到vision_max_edge，相同图片只处理一次
         
-        # 将图片数据转换为Base64编码
-        image_base64 = base64.b64encode(image_data).decode("utf-8")
-        
-        # 构建请求数据
-        if conversation_history and len(conversation_history) > 0:
-            # 有会话历史，构建上下文
-            # 处理会话历史中的图片格式
-            processed_history = []
-            for msg in conversation_history:
-                # 转换角色名称，确保使用 "user" 或 "model"
-                role = msg["role"]
-                if role == "assistant":
-                    role = "model"
-                
-                processed_msg = {"role": role, "parts": []}
-                for part in msg["parts"]:
-                    if "text" in part:
-                        processed_msg["parts"].append({"text": part["text"]})
-                    elif "image_url" in part:
-                        # 需要读取图片并转换为inlineData格式
-                        try:
-                            with open(part["image_url"], "rb") as f:
-                                img_data = f.read()
-                                # 压缩图片
-                                img_data = await self._compress_image(img_data, max_size=800, quality=85)
-                                img_base64 = base64.b64encode(img_data).decode("utf-8")
-                                processed_msg["parts"].append({
-                                    "inlineData": {
-                                        "mimeType": "image/png",
-                                        "data": img_base64
-                                    }
-                                })
-                        except Exception as e:
-                            logger.error(f"处理历史图片失败: {e}")
-                            # 跳过这个图片
-                processed_history.append(processed_msg)
-
-            # 构建多模态请求
-            # 压缩当前图片
-            compressed_image_data = await self._compress_image(image_data, max_size=800, quality=85)
-            compressed_image_base64 = base64.b64encode(compressed_image_data).decode("utf-8")
-            
-            user_message = {
-                "role": "user",
-                "parts": [
-                    {"text": prompt},
-                    {
+        Args:
+            image_data: 原始图片二进制数据
+            
+        Returns:
+            Dict[str, Any]: inlineData请求部分
+        """
+        return await self._get_encoded_part(image_data, max_size=self.vision_max_edge, quality=self.vision_quality)
+    
+    async def _keep_vision_image(self, image_data: bytes) -> bytes:
+        """获取预处理后的识图图片，用于在追问期间保存
+        
+        预处理结果同时登记为其自身的编码结果，追问时直接使用，不会再次压缩。
+        
+        Args:
+            image_data: 原始图片二进制数据
+            
+        Returns:
+            bytes: 预处理后的图片数据
+        """
+        inline_data = (await self._get_vision_part(image_data))["inlineData"]
+        prepared = base64.b64decode(inline_data["data"])
+        key = EncodedPartCache.make_key(prepared, self.vision_max_edge, self.vision_quality, "JPEG")
+        self.encoded_part_cache.put(key, inline_data["mimeType"], inline_data["data"])
+        return prepared
+    
+    async def _prepare_history(self, conversation_history: Optional[List[Dict]], history_max_size: int = 800,
+                               history_quality: int = 85) -> Tuple[List[Dict], List[Tuple[Dict, Dict, Optional[bytes]]]]:
+        """将会话历史转换为请求格式，所有历史图片并发读取和压缩编码
+        
+        Args:
+            conversation_history: 会话历史
+            history_max_size: 历史图片的最大尺寸
+            history_quality: 历史图片的JPEG质量
+            
+        Returns:
+            Tuple: (历史消息列表, [(消息, 图片部分, 原始图片数据), ...])，图片按时间顺序
+        """
+        def read_file(path: str) -> bytes:
+            with open(path, "rb") as f:
+                return f.read()
+        
+        async def load_image(path: str) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+            try:
+                img_data = await asyncio.to_thread(read_file, path)
+                # 压缩图片数据以减小请求大小，之前轮次处理过的图片直接使用缓存
+                return img_data, await self._get_encoded_part(img_data, max_size=history_max_size, quality=history_quality)
+            except Exception as e:
+                logger.error(f"处理历史图片失败: {e}")
+                return None
+        
+        history = []
+        images = []  # [(消息, 图片部分, 图片路径), ...]，需要读取的图片先放入空的占位部分
+        for msg in conversation_history or []:
+            # 转换角色名称，确保使用 "user" 或 "model"
+            role = msg["role"]
+            if role == "assistant":
+                role = "model"
+            
+            processed_msg = {"role": role, "parts": []}
+            for part in msg["parts"]:
+                if "text" in part:
+                    processed_msg["parts"].append({"text": part["text"]})
+                elif "image_url" in part:
+                    # 需要读取图片并转换为inlineData格式
+                    image_part = {}
+                    processed_msg["parts"].append(image_part)
+                    images.append((processed_msg, image_part, part["image_url"]))
+                elif "inline_data" in part:
+                    # 直接使用inlineData格式
+                    image_part = {
                         "inlineData": {
-                            "mimeType": "image/jpeg", 
-                            "data": compressed_image_base64
+                            "mimeType": part["inline_data"]["mime_type"],
+                            "data": part["inline_data"]["data"]
                         }
                     }
-                ]
-            }
-
-            data = {
-                "contents": processed_history + [user_message],
-                "generationConfig": {
-                    "responseModalities": ["Text", "Image"]
-                }
-            }
-        else:
-            # 无会话历史，直接使用提示和图片
-            data = {
-                "contents": [
-                    {
-                        "parts": [
-                            {
-                                "text": prompt
-                            },
-                            {
-                                "inlineData": {
-                                    "mimeType": "image/png",
-                                    "data": image_base64
-                                }
-                            }
-                        ]
-                    }
-                ],
-                "generationConfig": {
-                    "responseModalities": ["Text", "Image"]
-                }
-            }
+                    processed_msg["parts"].append(image_part)
+                    images.append((processed_msg, image_part, None))
+            history.append(processed_msg)
         
-        # 创建代理配置
-        proxies = None
-        if self.enable_proxy and self.proxy_url and not self.use_proxy_service:
-            # 只有在直接调用Google API且启用了代理时才使用代理
-            proxies = {
-                "http": self.proxy_url,
-                "https": self.proxy_url
-            }
+        loaded = await asyncio.gather(*(load_image(path) for _, _, path in images if path is not None))
+        loaded_iter = iter(loaded)
+        history_images = []
+        for processed_msg, image_part, path in images:
+            if path is None:
+                history_images.append((processed_msg, image_part, None))
+                continue
+            result = next(loaded_iter)
+            if result is None:
+                # 跳过这个图片
+                processed_msg["parts"].remove(image_part)
+                continue
+            img_data, encoded_part = result
+            image_part.update(encoded_part)
+            history_images.append((processed_msg, image_part, img_data))
+        
+        history = [msg for msg in history if msg["parts"]]
+        return history, history_images
+    
+    def _history_cache_key(self, conversation_history: Optional[List[Dict]]) -> List[Any]:
+        """生成结果缓存键中的会话历史部分，文本原样保留，图片只使用内容摘要
+        
+        图片存储中的文件以内容的SHA-256命名，不需要读取或重新计算图片数据。
+        
+        Args:
+            conversation_history: 会话历史
+            
+        Returns:
+            List[Any]: [[角色, [[类型, 文本或摘要], ...]], ...]
+        """
+        result = []
+        for msg in conversation_history or []:
+            parts = []
+            for part in msg["parts"]:
+                if "text" in part:
+                    parts.append(["text", part["text"]])
+                elif "image_url" in part:
+                    parts.append(["image", self.image_store.digest_of(part["image_url"]) or part["image_url"]])
+                elif "inline_data" in part:
+                    parts.append(["image", hashlib.sha256(part["inline_data"]["data"].encode("utf-8")).hexdigest()])
+            result.append([msg["role"], parts])
+        return result
+    
+    async def _pack_request(self, conversation_history: Optional[List[Dict]], current_message: Dict,
+                            generation_config: Dict, history_max_size: int = 800, history_quality: int = 85,
+                            prepared_history: Optional[Tuple[List[Dict], List[Tuple[Dict, Dict, Optional[bytes]]]]] = None) -> str:
+        """构建请求体，超出MAX_REQUEST_SIZE时按预算逐步裁剪会话历史
+        
+        请求体大小根据各部分长度直接计算，不需要反复序列化。超出预算时依次：
+        以更低的分辨率和质量重新编码较早的历史图片、从最早的消息开始删除历史图片、
+        删除最早的历史消息。当前消息始终保留。
+        
+        Args:
+            conversation_history: 会话历史
+            current_message: 当前用户消息（包含role和parts）
+            generation_config: 生成参数
+            history_max_size: 历史图片的最大尺寸
+            history_quality: 历史图片的JPEG质量
+            prepared_history: 已由_prepare_history转换的会话历史，传入时忽略conversation_history
+            
+        Returns:
+            str: 序列化后的请求体
+        """
+        if prepared_history is None:
+            prepared_history = await self._prepare_history(conversation_history, history_max_size, history_quality)
+        history, history_images = prepared_history
+        
+        data = {
+            "contents": history + [current_message],
+            "generationConfig": generation_config
+        }
+        request_size = _estimate_json_size(data)
+        if request_size > self.MAX_REQUEST_SIZE and history:
+            logger.warning(f"请求体大小 ({request_size/1024/1024:.2f} MB) 超出限制，开始裁剪会话历史")
+            
+            # 1. 以更低的分辨率和质量重新编码较早的历史图片
+            for max_size, quality in self.HISTORY_IMAGE_LEVELS:
+                if max_size >= history_max_size:
+                    continue
+                for _, image_part, raw_data in history_images:
+                    if request_size <= self.MAX_REQUEST_SIZE:
+                        break
+                    inline_data = image_part["inlineData"]
+                    if raw_data is None:
+                        raw_data = base64.b64decode(inline_data["data"])
+                    encoded = (await self._get_encoded_part(raw_data, max_size=max_size, quality=quality))["inlineData"]
+                    if len(encoded["data"]) < len(inline_data["data"]):
+                        request_size += _estimate_json_size(encoded["mimeType"]) - _estimate_json_size(inline_data["mimeType"])
+                        request_size += len(encoded["data"]) - len(inline_data["data"])
+                        inline_data.update(encoded)
+                if request_size <= self.MAX_REQUEST_SIZE:
+                    logger.info(f"重新编码历史图片后请求体大小: {request_size/1024/1024:.2f} MB")
+                    break
+            
+            # 2. 从最早的消息开始删除历史图片
+            for msg, image_part, _ in history_images:
+                if request_size <= self.MAX_REQUEST_SIZE:
+                    break
+                request_size -= self._remove_request_part(data, msg, image_part)
+                logger.info("请求体仍超出限制，删除一张历史图片")
+            
+            # 3. 从最早的消息开始删除历史文本
+            contents = data["contents"]
+            while len(contents) > 1 and (request_size > self.MAX_REQUEST_SIZE or contents[0]["role"] == "model"):
+                # 历史需要以用户消息开头，删除后残留在开头的模型回复一并删除
+                request_size -= _estimate_json_size(contents[0]) + 2
+                del contents[0]
+                logger.info("请求体仍超出限制，删除一条历史消息")
         
+        # 记录处理后的请求数据（安全版本）
+        if logger.isEnabledFor(logging.DEBUG):
+            safe_contents = [
+                {**msg, "parts": [
+                    {"inlineData": {**part["inlineData"], "data": f"[BASE64_DATA_LENGTH: {len(part['inlineData']['data'])}]"}}
+                    if "inlineData" in part else part
+                    for part in msg["parts"]
+                ]}
+                for msg in data["contents"]
+            ]
+            logger.debug(f"请求数据结构: {safe_contents}")
+        
+        # 带有历史图片的请求体较大，在线程中序列化，不阻塞事件循环
+        request_data = await asyncio.to_thread(json.dumps, data) if history_images else json.dumps(data)
+        logger.info(f"Gemini API请求体大小: {len(request_data)} 字节 ({len(request_data)/1024/1024:.2f} MB)，历史消息 {len(data['contents']) - 1} 条")
+        if len(request_data) > self.MAX_REQUEST_SIZE:
+            logger.warning(f"请求体大小 ({len(request_data)/1024/1024:.2f} MB) 仍超出限制，当前消息无法再裁剪")
+        return request_data
+    
+    def _remove_request_part(self, data: Dict, msg: Dict, part: Dict) -> int:
+        """从请求中删除一个部分，部分为空的消息一并删除
+        
+        Returns:
+            int: 请求体减少的字节数
+        """
+        contents = data["contents"]
+        index = next((i for i, m in enumerate(contents) if m is msg), None)
+        if index is None:
+            return 0
+        if len(msg["parts"]) > 1:
+            removed = _estimate_json_size(part) + 2
+            msg["parts"] = [p for p in msg["parts"] if p is not part]
+            return removed
+        removed = _estimate_json_size(msg) + (2 if len(contents) > 1 else 0)
+        del contents[index]
+        return removed
+    
+    async def _edit_image(self, prompt: str, image_data: bytes, conversation_history: List[Dict] = None) -> Tuple[Optional[bytes], Optional[str]]:
+        """调用Gemini API编辑图片，返回图片数据和文本响应"""
         try:
-            # 添加重试逻辑
-            max_retries = 10
-            retry_count = 0
-            retry_delay = 1
+            if conversation_history:
+                # 有会话历史，压缩当前图片以给历史留出空间
+                image_part = await self._get_encoded_part(image_data, max_size=self.EDIT_IMAGE_MAX_SIZE, quality=self.EDIT_IMAGE_QUALITY)
+            else:
+                # 无会话历史时尽量使用原图，已经符合大小要求的图片直接发送，不重新编码；
+                # 请求中没有可以裁剪的历史，超出预算时逐级缩小
+                budget = self.MAX_REQUEST_SIZE * 9 // 10 - len(prompt.encode("utf-8"))
+                image_part = await self._get_part_within_budget(image_data, self.EDIT_SOURCE_LEVELS, budget)
             
-            async with aiohttp.ClientSession() as session:
-                while retry_count <= max_retries:
-                    try:
-                        # 计算请求体大小
-                        request_data = json.dumps(data)
-                        request_size = len(request_data)
-                        logger.info(f"Gemini API请求体大小: {request_size} 字节 ({request_size/1024/1024:.2f} MB)")
-                        
-                        # 检查请求体大小是否超过限制
-                        if request_size > self.MAX_REQUEST_SIZE:
-                            logger.warning(f"请求体大小 ({request_size/1024/1024:.2f} MB) 超出限制，尝试清理会话历史")
-                            
-                            # 如果请求体过大，简化为只有当前提示和图片
-                            data = {
-                                "contents": [
-                                    {
-                                        "parts": [
-                                            {
-                                                "text": prompt
-                                            },
-                                            {
-                                                "inlineData": {
-                                                    "mimeType": "image/png",
-                                                    "data": image_base64
-                                                }
-                                            }
-                                        ]
-                                    }
-                                ],
-                                "generationConfig": {
-                                    "responseModalities": ["Text", "Image"]
-                                }
-                            }
-                            
-                            # 重新计算请求体大小
-                            request_data = json.dumps(data)
-                            request_size = len(request_data)
-                            logger.info(f"重建后的请求体大小: {request_size} 字节 ({request_size/1024/1024:.2f} MB)")
-                        
-                        # 发送请求
-                        async with session.post(
-                            url, 
-                            headers=headers, 
-                            params=params, 
-                            json=data,
-                            proxy=proxies["https"] if proxies else None,
-                            timeout=60
-                        ) as response:
-                            logger.info(f"Gemini API响应状态码: {response.status}")
-                            
-                            if response.status == 200 or response.status != 503:
-                                response_text = await response.text()
-                                break
-                            
-                            # 如果是503错误且未达到最大重试次数，继续重试
-                            if response.status == 503 and retry_count < max_retries:
-                                logger.warning(f"Gemini API服务过载 (状态码: 503)，将进行重试 ({retry_count+1}/{max_retries})")
-                                retry_count += 1
-                                await asyncio.sleep(retry_delay)
-                                retry_delay = min(retry_delay * 1.5, 10)  # 增加延迟，但最多10秒
-                                continue
-                            else:
-                                response_text = await response.text()
-                                break
-                            
-                    except Exception as e:
-                        logger.error(f"请求异常: {str(e)}")
-                        if retry_count < max_retries:
-                            logger.warning(f"请求异常，将进行重试 ({retry_count+1}/{max_retries})")
-                            retry_count += 1
-                            await asyncio.sleep(retry_delay)
-                            retry_delay = min(retry_delay * 1.5, 10)
-                            continue
-                        else:
-                            raise
+            # 构建请求体，超出大小限制时按预算裁剪会话历史
+            request_data = await self._pack_request(
+                conversation_history,
+                {"role": "user", "parts": [{"text": prompt}, image_part]},
+                {"responseModalities": ["Text", "Image"]},
+                history_max_size=self.EDIT_IMAGE_MAX_SIZE,
+                history_quality=self.EDIT_IMAGE_QUALITY
+            )
+        except ImageTooLargeError as e:
+            return None, str(e)
+        except Exception as e:
+            logger.error(f"API调用异常: {str(e)}")
+            logger.exception(e)
+            return None, f"API调用异常: {str(e)}"
+        return await self._request_image_edit(request_data, "图片编辑")
+    
+    async def _get_part_within_budget(self, image_data: bytes, levels: List[Tuple[int, int]], budget: int) -> Dict[str, Any]:
+        """按levels逐级降低分辨率和质量，返回Base64数据不超过budget的inlineData部分
+        
+        Args:
+            image_data: 原始图片二进制数据
+            levels: 依次尝试的 (最大尺寸, JPEG质量)
+            budget: Base64数据的最大字节数
             
-            # 如果所有重试都失败
-            if not response or not response.status:
-                logger.error("图片编辑失败，所有重试尝试均失败")
-                return None, "API调用失败，所有重试尝试均失败"
-                
-            if response.status == 200:
-                # 先记录响应内容，便于调试
-                logger.debug(f"Gemini API原始响应内容长度: {len(response_text)}, 前100个字符: {response_text[:100] if response_text else '空'}")
-                
-                # 检查响应内容是否为空
-                if not response_text.strip():
-                    logger.error("Gemini API返回了空响应")
-                    return None, "API返回了空响应，请检查网络连接或代理服务配置"
-                
+        Returns:
+            Dict[str, Any]: inlineData请求部分
+            
+        Raises:
+            ImageTooLargeError: 最低一级仍超出预算
+        """
+        for max_size, quality in levels:
+            part = await self._get_encoded_part(image_data, max_size=max_size, quality=quality)
+            size = len(part["inlineData"]["data"])
+            if size <= budget:
+                return part
+            logger.info(f"图片编码后 {size // 1024}KB 超出预算 {budget // 1024}KB ({max_size}px, 质量{quality})，继续缩小")
+        raise ImageTooLargeError("图片压缩后仍超出请求大小限制，请缩小后重新发送")
+    
+    def _edit_part_params(self, has_history: bool) -> Tuple[int, int]:
+        """获取编辑图片请求中当前图片首先尝试的 (最大尺寸, JPEG质量)"""
+        if has_history:
+            return self.EDIT_IMAGE_MAX_SIZE, self.EDIT_IMAGE_QUALITY
+        return self.EDIT_SOURCE_MAX_SIZE, self.EDIT_SOURCE_QUALITY
+    
+    async def _merge_images(self, prompt: str, images: List[bytes]) -> Tuple[Optional[bytes], Optional[str]]:
+        """调用Gemini API融合多张图片，所有图片作为独立的inlineData部分在一次请求中发送
+        
+        每张图片并发压缩，按MERGE_IMAGE_LEVELS逐级降低分辨率和质量，直到不超过请求体预算中
+        平均分给每张图片的大小。
+        
+        Args:
+            prompt: 融图提示词
+            images: 需要融合的图片二进制数据，按发送顺序排列
+            
+        Returns:
+            Tuple[Optional[bytes], Optional[str]]: 融合后的图片数据和文本响应（失败时为错误信息）
+        """
+        # 预留一成给提示词和JSON结构，剩余部分平均分给每张图片
+        budget = (self.MAX_REQUEST_SIZE * 9 // 10 - len(prompt.encode("utf-8"))) // len(images)
+        
+        try:
+            image_parts = await asyncio.gather(*(
+                self._get_part_within_budget(image_data, self.MERGE_IMAGE_LEVELS, budget) for image_data in images
+            ))
+            sizes = ", ".join(f"{len(part['inlineData']['data']) // 1024}KB" for part in image_parts)
+            logger.info(f"融图图片压缩完成，共 {len(images)} 张，单张预算 {budget // 1024}KB，编码后大小: {sizes}")
+            
+            request_data = await self._pack_request(
+                None,
+                {"role": "user", "parts": [{"text": prompt}, *image_parts]},
+                {"responseModalities": ["Text", "Image"]}
+            )
+        except ImageTooLargeError as e:
+            return None, str(e)
+        except Exception as e:
+            logger.error(f"API调用异常: {str(e)}")
+            logger.exception(e)
+            return None, f"API调用异常: {str(e)}"
+        return await self._request_image_edit(request_data, "融图")
+    
+    async def _request_image_edit(self, request_data: str, label: str) -> Tuple[Optional[bytes], Optional[str]]:
+        """发送图片编辑类请求并解析响应
+        
+        Args:
+            request_data: 序列化后的请求体
+            label: 日志中使用的请求名称
+            
+        Returns:
+            Tuple[Optional[bytes], Optional[str]]: 图片数据和文本响应（失败时为错误信息）
+        """
+        try:
+            async def read_response(response: aiohttp.ClientResponse) -> Tuple[int, Optional[dict], str]:
+                if response.status != 200:
+                    return response.status, None, await response.text()
                 try:
-                    result = json.loads(response_text)
-                    # 记录解析后的JSON结构
-                    logger.debug(f"Gemini API响应JSON结构: 已获取")
+                    return response.status, await self._read_json_response(response), ""
                 except json.JSONDecodeError as json_err:
-                    logger.error(f"JSON解析错误: {str(json_err)}, 响应内容: {response_text[:200]}")
+                    # 解析失败时doc中是去掉图片数据后的正文
+                    if json_err.doc.strip():
+                        logger.error(f"JSON解析错误: {str(json_err)}, 响应内容: {json_err.doc[:200]}")
+                    return response.status, None, json_err.doc
+            
+            # 发送请求，重试由统一的重试策略处理
+            try:
+                status, result, response_text = await self._call_gemini(request_data, read_response, label=label)
+            except RetryableStatusError as e:
+                logger.error(f"{label}失败，重试结束后状态码仍为 {e.status}")
+                status, result, response_text = e.status, None, e.body
+                
+            if status == 200:
+                if result is None:
+                    # 检查响应内容是否为空
+                    if not response_text.strip():
+                        logger.error("Gemini API返回了空响应")
+                        return None, "API返回了空响应，请检查网络连接或代理服务配置"
+                    
                     # 检查是否是代理服务问题
                     if self.use_proxy_service:
                         logger.error("可能是代理服务配置问题，尝试禁用代理服务或检查代理服务实现")
                         return None, "API响应格式错误，可能是代理服务配置问题。请检查代理服务实现或暂时禁用代理服务。"
-                    return None, f"API响应格式错误: {str(json_err)}"
+                    return None, "API响应格式错误，响应不是有效的JSON"
                 
                 # 检查是否有内容安全问题
                 candidates = result.get("candidates", [])
@@ -1081,8 +3810,8 @@ class GeminiImageXXX(PluginBase):
                         if "inlineData" in part:
                             inlineData = part.get("inlineData", {})
                             if inlineData and "data" in inlineData:
-                                # 返回Base64解码后的图片数据
-                                image_data = base64.b64decode(inlineData["data"])
+                                # 返回解码后的图片数据
+                                image_data = _inline_data_bytes(inlineData["data"])
                     
                     if not image_data:
                         logger.error(f"API响应中没有找到图片数据")
@@ -1092,17 +3821,17 @@ class GeminiImageXXX(PluginBase):
                 logger.error(f"未找到编辑后的图片数据")
                 return None, None
             else:
-                logger.error(f"Gemini API调用失败 (状态码: {response.status}): {response_text}")
-                error_message = f"API调用失败，状态码: {response.status}"
+                logger.error(f"Gemini API调用失败 (状态码: {status}): {response_text}")
+                error_message = f"API调用失败，状态码: {status}"
                 
                 # 特殊处理一些常见错误
-                if response.status == 400:
+                if status == 400:
                     error_message = "请求格式错误，请检查API版本或参数"
-                elif response.status == 401:
+                elif status == 401:
                     error_message = "API密钥无效或未授权"
-                elif response.status == 403:
+                elif status == 403:
                     error_message = "没有访问权限，请检查API密钥或账户状态"
-                elif response.status == 429:
+                elif status == 429:
                     error_message = "请求过于频繁，请稍后再试"
                 
                 return None, error_message
@@ -1142,52 +3871,121 @@ class GeminiImageXXX(PluginBase):
         # 默认情况，原样返回
         return text
 
-    def _get_recent_image(self, conversation_key: str) -> Optional[bytes]:
-        """获取最近的图片数据"""
+    async def _get_recent_image(self, conversation_key: str) -> Optional[bytes]:
+        """获取最近的图片数据，必要时下载之前延迟处理的图片"""
         logger.info(f"尝试获取会话 {conversation_key} 的最近图片")
+        current_time = time.time()
+        
+        # 检查缓存和待下载图片，取最新的一个
+        cache_data = self.image_cache.lookup(conversation_key)
+        if cache_data and current_time - cache_data[1] > self.image_cache_timeout:
+            cache_data = None
+        pending = self.pending_images.get(conversation_key)
+        if pending and current_time - pending["timestamp"] > self.image_cache_timeout:
+            del self.pending_images[conversation_key]
+            pending = None
+        
+        # 用户在最近一次结果之后上传了新图片，此时才真正读取图片数据，
+        # 后台预处理正在下载同一张图片时等待其结果
+        if pending and (not cache_data or pending["timestamp"] >= cache_data[1]):
+            image_data = await self.download_flight.do(
+                (conversation_key, pending["timestamp"]),
+                lambda: self._download_pending_image(conversation_key, pending)
+            )
+            if image_data:
+                return image_data
+            logger.warning(f"下载会话 {conversation_key} 延迟处理的图片失败")
         
         # 尝试直接从缓存获取
-        if conversation_key in self.image_cache:
-            cache_data = self.image_cache[conversation_key]
-            if time.time() - cache_data["timestamp"] <= self.image_cache_timeout:
-                logger.info(f"成功从缓存直接获取图片数据，大小: {len(cache_data['content'])} 字节")
-                return cache_data["content"]
+        if cache_data:
+            logger.info(f"成功从缓存直接获取图片数据，大小: {len(cache_data[0])} 字节")
+            return cache_data[0]
         
         # 如果缓存中没有或已过期，尝试从文件中读取
-        if conversation_key in self.last_images:
-            last_image_path = self.last_images[conversation_key]
-            if os.path.exists(last_image_path):
-                try:
-                    with open(last_image_path, "rb") as f:
-                        image_data = f.read()
-                        # 加入缓存
-                        self.image_cache[conversation_key] = {
-                            "content": image_data,
-                            "timestamp": time.time()
-                        }
-                        logger.info(f"从最后图片路径读取并加入缓存: {last_image_path}")
-                        return image_data
-                except Exception as e:
-                    logger.error(f"从文件读取图片失败: {e}")
+        last_image_path = self._get_last_image_path(conversation_key)
+        if last_image_path:
+            try:
+                image_data = self.image_store.read(last_image_path)
+                if image_data:
+                    # 加入缓存
+                    self.image_cache.put(conversation_key, image_data)
+                    logger.info(f"从最后图片路径读取并加入缓存: {last_image_path}")
+                    return image_data
+            except Exception as e:
+                logger.error(f"从文件读取图片失败: {e}")
         
         logger.warning(f"未找到会话 {conversation_key} 的最近图片")
         return None 
 
-    @on_image_message(priority=60)
-    async def handle_image_message(self, bot: WechatAPIClient, message: dict):
-        """处理图片消息"""
-        if not self.enable:
-            return True  # 插件禁用，传递给其他插件
-            
-        # 获取用户ID
-        user_id = self._get_user_id(message)
-        conversation_key = self._get_conversation_key(message)
+    async def _download_pending_image(self, conversation_key: str, pending: Dict[str, Any]) -> Optional[bytes]:
+        """下载延迟处理的图片并加入缓存"""
+        image_data = await self._read_message_image(pending["bot"], pending["message"])
+        if self.pending_images.get(conversation_key) is pending:
+            del self.pending_images[conversation_key]
+        if image_data:
+            self.image_cache.put(conversation_key, image_data, pending["timestamp"])
+            logger.info(f"已下载会话 {conversation_key} 延迟处理的图片，大小: {len(image_data)} 字节")
+        return image_data
+    
+    def _schedule_precompute(self, message: dict, conversation_key: str):
+        """在后台预先下载并压缩编码新收到的图片，后续命令可以直接使用编码缓存
         
-        # 清理过期会话和图片缓存
-        self._cleanup_expired_conversations()
-        self._cleanup_image_cache()
+        群聊中的图片只有发送者正在进行会话时才处理，避免下载群里的每一张图片。
+        """
+        if not self.precompute_images:
+            return
+        if message.get("FromWxid", "").endswith("@chatroom"):
+            session = self.sessions.get(conversation_key)
+            if (session is None or not session.has_conversation()
+                    or time.time() - session.last_active > self.conversation_expire_seconds):
+                return
+        task = asyncio.create_task(self._precompute_image(conversation_key))
+        self.precompute_tasks.add(task)
+        task.add_done_callback(self.precompute_tasks.discard)
+    
+    async def _precompute_image(self, conversation_key: str):
+        """下载会话的最新图片，生成编辑图片使用的编码结果
+        
+        识图和反推只使用命令之后上传的图片，不在这里预处理。
+        """
+        async with self.precompute_slots:
+            # 优先级低于前台任务，任务队列中有排队的请求时不占用图片处理池
+            queue = self.job_scheduler.queue
+            if queue is not None and queue.qsize() > 0:
+                self.precompute_skipped += 1
+                return
+            try:
+                image_data = await self._get_recent_image(conversation_key)
+                if not image_data:
+                    return
+                # 编辑会话中的下一次编辑会带上会话历史，其他情况会重置会话
+                session = self.sessions.get(conversation_key)
+                has_history = (session is not None and session.session_type == self.SESSION_TYPE_EDIT
+                               and bool(session.messages))
+                max_size, quality = self._edit_part_params(has_history)
+                await self._get_encoded_part(image_data, max_size=max_size, quality=quality)
+                self.precompute_done += 1
+                logger.debug(f"已完成会话 {conversation_key} 图片的后台预处理")
+            except Exception as e:
+                logger.error(f"后台预处理图片失败: {str(e)}")
+    
+    def _has_pending_image_request(self, user_id: str) -> bool:
+        """检查用户是否有等待图片的请求（反推/参考图/识图/融图）"""
+        session = self.sessions.get(user_id)
+        return session is not None and session.waiting is not None
+
+    async def _read_message_image(self, bot: WechatAPIClient, message: dict) -> Optional[bytes]:
+        """读取图片消息中的图片数据
         
-        # 尝试读取图片数据
+        依次尝试本地路径、消息内容中的Base64数据以及Pad API下载。
+        
+        Args:
+            bot: 微信API客户端
+            message: 图片消息
+            
+        Returns:
+            Optional[bytes]: 图片二进制数据，失败则返回None
+        """
         image_data = None
         try:
             # 1. 尝试从Image字段获取图片路径 (通常是框架已下载的本地路径)
@@ -1233,131 +4031,136 @@ class GeminiImageXXX(PluginBase):
         except Exception as e:
             logger.error(f"读取或下载图片数据过程中发生严重错误: {e}")
             logger.exception(e)
-            # 不立即返回True，允许后续逻辑检查 image_data 是否为 None
         
+        return image_data
+
+    @on_image_message(priority=60)
+    async def handle_image_message(self, bot: WechatAPIClient, message: dict):
+        """处理图片消息"""
+        if not self.enable:
+            return True  # 插件禁用，传递给其他插件
+            
+        # 获取用户ID
+        user_id = self._get_user_id(message)
+        conversation_key = self._get_conversation_key(message)
+        
+        # 先检查等待状态，没有等待图片的用户不下载也不解码图片，
+        # 只登记消息，等后续g改图等命令真正需要时再读取
+        if not self._has_pending_image_request(user_id):
+            # 重新插入，保持按登记时间排序
+            self.pending_images.pop(conversation_key, None)
+            self.pending_images[conversation_key] = {
+                "bot": bot,
+                "message": message,
+                "timestamp": time.time()
+            }
+            logger.debug(f"用户 {user_id} 没有待处理的图片请求，已登记图片消息供后续使用")
+            self._schedule_precompute(message, conversation_key)
+            return True
+        
+        # 清理过期会话和图片缓存
+        self._cleanup_expired_conversations()
+        self._cleanup_image_cache()
+        
+        # 读取图片数据
+        image_data = await self._read_message_image(bot, message)
         if not image_data:
             logger.warning("最终未能获取图片数据。允许其他插件处理。")
             await bot.send_text_message(message["FromWxid"], "无法获取您发送的图片，请稍后再试或联系管理员。")
             return True # 确实没有图片数据，传递给其他插件
             
+        # 新图片已读取，之前登记的待下载图片作废
+        self.pending_images.pop(conversation_key, None)
+        
         # 缓存图片数据
-        self.image_cache[conversation_key] = {
-            "content": image_data,
-            "timestamp": time.time()
-        }
+        self.image_cache.put(conversation_key, image_data)
         
         # 如果user_id与conversation_key不同，也用user_id缓存
         if user_id != conversation_key:
-            self.image_cache[user_id] = {
-                "content": image_data,
-                "timestamp": time.time()
-            }
+            self.image_cache.put(user_id, image_data)
             
         logger.info(f"已缓存用户 {user_id} 的图片，大小: {len(image_data)} 字节")
         
-        # 添加诊断日志，检查等待状态
-        logger.info(f"检查用户 {user_id} 的等待状态...")
-        logger.info(f"当前等待反推图片的用户列表: {list(self.waiting_for_reverse_image.keys())}")
-        logger.info(f"当前等待识图的用户列表: {list(self.waiting_for_analysis_image.keys())}")
-        logger.info(f"当前等待参考图的用户列表: {list(self.waiting_for_reference_image.keys())}")
-        logger.info(f"当前等待融图的用户列表: {list(self.waiting_for_merge_image.keys())}")
+        session = self.sessions.get(user_id)
+        waiting = session.waiting if session else None
+        logger.info(f"用户 {user_id} 的等待状态: {waiting}")
+        if waiting is None:
+            logger.info(f"用户 {user_id} 没有待处理的图片请求，忽略图片消息")
+            return True
+        
+        # 检查是否已超时
+        wait_seconds = time.time() - session.waiting_since
+        if wait_seconds > self._wait_timeout(waiting):
+            label = {
+                self.WAIT_REVERSE: "反推图片",
+                self.WAIT_REFERENCE: "参考图片",
+                self.WAIT_ANALYSIS: "识图图片",
+                self.WAIT_MERGE: "融图图片",
+            }[waiting]
+            logger.warning(f"{label}上传超时: {user_id}, 等待数据: {session.waiting_data}")
+            self._clear_waiting(user_id)
+            await bot.send_text_message(message["FromWxid"], f"{label}上传超时，请重新发送命令")
+            return False  # 阻止其他插件处理
         
         # 处理等待状态的图片上传
-        if user_id in self.waiting_for_reverse_image:
-            # 记录详细日志
-            logger.info(f"检测到用户 {user_id} 有待处理的反推图片请求")
-            logger.info(f"反推图片等待时间: {time.time() - self.waiting_for_reverse_image_time.get(user_id, 0):.2f}秒")
-            logger.info(f"反推图片等待值: {self.waiting_for_reverse_image.get(user_id)}")
-            
-            # 检查是否已超时
-            if time.time() - self.waiting_for_reverse_image_time.get(user_id, 0) > self.reverse_image_wait_timeout:
-                # 清理超时状态
-                wait_value = self.waiting_for_reverse_image.pop(user_id, None)
-                self.waiting_for_reverse_image_time.pop(user_id, None)
-                logger.warning(f"反推图片上传超时: {user_id}, 等待值: {wait_value}")
-                await bot.send_text_message(message["FromWxid"], "反推图片上传超时，请重新发送命令")
-                return False  # 阻止其他插件处理
-            
-            # 清理状态
-            wait_value = self.waiting_for_reverse_image.pop(user_id, None)
-            wait_time = self.waiting_for_reverse_image_time.pop(user_id, None)
-            logger.info(f"清理用户 {user_id} 的反推图片等待状态: value={wait_value}, time={wait_time}")
+        if waiting == self.WAIT_REVERSE:
+            logger.info(f"检测到用户 {user_id} 有待处理的反推图片请求，等待时间: {wait_seconds:.2f}秒")
+            self._clear_waiting(user_id)
             
             # 处理反推
             logger.info(f"接收到用户 {user_id} 的反推图片，开始处理反推提示词")
-            try:
-                await self._process_reverse_image(bot, message, user_id, image_data)
-            except Exception as e:
-                logger.error(f"处理反推图片时出错: {str(e)}")
-                logger.exception(e)
-                await bot.send_text_message(message["FromWxid"], f"处理反推图片失败: {str(e)}")
+            await self._submit_job(bot, message, lambda: self._process_reverse_image(bot, message, user_id, image_data), "反推图片")
             return False  # 阻止其他插件处理
             
-        elif user_id in self.waiting_for_reference_image:
-            # 检查是否已超时
-            if time.time() - self.waiting_for_reference_image_time.get(user_id, 0) > self.reference_image_wait_timeout:
-                # 清理超时状态
-                prompt = self.waiting_for_reference_image.pop(user_id, None)
-                self.waiting_for_reference_image_time.pop(user_id, None)
-                logger.warning(f"参考图片上传超时: {user_id}, prompt: {prompt}")
-                await bot.send_text_message(message["FromWxid"], "参考图片上传超时，请重新发送命令")
-                return False  # 阻止其他插件处理
-                
+        elif waiting == self.WAIT_REFERENCE:
             # 获取之前保存的提示词并清理状态
-            prompt = self.waiting_for_reference_image.pop(user_id)
-            self.waiting_for_reference_image_time.pop(user_id, None)
+            prompt = session.waiting_data
+            self._clear_waiting(user_id)
             
             logger.info(f"接收到用户 {user_id} 的参考图片，开始处理参考图编辑，提示词: {prompt}")
             
             # 处理参考图片编辑请求
-            await self._process_reference_edit(bot, message, user_id, conversation_key, prompt, image_data)
+            await self._submit_job(bot, message, lambda: self._process_reference_edit(bot, message, user_id, conversation_key, prompt, image_data), "参考图编辑")
             return False  # 阻止其他插件处理
             
-        elif user_id in self.waiting_for_analysis_image:
+        elif waiting == self.WAIT_ANALYSIS:
             # 处理识图分析
-            question = self.waiting_for_analysis_image.pop(user_id)
-            self.waiting_for_analysis_image_time.pop(user_id, None)
+            question = session.waiting_data
+            self._clear_waiting(user_id)
             
             logger.info(f"接收到用户 {user_id} 的识图图片，开始处理识图，问题: {question}")
-            await self._process_image_analysis(bot, message, user_id, image_data, question)
+            await self._submit_job(bot, message, lambda: self._process_image_analysis(bot, message, user_id, image_data, question), "识图")
             return False
             
-        elif user_id in self.waiting_for_merge_image:
-            # 处理融图
-            if user_id in self.waiting_for_merge_image_first and self.waiting_for_merge_image_first[user_id]:
-                # 接收第一张图片
-                prompt = self.waiting_for_merge_image[user_id]
-                
-                # 保存第一张图片
-                self.merge_first_image[user_id] = image_data
-                
-                # 更新状态，等待第二张图片
-                self.waiting_for_merge_image_first[user_id] = False
-                self.waiting_for_merge_image_first_time[user_id] = time.time()
+        elif waiting == self.WAIT_MERGE:
+            # 处理融图，保存收到的图片直到达到指定数量
+            prompt, count = session.waiting_data
+            index = session.merge_received
+            self.image_cache.put(f"merge:{user_id}:{index}", image_data, pinned=True)
+            
+            if index + 1 < count:
+                # 更新状态，等待下一张图片，超时时间从收到这张图片开始重新计算
+                session.merge_received = index + 1
+                session.waiting_since = time.time()
+                self.sessions.schedule(session)
                 
                 # 发送提示
-                await bot.send_text_message(message["FromWxid"], f"已接收第一张图片，请发送第二张图片")
+                await bot.send_text_message(message["FromWxid"], f"已接收第 {index + 1} 张图片，请发送第 {index + 2} 张图片（共 {count} 张）")
                 return False  # 阻止其他插件处理
-            else:
-                # 接收第二张图片
-                prompt = self.waiting_for_merge_image.pop(user_id)
-                first_image = self.merge_first_image.pop(user_id, None)
-                
-                # 清理状态
-                self.waiting_for_merge_image_time.pop(user_id, None)
-                self.waiting_for_merge_image_first.pop(user_id, None)
-                if hasattr(self, 'waiting_for_merge_image_first_time') and user_id in self.waiting_for_merge_image_first_time:
-                    self.waiting_for_merge_image_first_time.pop(user_id, None)
-                
-                if not first_image:
-                    # 如果没有第一张图片，报错
-                    await bot.send_text_message(message["FromWxid"], "未找到第一张图片，请重新开始融图流程")
-                    return False  # 阻止其他插件处理
-                    
-                # 处理融图
-                logger.info(f"接收到用户 {user_id} 的第二张融图图片，开始融图处理")
-                await self._process_merge_image(bot, message, user_id, conversation_key, prompt, first_image, image_data)
+            
+            # 取出所有图片并清理状态
+            images = [self.image_cache.pop(f"merge:{user_id}:{i}") for i in range(count)]
+            self._clear_waiting(user_id)
+            
+            if not all(images):
+                # 之前的图片已丢失（如插件重启），报错
+                await bot.send_text_message(message["FromWxid"], "未找到之前发送的图片，请重新开始融图流程")
                 return False  # 阻止其他插件处理
+                
+            # 处理融图
+            logger.info(f"接收到用户 {user_id} 的全部 {count} 张融图图片，开始融图处理")
+            await self._submit_job(bot, message, lambda: self._process_merge_image(bot, message, user_id, conversation_key, prompt, images), "融图")
+            return False  # 阻止其他插件处理
             
         # 不是期望的图片上传，继续处理
         logger.info(f"用户 {user_id} 没有待处理的图片请求，忽略图片消息")
@@ -1374,34 +4177,27 @@ class GeminiImageXXX(PluginBase):
                 # 这里应该添加积分检查逻辑
                 pass
             
-            # 保存图片为临时文件
-            temp_path = self._save_temp_image(image_data, "ref_img")
-            if temp_path:
-                self.last_images[conversation_key] = temp_path
+            # 保存参考图片
+            reference_path = self._store_image(image_data)
+            self._set_last_image(conversation_key, reference_path)
             
             # 准备会话历史（如果需要）
-            conversation_history = self.conversations.get(conversation_key, {}).get("messages", [])
+            conversation_history = self._get_history(conversation_key)
             
             # 调用图片编辑API
             edited_image, error_msg = await self._edit_image(prompt, image_data, conversation_history)
             
             if edited_image:
                 # 保存编辑后的图片
-                save_path = self._save_temp_image(edited_image, "gem_ref")
+                save_path = self._store_image(edited_image)
                 if save_path:
                     # 更新最后图片路径
-                    self.last_images[conversation_key] = save_path
+                    self._set_last_image(conversation_key, save_path)
                     
                     # 更新图片缓存
-                    self.image_cache[conversation_key] = {
-                        "content": edited_image,
-                        "timestamp": time.time()
-                    }
+                    self.image_cache.put(conversation_key, edited_image)
                     if user_id != conversation_key:
-                        self.image_cache[user_id] = {
-                            "content": edited_image,
-                            "timestamp": time.time()
-                        }
+                        self.image_cache.put(user_id, edited_image)
                     
                     # 发送编辑后的图片
                     try:
@@ -1427,24 +4223,22 @@ class GeminiImageXXX(PluginBase):
                                 await bot.send_text_message(message["FromWxid"], "发送编辑后的图片失败，请重试")
                                 return
                     
-                    # 添加到会话历史
+                    # 添加到会话历史，图片只保存图片存储中的路径，使用时再读取
                     # 用户输入
+                    user_parts = [{"text": prompt}]
+                    if reference_path:
+                        user_parts.append({"image_url": reference_path})
                     self._add_message_to_conversation(
                         conversation_key,
                         "user",
-                        [
-                            {"text": prompt},
-                            {"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(image_data).decode("utf-8")}}
-                        ]
+                        user_parts
                     )
                     
                     # 模型响应
                     self._add_message_to_conversation(
                         conversation_key,
                         "model",
-                        [
-                            {"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(edited_image).decode("utf-8")}}
-                        ]
+                        [{"image_url": save_path}]
                     )
                 else:
                     await bot.send_text_message(message["FromWxid"], "图片保存失败，请重试")
@@ -1459,7 +4253,7 @@ class GeminiImageXXX(PluginBase):
             logger.exception(e)
             await bot.send_text_message(message["FromWxid"], f"处理参考图编辑时出错: {str(e)}")
     
-    async def _process_merge_image(self, bot: WechatAPIClient, message: dict, user_id: str, conversation_key: str, prompt: str, first_image: bytes, second_image: bytes):
+    async def _process_merge_image(self, bot: WechatAPIClient, message: dict, user_id: str, conversation_key: str, prompt: str, images: List[bytes]):
         """处理融图请求"""
         try:
             # 显示处理中消息
@@ -1473,43 +4267,25 @@ class GeminiImageXXX(PluginBase):
             # 准备会话上下文
             self._create_or_reset_conversation(conversation_key, self.SESSION_TYPE_MERGE, False)
             
-            # 构建请求体
-            fusion_prompt = f"融合这两张图片。{prompt}" if prompt else "融合这两张图片，创造一个协调的组合图像。"
-            
-            # 用户输入
-            self._add_message_to_conversation(
-                conversation_key,
-                "user",
-                [
-                    {"text": fusion_prompt},
-                    {"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(first_image).decode("utf-8")}},
-                    {"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(second_image).decode("utf-8")}}
-                ]
-            )
+            # 构建提示词
+            count = "这两张" if len(images) == 2 else f"这{len(images)}张"
+            fusion_prompt = f"融合{count}图片。{prompt}" if prompt else f"融合{count}图片，创造一个协调的组合图像。"
             
             # 调用API
             try:
-                # API调用逻辑与_edit_image类似，但需要处理两张图片
-                # 此处简化为直接调用_edit_image，实际可能需要修改
-                merged_image, error_msg = await self._edit_image(fusion_prompt, first_image, self.conversations.get(conversation_key, {}).get("messages", []))
+                merged_image, text_response = await self._merge_images(fusion_prompt, images)
                 
                 if merged_image:
                     # 保存融合后的图片
-                    save_path = self._save_temp_image(merged_image, "gem_merge")
+                    save_path = self._store_image(merged_image)
                     if save_path:
                         # 更新最后图片路径
-                        self.last_images[conversation_key] = save_path
+                        self._set_last_image(conversation_key, save_path)
                         
                         # 更新图片缓存
-                        self.image_cache[conversation_key] = {
-                            "content": merged_image,
-                            "timestamp": time.time()
-                        }
+                        self.image_cache.put(conversation_key, merged_image)
                         if user_id != conversation_key:
-                            self.image_cache[user_id] = {
-                                "content": merged_image,
-                                "timestamp": time.time()
-                            }
+                            self.image_cache.put(user_id, merged_image)
                         
                         # 发送融合后的图片
                         try:
@@ -1535,18 +4311,24 @@ class GeminiImageXXX(PluginBase):
                                     await bot.send_text_message(message["FromWxid"], "发送融合后的图片失败，请重试")
                                     return
                         
-                        # 添加到会话历史
+                        # 添加到会话历史，输入图片已体现在融合结果中，只保存提示词
+                        self._add_message_to_conversation(
+                            conversation_key,
+                            "user",
+                            [{"text": fusion_prompt}])
+                        model_parts = []
+                        if text_response:
+                            model_parts.append({"text": text_response})
+                        model_parts.append({"image_url": save_path})
                         self._add_message_to_conversation(
                             conversation_key,
                             "model",
-                            [
-                                {"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(merged_image).decode("utf-8")}}
-                            ]
-                        )
+                            model_parts)
                     else:
                         await bot.send_text_message(message["FromWxid"], "图片保存失败，请重试")
                 else:
                     # 翻译错误消息
+                    error_msg = text_response
                     if error_msg:
                         error_msg = self._translate_gemini_message(error_msg)
                         
@@ -1560,204 +4342,295 @@ class GeminiImageXXX(PluginBase):
             logger.exception(e)
             await bot.send_text_message(message["FromWxid"], f"处理融图时出错: {str(e)}")
     
-    async def _process_reverse_image(self, bot: WechatAPIClient, message: dict, user_id: str, image_data: bytes):
-        """处理图片反向生成提示词功能"""
+    async def _process_reverse_image(self, bot: WechatAPIClient, message: dict, user_id: str, image_data: bytes):
+        """处理图片反向生成提示词功能"""
+        try:
+            # 显示处理中消息
+            await bot.send_text_message(message["FromWxid"], "正在分析图片，请稍候...")
+            
+            text_response, error_messages = await self._reverse_image(image_data)
+            if text_response:
+                # 发送反推结果
+                await bot.send_text_message(message["FromWxid"], text_response)
+                logger.info("反推图片结果已发送给用户")
+                return
+            
+            # 如果所有尝试都失败，发送错误信息给用户
+            if error_messages:
+                error_summary = "\n".join(error_messages[:3])  # 只显示前三个错误
+                await bot.send_text_message(message["FromWxid"], f"图片分析失败，请稍后重试。\n错误信息: {error_summary}")
+            else:
+                await bot.send_text_message(message["FromWxid"], "图片分析失败，请稍后重试。")
+                    
+        except Exception as outer_error:
+            logger.error(f"反推图片整体处理异常: {str(outer_error)}")
+            logger.exception(outer_error)
+            await bot.send_text_message(message["FromWxid"], f"图片分析失败: {str(outer_error)}")
+            return
+    
+    async def _reverse_image(self, image_data: bytes) -> Tuple[Optional[str], List[str]]:
+        """获取图片的反推结果
+        
+        同一张图片的并发请求只调用一次API，结果在短时间内缓存。
+        
+        Args:
+            image_data: 图片二进制数据
+            
+        Returns:
+            Tuple[Optional[str], List[str]]: (反推结果, 错误信息列表)
+        """
+        # 密钥可以单独配置模型，缓存键使用请求实际可能使用的模型
+        cache_key = ("reverse", hashlib.sha256(image_data).hexdigest(), self.REVERSE_PROMPT, tuple(self._effective_models()))
+        text_response = self.vision_result_cache.get(cache_key)
+        if text_response is not None:
+            logger.info("使用缓存的反推结果")
+            return text_response, []
+        return await self.vision_flight.do(cache_key, lambda: self._request_reverse_prompt(image_data, cache_key))
+    
+    async def _request_reverse_prompt(self, image_data: bytes, cache_key: Tuple) -> Tuple[Optional[str], List[str]]:
+        """调用API反推图片提示词，成功时写入结果缓存"""
+        error_messages = []
         try:
-            # 保存图片到临时文件，确保图片可以被正确处理
-            temp_path = self._save_temp_image(image_data, "reverse_img")
-            if not temp_path:
-                logger.error("保存反推图片到临时文件失败")
-                await bot.send_text_message(message["FromWxid"], "保存图片失败，请重试")
-                return
-                
-            logger.info(f"已保存反推图片到临时文件: {temp_path}")
+            # 图片缩小到适合识图的尺寸并转换为Base64格式
+            image_part = await self._get_vision_part(image_data)
+            logger.info(f"图片成功转换为Base64格式，长度: {len(image_part['inlineData']['data'])}")
             
-            # 显示处理中消息
-            await bot.send_text_message(message["FromWxid"], "正在分析图片，请稍候...")
+            # 构建请求数据
+            data = {
+                "contents": [
+                    {
+                        "parts": [
+                            image_part,
+                            {
+                                "text": self.REVERSE_PROMPT
+                            }
+                        ]
+                    }
+                ]
+            }
             
-            # 尝试三种不同的方法处理图片
-            success = False
-            error_messages = []
+            async def read_response(response: aiohttp.ClientResponse) -> Tuple[int, Optional[dict]]:
+                try:
+                    return response.status, await response.json(content_type=None)
+                except Exception as json_error:
+                    logger.error(f"解析API响应JSON失败: {str(json_error)}")
+                    # 尝试读取文本内容
+                    try:
+                        text_content = await response.text()
+                        logger.error(f"API响应文本内容: {text_content[:500]}...")
+                    except Exception:
+                        pass
+                    error_messages.append(f"API响应解析失败: {str(json_error)}")
+                    return response.status, None
             
+            # 发送请求，重试由统一的重试策略处理
+            result = None
+            response_status = None
             try:
-                # 将图片转换为Base64格式
-                image_base64 = base64.b64encode(image_data).decode("utf-8")
-                logger.info(f"图片成功转换为Base64格式，长度: {len(image_base64)}")
-                
-                # 提示词（中文）
-                prompt = "请详细分析这张图片的内容，包括主要对象、场景、风格、颜色等关键特征。如果图片包含文字，也请提取出来。请用简洁清晰的中文进行描述。"
-                
-                # 构建请求数据
-                data = {
-                    "contents": [
-                        {
-                            "parts": [
-                                {
-                                    "inlineData": {
-                                        "mimeType": "image/jpeg",  # 使用更通用的mime类型
-                                        "data": image_base64
-                                    }
-                                },
-                                {
-                                    "text": prompt
-                                }
-                            ]
-                        }
-                    ]
-                }
-                
-                # 根据配置决定使用直接调用还是通过代理服务调用
-                if self.use_proxy_service and self.proxy_service_url:
-                    url = f"{self.proxy_service_url.rstrip('/')}/v1beta/models/{self.model}:generateContent?key={self.api_key}"
-                    headers = {
-                        "Content-Type": "application/json"
-                    }
-                    params = {}
-                    logger.info(f"使用代理服务URL: {self.proxy_service_url}")
+                response_status, result = await self._call_gemini(json.dumps(data), read_response, label="反推图片")
+                logger.info(f"图片分析API响应状态码: {response_status}")
+            except RetryableStatusError as e:
+                logger.error(f"重试结束，最后状态码: {e.status}")
+                error_messages.append(f"API请求失败，状态码: {e.status}")
+            except Exception as e:
+                logger.error(f"图片分析请求异常，重试结束: {str(e)}")
+                error_messages.append(f"网络请求异常: {str(e)}")
+            
+
+            # 处理API响应
+            if result and response_status == 200:
+                candidates = result.get("candidates", [])
+                if candidates and len(candidates) > 0:
+                    content = candidates[0].get("content", {})
+                    parts = content.get("parts", [])
+                    
+                    # 提取文本响应
+                    text_response = None
+                    for part in parts:
+                        if "text" in part:
+                            text_response = part["text"]
+                            break
+                    
+                    if text_response:
+                        logger.info(f"成功获取反推结果，文本长度: {len(text_response)}")
+                        self.vision_result_cache.put(cache_key, text_response)
+                        return text_response, error_messages
+                    else:
+                        logger.warning("API响应中没有文本内容")
+                        error_messages.append("API响应中没有文本内容")
                 else:
-                    url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:generateContent"
-                    headers = {
-                        "Content-Type": "application/json",
-                    }
-                    params = {
-                        "key": self.api_key
-                    }
-                    logger.info("使用直接API请求")
-                
-                # 创建代理配置
-                proxies = None
-                if self.enable_proxy and self.proxy_url and not self.use_proxy_service:
-                    proxies = {
-                        "http": self.proxy_url,
-                        "https": self.proxy_url
-                    }
-                    logger.info(f"使用代理: {self.proxy_url}")
-                
-                # 添加重试逻辑
-                max_retries = 3  # 最大重试次数
-                retry_count = 0
-                retry_delay = 1  # 初始重试延迟（秒）
-                response = None
-                result = None
-                response_status = None
+                    logger.warning("API响应中没有candidates字段或为空")
+                    error_messages.append("API未返回有效响应")
+            else:
+                logger.warning(f"API请求失败或返回非200状态码: {response_status}")
                 
-                logger.info(f"开始执行反推图片请求，URL: {url}")
+        except Exception as process_error:
+            logger.error(f"处理反推请求过程中出错: {str(process_error)}")
+            logger.exception(process_error)
+            error_messages.append(f"处理图片分析失败: {str(process_error)}")
+        
+        return None, error_messages
+    
+    def _get_finish_reason_error(self, finish_reason: str) -> Optional[str]:
+        """根据finishReason返回面向用户的错误消息，正常结束时返回None"""
+        if finish_reason == "SAFETY":
+            logger.warning("内容安全过滤: 请求被安全系统拒绝")
+            return "请求被内容安全系统拒绝，请修改提示词后重试"
+        elif finish_reason == "RECITATION":
+            logger.warning("内容重复: API检测到提示词中存在重复或引用内容")
+            return "API检测到提示词中存在重复或引用内容，请修改后重试"
+        elif finish_reason == "IMAGE_SAFETY":
+            logger.warning("图片安全过滤: 生成的图片被安全系统拒绝")
+            return "生成的图片被内容安全系统拒绝，请修改提示词后重试"
+        elif finish_reason and finish_reason != "STOP":
+            logger.warning(f"其他失败原因: {finish_reason}")
+            return f"生成失败，原因: {finish_reason}"
+        return None
+    
+    async def _read_json_response(self, response: aiohttp.ClientResponse) -> Any:
+        """增量读取并解析JSON响应，inlineData中的图片直接解码为bytes
+        
+        Raises:
+            json.JSONDecodeError: 响应不是完整的JSON
+        """
+        decoder = InlineDataDecoder()
+        async for chunk in response.content.iter_chunked(65536):
+            decoder.feed(chunk)
+        logger.debug(f"Gemini API响应大小: {decoder.size} 字节，包含 {len(decoder.images)} 张图片")
+        return decoder.close()
+    
+    async def _iter_sse_events(self, response: aiohttp.ClientResponse) -> AsyncIterator[Any]:
+        """逐个解析SSE响应中的事件数据（JSON）
+        
+        data行的内容直接送入InlineDataDecoder，包含图片的事件通常是一行数MB的数据，
+        不会先拼成完整的行，也不会超过StreamReader按行读取的长度限制。
+        """
+        decoder = None     # 当前事件的解码器
+        head = bytearray() # 行首尚未确定类型的字节
+        line_type = None   # 当前行的类型: None(行首) / "data" / "skip"
+        async for chunk in response.content.iter_chunked(65536):
+            pos = 0
+            while pos < len(chunk):
+                if line_type is not None:
+                    newline = chunk.find(b"\n", pos)
+                    end = len(chunk) if newline < 0 else newline
+                    if line_type == "data":
+                        # JSON允许行尾的\r，直接交给解码器
+                        decoder.feed(chunk[pos:end])
+                    if newline < 0:
+                        break
+                    pos = newline + 1
+                    line_type = None
+                    continue
                 
-                while retry_count <= max_retries:
-                    try:
-                        # 发送请求
-                        async with aiohttp.ClientSession() as session:
-                            async with session.post(
-                                url,
-                                headers=headers,
-                                params=params,
-                                json=data,
-                                proxy=proxies["https"] if proxies else None,
-                                timeout=60
-                            ) as response:
-                                response_status = response.status
-                                logger.info(f"图片分析API响应状态码: {response_status}")
-                                
-                                # 如果成功或不是可重试的错误，跳出循环
-                                if response_status == 200 or response_status not in [429, 500, 502, 503, 504]:
-                                    try:
-                                        result = await response.json()
-                                        logger.info("成功解析API响应为JSON")
-                                        break
-                                    except Exception as json_error:
-                                        logger.error(f"解析API响应JSON失败: {str(json_error)}")
-                                        result = None
-                                        # 尝试读取文本内容
-                                        try:
-                                            text_content = await response.text()
-                                            logger.error(f"API响应文本内容: {text_content[:500]}...")
-                                            error_messages.append(f"API响应解析失败: {str(json_error)}")
-                                        except:
-                                            pass
-                                        break
-                                
-                                # 如果是可重试的错误且未达到最大重试次数，继续重试
-                                if retry_count < max_retries:
-                                    logger.warning(f"API请求返回状态码 {response_status}，将进行重试 ({retry_count+1}/{max_retries})")
-                                    retry_count += 1
-                                    await asyncio.sleep(retry_delay)
-                                    retry_delay = min(retry_delay * 2, 5)  # 增加延迟，但最多5秒
-                                    continue
-                                else:
-                                    logger.error(f"达到最大重试次数，最后状态码: {response_status}")
-                                    error_messages.append(f"API请求失败，状态码: {response_status}")
-                                    break
-                            
-                    except Exception as e:
-                        logger.error(f"图片分析请求异常: {str(e)}")
-                        if retry_count < max_retries:
-                            logger.warning(f"图片分析请求异常，将进行重试 ({retry_count+1}/{max_retries})")
-                            retry_count += 1
-                            await asyncio.sleep(retry_delay)
-                            retry_delay = min(retry_delay * 2, 5)
-                            continue
+                # 行首：读到换行或足够判断行类型的字节
+                newline = chunk.find(b"\n", pos, pos + 5 - len(head) + 1)
+                if newline >= 0:
+                    head += chunk[pos:newline]
+                    pos = newline + 1
+                    line = bytes(head).rstrip(b"\r")
+                    head.clear()
+                    if not line:
+                        # 空行表示一个事件结束
+                        if decoder is not None:
+                            yield decoder.close()
+                            decoder = None
+                    elif line.startswith(b"data:"):
+                        if decoder is None:
+                            decoder = InlineDataDecoder()
                         else:
-                            logger.error(f"图片分析请求异常，达到最大重试次数: {str(e)}")
-                            error_messages.append(f"网络请求异常: {str(e)}")
-                            break
+                            decoder.feed(b"\n")
+                        decoder.feed(line[5:])
+                    continue
                 
-                # 处理API响应
-                if result and response_status == 200:
-                    candidates = result.get("candidates", [])
-                    if candidates and len(candidates) > 0:
-                        content = candidates[0].get("content", {})
-                        parts = content.get("parts", [])
-                        
-                        # 提取文本响应
-                        text_response = None
-                        for part in parts:
-                            if "text" in part:
-                                text_response = part["text"]
-                                break
-                        
-                        if text_response:
-                            logger.info(f"成功获取反推结果，文本长度: {len(text_response)}")
-                            
-                            # 清理输出路径
-                            try:
-                                if os.path.exists(temp_path):
-                                    os.remove(temp_path)
-                                    logger.debug(f"已清理临时文件: {temp_path}")
-                            except Exception as e:
-                                logger.warning(f"清理临时文件失败: {e}")
-                            
-                            # 发送反推结果
-                            await bot.send_text_message(message["FromWxid"], text_response)
-                            logger.info("反推图片结果已发送给用户")
-                            success = True
-                            # 成功处理，不需要继续尝试
+                take = min(len(chunk) - pos, 5 - len(head))
+                head += chunk[pos:pos + take]
+                pos += take
+                if len(head) >= 5:
+                    if head == b"data:":
+                        if decoder is None:
+                            decoder = InlineDataDecoder()
                         else:
-                            logger.warning("API响应中没有文本内容")
-                            error_messages.append("API响应中没有文本内容")
+                            # 同一事件的多个data行以换行连接
+                            decoder.feed(b"\n")
+                        line_type = "data"
                     else:
-                        logger.warning("API响应中没有candidates字段或为空")
-                        error_messages.append("API未返回有效响应")
-                else:
-                    logger.warning(f"API请求失败或返回非200状态码: {response_status}")
-                    
-            except Exception as process_error:
-                logger.error(f"处理反推请求过程中出错: {str(process_error)}")
-                logger.exception(process_error)
-                error_messages.append(f"处理图片分析失败: {str(process_error)}")
+                        line_type = "skip"
+                    head.clear()
+        
+        # 处理没有以空行结尾的最后一个事件
+        if head.startswith(b"data:"):
+            if decoder is None:
+                decoder = InlineDataDecoder()
+            decoder.feed(bytes(head[5:]))
+        if decoder is not None and decoder.size:
+            yield decoder.close()
+    
+    async def _process_stream_response(self, response: aiohttp.ClientResponse,
+                                       on_image: Callable[[bytes, str, int], Awaitable[None]]) -> Tuple[List[Tuple[bytes, str]], Optional[str], Optional[str], bool]:
+        """
+        处理streamGenerateContent的SSE响应，增量解析各个部分，图片完整后立即回调
+        
+        Args:
+            response: 状态码为200的流式响应
+            on_image: 每张图片解析完成时调用，参数为 (图片数据, 关联文本, 序号)
             
-            # 如果所有尝试都失败，发送错误信息给用户
-            if not success:
-                if error_messages:
-                    error_summary = "\n".join(error_messages[:3])  # 只显示前三个错误
-                    await bot.send_text_message(message["FromWxid"], f"图片分析失败，请稍后重试。\n错误信息: {error_summary}")
-                else:
-                    await bot.send_text_message(message["FromWxid"], "图片分析失败，请稍后重试。")
-                    
-        except Exception as outer_error:
-            logger.error(f"反推图片整体处理异常: {str(outer_error)}")
-            logger.exception(outer_error)
-            await bot.send_text_message(message["FromWxid"], f"图片分析失败: {str(outer_error)}")
-            return
+        Returns:
+            Tuple[List[Tuple[bytes, str]], Optional[str], Optional[str], bool]: 图片数据和文本对列表, 最终文本, 错误消息,
+            是否收到了finishReason为STOP的完整响应（流中断时已发送的部分结果不能缓存）
+        """
+        image_text_pairs = []  # 存储(图片数据, 图片文本)对
+        final_text = ""  # 存储主文本响应
+        current_text = ""  # 尚未与图片配对的文本，流式响应中文本可能分多段到达
+        complete = False  # 是否收到了正常结束的finishReason
+        
+        try:
+            async for event in self._iter_sse_events(response):
+                candidates = event.get("candidates", [])
+                if not candidates:
+                    block_reason = event.get("promptFeedback", {}).get("blockReason", "")
+                    if block_reason:
+                        logger.warning(f"提示词被阻止: {block_reason}")
+                        return image_text_pairs, None, f"提示词被拒绝: {block_reason}", False
+                    continue
+                
+                candidate = candidates[0]
+                for part in candidate.get("content", {}).get("parts", []):
+                    if part.get("text"):
+                        current_text += part["text"]
+                    elif "inlineData" in part:
+                        inline_data = part.get("inlineData", {})
+                        if inline_data and "data" in inline_data:
+                            try:
+                                image_data = _inline_data_bytes(inline_data["data"])
+                            except Exception as e:
+                                logger.error(f"处理图片数据失败: {e}")
+                                continue
+                            text = current_text.strip()
+                            current_text = ""
+                            if text:
+                                final_text = text
+                            image_text_pairs.append((image_data, text))
+                            logger.info(f"流式响应收到第 {len(image_text_pairs)} 张图片，立即发送")
+                            await on_image(image_data, text, len(image_text_pairs) - 1)
+                
+                finish_reason = candidate.get("finishReason", "")
+                finish_error = self._get_finish_reason_error(finish_reason)
+                if finish_error:
+                    return image_text_pairs, None, finish_error, False
+                if finish_reason == "STOP":
+                    complete = True
+        except Exception as e:
+            # 已经发送过图片时不能再重试，否则用户会收到重复的图片
+            if not image_text_pairs:
+                raise
+            logger.error(f"流式响应中断，已发送 {len(image_text_pairs)} 张图片: {e}")
+        
+        if not complete:
+            logger.warning(f"流式响应未正常结束，已收到 {len(image_text_pairs)} 张图片")
+        if current_text.strip():
+            final_text = current_text.strip()
+        return image_text_pairs, final_text, None, complete
     
     async def _process_multi_image_response(self, result: dict) -> Tuple[List[Tuple[bytes, str]], Optional[str], Optional[str]]:
         """
@@ -1789,18 +4662,9 @@ class GeminiImageXXX(PluginBase):
             finish_reason = first_candidate.get("finishReason", "")
             
             # 处理已知的失败原因
-            if finish_reason == "SAFETY":
-                logger.warning("内容安全过滤: 请求被安全系统拒绝")
-                return [], None, "请求被内容安全系统拒绝，请修改提示词后重试"
-            elif finish_reason == "RECITATION":
-                logger.warning("内容重复: API检测到提示词中存在重复或引用内容")
-                return [], None, "API检测到提示词中存在重复或引用内容，请修改后重试"
-            elif finish_reason == "IMAGE_SAFETY":
-                logger.warning("图片安全过滤: 生成的图片被安全系统拒绝")
-                return [], None, "生成的图片被内容安全系统拒绝，请修改提示词后重试"
-            elif finish_reason and finish_reason != "STOP":
-                logger.warning(f"其他失败原因: {finish_reason}")
-                return [], None, f"生成失败，原因: {finish_reason}"
+            finish_error = self._get_finish_reason_error(finish_reason)
+            if finish_error:
+                return [], None, finish_error
             
             # 处理正常响应
             content = first_candidate.get("content", {})
@@ -1825,7 +4689,7 @@ class GeminiImageXXX(PluginBase):
                     if inline_data and "data" in inline_data:
                         try:
                             # 将Base64数据转换为图片
-                            image_data = base64.b64decode(inline_data["data"])
+                            image_data = _inline_data_bytes(inline_data["data"])
                             
                             # 将当前文本与图片配对
                             image_text_pairs.append((image_data, current_text))
@@ -1843,14 +4707,6 @@ class GeminiImageXXX(PluginBase):
     async def _process_image_analysis(self, bot: WechatAPIClient, message: dict, user_id: str, image_data: bytes, question: str):
         """处理图片分析请求"""
         try:
-            # 保存图片到临时文件，确保图片可以被正确处理
-            temp_path = self._save_temp_image(image_data, "analysis_img")
-            if not temp_path:
-                await bot.send_text_message(message["FromWxid"], "保存图片失败，请重试")
-                return
-                
-            logger.info(f"已保存分析图片到临时文件: {temp_path}")
-            
             # 显示处理中消息
             await bot.send_text_message(message["FromWxid"], "正在分析图片，请稍候...")
             
@@ -1858,23 +4714,17 @@ class GeminiImageXXX(PluginBase):
             analysis_result = await self._analyze_image(image_data, question)
             
             if analysis_result:
-                # 保存最近图片分析记录，便于追问
-                self.last_analysis_image[user_id] = image_data
-                self.last_analysis_time[user_id] = time.time()
+                # 保存最近图片分析记录，便于追问；只保存预处理后的图片，追问时不需要重新压缩
+                self.image_cache.put(f"analysis:{user_id}", await self._keep_vision_image(image_data), pinned=True)
+                session = self.sessions.get_or_create(user_id)
+                session.analysis_time = time.time()
+                self.sessions.schedule(session)
                 
                 # 添加追问提示
                 analysis_result += "\n\n💬3min内输入g追问+问题，可继续追问"
                 
                 # 发送分析结果
                 await bot.send_text_message(message["FromWxid"], analysis_result)
-                
-                # 清理临时文件
-                try:
-                    if os.path.exists(temp_path):
-                        os.remove(temp_path)
-                        logger.debug(f"已清理临时文件: {temp_path}")
-                except Exception as e:
-                    logger.warning(f"清理临时文件失败: {e}")
             else:
                 await bot.send_text_message(message["FromWxid"], "图片分析失败，请稍后重试")
         except Exception as e:
@@ -1883,14 +4733,23 @@ class GeminiImageXXX(PluginBase):
             await bot.send_text_message(message["FromWxid"], f"处理图片分析时出错: {str(e)}")
     
     async def _analyze_image(self, image_data: bytes, question: str) -> Optional[str]:
-        """调用API分析图片"""
+        """分析图片，同一张图片的相同问题并发时只调用一次API，结果在短时间内缓存"""
+        cache_key = ("analysis", hashlib.sha256(image_data).hexdigest(), question, tuple(self._effective_models(self.ANALYSIS_MODEL)))
+        analysis_result = self.vision_result_cache.get(cache_key)
+        if analysis_result is not None:
+            logger.info("使用缓存的图片分析结果")
+            return analysis_result
+        return await self.vision_flight.do(cache_key, lambda: self._request_image_analysis(image_data, question, cache_key))
+    
+    async def _request_image_analysis(self, image_data: bytes, question: str, cache_key: Tuple) -> Optional[str]:
+        """调用API分析图片，成功时写入结果缓存"""
         # 确保使用中文回答
         if not question.strip().endswith("。") and not "中文" in question:
             question = question + "。请用简洁的中文回答。"
             
         try:
-            # 构建请求体
-            encoded_image = base64.b64encode(image_data).decode("utf-8")
+            # 构建请求体，图片缩小到适合识图的尺寸
+            image_part = await self._get_vision_part(image_data)
             
             payload = {
                 "contents": [
@@ -1898,12 +4757,7 @@ class GeminiImageXXX(PluginBase):
                         "role": "user",
                         "parts": [
                             {"text": question},
-                            {
-                                "inline_data": {
-                                    "mime_type": "image/jpeg",
-                                    "data": encoded_image
-                                }
-                            }
+                            image_part
                         ]
                     }
                 ],
@@ -1915,107 +4769,56 @@ class GeminiImageXXX(PluginBase):
                 }
             }
             
-            # 调用API
-            headers = {
-                "Content-Type": "application/json"
-            }
+            # 构建请求
+            request_body = json.dumps(payload)
             
-            # 根据配置决定使用直接调用还是通过代理服务调用
-            if self.use_proxy_service and self.proxy_service_url:
-                # 修改为最新的gemini-1.5-flash模型
-                url = f"{self.proxy_service_url.rstrip('/')}/v1beta/models/gemini-2.0-flash:generateContent?key={self.api_key}"
-                logger.info(f"使用代理服务URL: {url}")
-            else:
-                # 修改为最新的gemini-1.5-flash模型
-                url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={self.api_key}"
-                logger.info(f"使用直接API URL: {url}")
-            
-            # 使用aiohttp发送请求
-            async with aiohttp.ClientSession() as session:
-                # 配置代理
-                proxy = None
-                if self.enable_proxy and self.proxy_url and not self.use_proxy_service:
-                    proxy = self.proxy_url
-                    logger.info(f"使用HTTP代理: {proxy}")
-                
-                # 构建请求
-                request_body = json.dumps(payload)
-                
-                # 添加重试逻辑
-                max_retries = 3
-                retry_count = 0
-                retry_delay = 1
-                
-                while retry_count <= max_retries:
-                    try:
-                        # 发送请求
-                        async with session.post(
-                            url, 
-                            headers=headers, 
-                            data=request_body,
-                            proxy=proxy,
-                            timeout=30
-                        ) as response:
-                            response_text = await response.text()
-                            logger.info(f"API响应状态码: {response.status}")
-                            
-                            if response.status == 200:
-                                try:
-                                    result = json.loads(response_text)
-                                    
-                                    # 解析响应
-                                    candidates = result.get("candidates", [])
-                                    if candidates and len(candidates) > 0:
-                                        content = candidates[0].get("content", {})
-                                        parts = content.get("parts", [])
-                                        
-                                        text_response = ""
-                                        for part in parts:
-                                            if "text" in part:
-                                                text_response += part["text"]
-                                        
-                                        return text_response
-                                    
-                                    logger.error(f"API响应中找不到有效内容: {response_text[:200]}")
-                                    return None
-                                except json.JSONDecodeError as e:
-                                    logger.error(f"解析API响应异常: {str(e)}, 响应内容: {response_text[:200]}")
-                                    
-                                    # 如果代理服务失败，尝试直接调用API
-                                    if self.use_proxy_service and retry_count < max_retries:
-                                        logger.warning("代理服务返回无效JSON，尝试直接调用API")
-                                        # 切换到直接API调用，使用新模型
-                                        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={self.api_key}"
-                                        logger.info(f"切换到直接API URL: {url}")
-                                        retry_count += 1
-                                        await asyncio.sleep(retry_delay)
-                                        retry_delay *= 2
-                                        continue
-                                    else:
-                                        return None
-                            elif response.status in [429, 500, 502, 503, 504] and retry_count < max_retries:
-                                # 服务器错误，重试
-                                logger.warning(f"服务器错误 {response.status}，正在重试 ({retry_count+1}/{max_retries})")
-                                retry_count += 1
-                                await asyncio.sleep(retry_delay)
-                                retry_delay *= 2
-                                continue
-                            else:
-                                logger.error(f"API调用失败 (状态码: {response.status}): {response_text[:200]}")
-                                return None
-                                
-                    except Exception as req_error:
-                        logger.error(f"请求异常: {str(req_error)}")
-                        if retry_count < max_retries:
-                            logger.warning(f"请求异常，正在重试 ({retry_count+1}/{max_retries})")
-                            retry_count += 1
-                            await asyncio.sleep(retry_delay)
-                            retry_delay *= 2
-                            continue
-                        else:
-                            logger.error(f"请求失败，达到最大重试次数")
-                            return None
+            async def read_response(response: aiohttp.ClientResponse) -> Tuple[int, str]:
+                return response.status, await response.text()
+            
+            # 发送请求，重试由统一的重试策略处理；代理服务返回无效JSON时改为直接调用API
+            use_direct = False
+            while True:
+                try:
+                    status, response_text = await self._call_gemini(
+                        request_body, read_response, label="图片分析",
+                        model=self.ANALYSIS_MODEL, timeout=30, direct=use_direct
+                    )
+                except RetryableStatusError as e:
+                    logger.error(f"API调用失败，重试结束后状态码仍为 {e.status}: {e.body[:200]}")
+                    return None
+                
+                if status != 200:
+                    logger.error(f"API调用失败 (状态码: {status}): {response_text[:200]}")
+                    return None
+                
+                try:
+                    result = json.loads(response_text)
+                except json.JSONDecodeError as e:
+                    logger.error(f"解析API响应异常: {str(e)}, 响应内容: {response_text[:200]}")
+                    
+                    # 如果代理服务失败，尝试直接调用API
+                    if self.use_proxy_service and self.proxy_service_url and not use_direct:
+                        logger.warning("代理服务返回无效JSON，尝试直接调用API")
+                        use_direct = True
+                        continue
+                    return None
+                
+                # 解析响应
+                candidates = result.get("candidates", [])
+                if candidates and len(candidates) > 0:
+                    content = candidates[0].get("content", {})
+                    parts = content.get("parts", [])
+                    
+                    text_response = ""
+                    for part in parts:
+                        if "text" in part:
+                            text_response += part["text"]
+                    
+                    if text_response:
+                        self.vision_result_cache.put(cache_key, text_response)
+                    return text_response
                 
+                logger.error(f"API响应中找不到有效内容: {response_text[:200]}")
                 return None
                 
         except Exception as e:
@@ -2023,198 +4826,87 @@ class GeminiImageXXX(PluginBase):
             logger.exception(e)
             return None
 
-    async def _generate_image(self, prompt: str, conversation_history: List[Dict] = None) -> Tuple[List[Tuple[bytes, str]], Optional[str], Optional[str]]:
-        """调用Gemini API生成图片，返回图片数据和文本响应列表"""
-        # 根据配置决定使用直接调用还是通过代理服务调用
-        if self.use_proxy_service and self.proxy_service_url:
-            # 使用代理服务调用API
-            url = f"{self.proxy_service_url.rstrip('/')}/v1beta/models/{self.model}:generateContent?key={self.api_key}"
-            headers = {
-                "Content-Type": "application/json"
-            }
-            params = {}  # 不需要在URL参数中传递API密钥
-        else:
-            # 直接调用Google API
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:generateContent"
-            headers = {
-                "Content-Type": "application/json",
-            }
-            params = {
-                "key": self.api_key
-            }
+    async def _generate_image(self, prompt: str, conversation_history: List[Dict] = None,
+                              on_image: Optional[Callable[[bytes, str, int], Awaitable[None]]] = None,
+                              prepared_history: Optional[Tuple[List[Dict], List[Tuple[Dict, Dict, Optional[bytes]]]]] = None,
+                              use_cache: bool = False) -> Tuple[List[Tuple[bytes, str]], Optional[str], Optional[str]]:
+        """调用Gemini API生成图片，返回图片数据和文本响应列表
         
-        # 构建请求数据
-        if conversation_history and len(conversation_history) > 0:
-            # 有会话历史，构建上下文
-            processed_history = []
-            for msg in conversation_history:
-                role = msg["role"]
-                if role == "assistant":
-                    role = "model"
-                
-                processed_msg = {"role": role, "parts": []}
-                for part in msg["parts"]:
-                    if "text" in part:
-                        processed_msg["parts"].append({"text": part["text"]})
-                    elif "image_url" in part:
-                        try:
-                            with open(part["image_url"], "rb") as f:
-                                image_data = f.read()
-                                # 压缩图片数据以减小请求大小
-                                image_data = await self._compress_image(image_data, max_size=600, quality=80)
-                                image_base64 = base64.b64encode(image_data).decode("utf-8")
-                                processed_msg["parts"].append({
-                                    "inlineData": {
-                                        "mimeType": "image/jpeg",
-                                        "data": image_base64
-                                    }
-                                })
-                        except Exception as e:
-                            logger.error(f"处理历史图片失败: {e}")
-                    elif "inline_data" in part:
-                        # 直接使用inlineData格式
-                        processed_msg["parts"].append({
-                            "inlineData": {
-                                "mimeType": part["inline_data"]["mime_type"],
-                                "data": part["inline_data"]["data"]
-                            }
-                        })
-                processed_history.append(processed_msg)
-            
-            # 最终请求用户消息不需要重复添加，已包含在processed_history中
-            data = {
-                "contents": processed_history,
-                "generationConfig": {
-                    "responseModalities": ["Text", "Image"],
-                    "temperature": 0.4,
-                    "topP": 0.8,
-                    "topK": 40
-                }
+        传入on_image时使用流式接口，每解析出一张完整图片就以 (图片数据, 关联文本, 序号) 调用一次。
+        传入prepared_history时直接使用已转换的会话历史。use_cache为True时先按conversation_history
+        中的文本和图片摘要查找生成结果缓存，成功的结果写入缓存。
+        """
+        try:
+            generation_config = {
+                "responseModalities": ["Text", "Image"],
+                "temperature": 0.4,
+                "topP": 0.8,
+                "topK": 40
             }
             
-            # 记录处理后的请求数据（安全版本）
-            safe_data = copy.deepcopy(data)
-            for msg in safe_data["contents"]:
-                for part in msg["parts"]:
-                    if "inlineData" in part and "data" in part["inlineData"]:
-                        part["inlineData"]["data"] = f"[BASE64_DATA_LENGTH: {len(part['inlineData']['data'])}]"
-            logger.debug(f"请求数据结构: {safe_data}")
+            cache_key = None
+            if use_cache:
+                # 密钥可以单独配置模型，缓存键使用请求实际可能使用的模型
+                cache_key = GenerationCache.make_key(",".join(self._effective_models()), prompt, generation_config,
+                                                     self._history_cache_key(conversation_history))
+                cached = self.generation_cache.get(cache_key)
+                if cached is not None:
+                    image_text_pairs, final_text = cached
+                    logger.info(f"使用缓存的生成结果，图片数量: {len(image_text_pairs)}")
+                    if on_image is not None:
+                        for index, (image_data, text) in enumerate(image_text_pairs):
+                            await on_image(image_data, text, index)
+                    return image_text_pairs, final_text, None
             
-        else:
-            data = {
-                "contents": [
-                    {
-                        "parts": [
-                            {
-                                "text": prompt
-                            }
-                        ]
-                    }
-                ],
-                "generationConfig": {
-                    "responseModalities": ["Text", "Image"],
-                    "temperature": 0.4,
-                    "topP": 0.8,
-                    "topK": 40
-                }
-            }
-        
-        proxies = None
-        if self.enable_proxy and self.proxy_url and not self.use_proxy_service:
-            proxies = {
-                "http": self.proxy_url,
-                "https": self.proxy_url
-            }
-        
-        try:
-            logger.info(f"开始调用Gemini API生成图片，模型: {self.model}")
+            logger.info(f"开始调用Gemini API生成图片，模型: {', '.join(self._effective_models())}")
+            
+            # 构建请求体，超出大小限制时按预算裁剪会话历史
+            request_data = await self._pack_request(
+                conversation_history,
+                {"role": "user", "parts": [{"text": prompt}]},
+                generation_config,
+                history_max_size=self.GENERATE_HISTORY_MAX_SIZE,
+                history_quality=self.GENERATE_HISTORY_QUALITY,
+                prepared_history=prepared_history
+            )
             
-            max_retries = 15
-            retry_count = 0
-            retry_delay = 1
-            response = None
+            async def read_response(response: aiohttp.ClientResponse) -> Tuple[int, Optional[dict]]:
+                if response.status != 200:
+                    logger.error(f"Gemini API调用失败 (状态码: {response.status}): {(await response.text())[:200]}")
+                    return response.status, None
+                return response.status, await self._read_json_response(response)
             
-            while retry_count <= max_retries:
+            if on_image is not None:
+                async def read_stream(response: aiohttp.ClientResponse) -> Tuple[int, Optional[Tuple[List[Tuple[bytes, str]], Optional[str], Optional[str], bool]]]:
+                    if response.status != 200:
+                        logger.error(f"Gemini API调用失败 (状态码: {response.status}): {(await response.text())[:200]}")
+                        return response.status, None
+                    return response.status, await self._process_stream_response(response, on_image)
+                
+                # 流式请求，重试由统一的重试策略处理
                 try:
-                    # 计算请求体大小
-                    request_data = json.dumps(data)
-                    request_size = len(request_data)
-                    logger.info(f"Gemini API请求体大小: {request_size} 字节 ({request_size/1024/1024:.2f} MB)")
-                    
-                    # 检查请求体大小是否超过限制
-                    if request_size > self.MAX_REQUEST_SIZE:
-                        logger.warning(f"请求体大小 ({request_size/1024/1024:.2f} MB) 超出限制，尝试清理会话历史")
-                        
-                        # 提取最后一条用户消息
-                        last_user_message = None
-                        if conversation_history and len(conversation_history) > 0:
-                            for msg in reversed(conversation_history):
-                                if msg.get("role") == "user":
-                                    last_user_message = msg
-                                    break
-                            
-                        # 重建请求数据，不包含历史
-                        data = {
-                            "contents": [
-                                {
-                                    "parts": [
-                                        {
-                                            "text": prompt
-                                        }
-                                    ]
-                                }
-                            ],
-                            "generationConfig": {
-                                "responseModalities": ["Text", "Image"],
-                                "temperature": 0.4,
-                                "topP": 0.8,
-                                "topK": 40
-                            }
-                        }
-                        
-                        # 重新计算请求体大小
-                        request_data = json.dumps(data)
-                        request_size = len(request_data)
-                        logger.info(f"重建后的请求体大小: {request_size} 字节 ({request_size/1024/1024:.2f} MB)")
-                    
-                    async with aiohttp.ClientSession() as session:
-                        async with session.post(
-                            url, 
-                            headers=headers, 
-                            params=params, 
-                            json=data,
-                            proxy=proxies['https'] if proxies else None,
-                            timeout=60
-                        ) as response:
-                            
-                            logger.info(f"Gemini API响应状态码: {response.status}")
-                            
-                            if response.status == 200 or response.status != 503:
-                                response_json = await response.json()
-                                break
-                            
-                            if response.status == 503 and retry_count < max_retries:
-                                logger.warning(f"Gemini API服务过载 (状态码: 503)，将进行重试 ({retry_count+1}/{max_retries})")
-                                retry_count += 1
-                                await asyncio.sleep(retry_delay)
-                                retry_delay = min(retry_delay * 1.5, 10)
-                                continue
-                            else:
-                                break
-                        
-                except Exception as e:
-                    logger.error(f"请求异常: {str(e)}")
-                    if retry_count < max_retries:
-                        logger.warning(f"请求异常，将进行重试 ({retry_count+1}/{max_retries})")
-                        retry_count += 1
-                        await asyncio.sleep(retry_delay)
-                        retry_delay = min(retry_delay * 1.5, 10)
-                        continue
-                    else:
-                        raise
+                    status, stream_result = await self._call_gemini(request_data, read_stream, label="图片生成(流式)", stream=True)
+                except RetryableStatusError as e:
+                    logger.error(f"图片生成失败，重试结束后状态码仍为 {e.status}")
+                    status, stream_result = e.status, None
+                
+                if status != 200:
+                    return [], None, f"API调用失败，状态码: {status}"
+                image_text_pairs, final_text, error_message, complete = stream_result
+                # 只缓存完整的响应，流中断时的部分结果不能回放给之后的相同请求
+                if cache_key and image_text_pairs and not error_message and complete:
+                    self.generation_cache.put(cache_key, image_text_pairs, final_text)
+                return image_text_pairs, final_text, error_message
+            
+            # 发送请求，重试由统一的重试策略处理
+            try:
+                status, response_json = await self._call_gemini(request_data, read_response, label="图片生成")
+            except RetryableStatusError as e:
+                logger.error(f"图片生成失败，重试结束后状态码仍为 {e.status}")
+                status, response_json = e.status, None
             
-            if response is None or response.status != 200:
-                return [], None, f"API调用失败，状态码: {response.status if response else 'unknown'}"
+            if status != 200:
+                return [], None, f"API调用失败，状态码: {status}"
             
             # 处理多图片响应
             image_text_pairs, final_text, error_message = await self._process_multi_image_response(response_json)
@@ -2227,6 +4919,8 @@ class GeminiImageXXX(PluginBase):
                 if final_text:
                     logger.info(f"API返回的文本内容: {final_text[:100]}...")
             
+            if cache_key and image_text_pairs:
+                self.generation_cache.put(cache_key, image_text_pairs, final_text)
             return image_text_pairs, final_text, None
                 
         except Exception as e:
@@ -2245,45 +4939,31 @@ class GeminiImageXXX(PluginBase):
             
         Returns:
             bytes: 压缩后的图片数据
+            
+        Raises:
+            ImageTooLargeError: 图片解码后的像素数超出限制
         """
         try:
-            # 使用PIL打开图片
-            img = Image.open(BytesIO(image_data))
-            
-            # 转换为RGB模式，解决某些透明PNG的问题
-            if img.mode in ('RGBA', 'LA') and format == 'JPEG':
-                background = Image.new("RGB", img.size, (255, 255, 255))
-                background.paste(img, mask=img.split()[3])
-                img = background
-            
-            # 调整大小，保持纵横比
-            width, height = img.size
-            if width > max_size or height > max_size:
-                if width > height:
-                    new_width = max_size
-                    new_height = int(height * (max_size / width))
-                else:
-                    new_height = max_size
-                    new_width = int(width * (max_size / height))
-                
-                logger.info(f"调整图片大小: {width}x{height} -> {new_width}x{new_height}")
-                img = img.resize((new_width, new_height), Image.LANCZOS)
-            
-            # 将图片保存到BytesIO对象中
-            output = BytesIO()
-            if format == 'JPEG':
-                img.save(output, format=format, quality=quality, optimize=True)
-            else:
-                img.save(output, format=format, optimize=True)
+            # 解码、缩放和编码都在图片处理池中执行，避免阻塞事件循环
+            executor = self._get_image_executor()
+            async with self.image_slots:
+                loop = asyncio.get_running_loop()
+                compressed_data, original_size, new_size = await loop.run_in_executor(
+                    executor, _compress_image_sync, image_data, max_size, quality, format, self.image_max_pixels
+                )
             
-            # 获取压缩后的图片数据
-            compressed_data = output.getvalue()
+            if original_size != new_size:
+                logger.info(f"调整图片大小: {original_size[0]}x{original_size[1]} -> {new_size[0]}x{new_size[1]}")
             
             # 记录压缩效果
             compression_ratio = len(compressed_data) / len(image_data)
             logger.info(f"图片压缩: {len(image_data)} -> {len(compressed_data)} 字节，比率: {compression_ratio:.2f}")
             
             return compressed_data
+        except ImageTooLargeError as e:
+            # 超大图片不能退回原始数据发送
+            logger.warning(f"拒绝处理超大图片: {str(e)}")
+            raise
         except Exception as e:
             logger.error(f"压缩图片失败: {str(e)}")
             logger.exception(e)
@@ -2317,6 +4997,33 @@ class GeminiImageXXX(PluginBase):
             logger.warning("翻译配置不完整，使用原始提示词")
             return prompt
         
+        # 优先使用缓存的翻译结果
+        cache_key = TranslationCache.make_key(prompt, self.translate_model)
+        translated_text = self.translate_cache.get(cache_key)
+        if translated_text:
+            logger.info(f"使用缓存的翻译结果: {prompt} -> {translated_text}")
+            return translated_text
+        
+        # 相同提示词的并发请求只调用一次翻译接口
+        translated_text = await self.translate_flight.do(cache_key, lambda: self._request_translation(prompt, cache_key))
+        return translated_text or prompt
+    
+    async def _request_translation(self, prompt: str, cache_key: str) -> Optional[str]:
+        """调用翻译接口翻译提示词，成功时写入翻译缓存
+        
+        Args:
+            prompt: 原始提示词（中文）
+            cache_key: 翻译缓存键
+            
+        Returns:
+            Optional[str]: 翻译结果，失败则返回None
+        """
+        # 翻译接口熔断时直接使用原始提示词，不等待超时
+        breaker = self._get_breaker("translate")
+        if not breaker.allow():
+            logger.warning("翻译接口已熔断，使用原始提示词")
+            return None
+        
         try:
             # 构建请求数据
             headers = {
@@ -2340,25 +5047,34 @@ class GeminiImageXXX(PluginBase):
             
             # 发送请求
             url = f"{self.translate_api_base.rstrip('/')}/chat/completions"
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=data, timeout=10) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        translated_text = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-                        
-                        # 清理翻译结果，移除可能的引号和多余空格
-                        translated_text = translated_text.strip('"\'').strip()
-                        
-                        if translated_text:
-                            logger.info(f"翻译成功: {prompt} -> {translated_text}")
-                            return translated_text
+            session = self._get_http_session()
+            async with session.post(url, headers=headers, json=data, timeout=10) as response:
+                if response.status >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if response.status == 200:
+                    result = await response.json()
+                    translated_text = result.get("choices", [{}])[0].get("message", {}).get("content", "")
+                    
+                    # 清理翻译结果，移除可能的引号和多余空格
+                    translated_text = translated_text.strip('"\'').strip()
+                    
+                    if translated_text:
+                        logger.info(f"翻译成功: {prompt} -> {translated_text}")
+                        self.translate_cache.put(cache_key, translated_text)
+                        return translated_text
             
             logger.warning(f"翻译失败: {response.status}")
-            return prompt
+            return None
             
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            breaker.record_failure()
+            logger.error(f"翻译出错: {str(e) or type(e).__name__}")
+            return None
         except Exception as e:
             logger.error(f"翻译出错: {str(e)}")
-            return prompt
+            return None
     
     def _is_mostly_english(self, text: str) -> bool:
         """判断文本是否主要由英文组成
@@ -2380,6 +5096,45 @@ class GeminiImageXXX(PluginBase):
         # 如果英文字符比例超过70%，认为是英文
         return english_chars / total_chars > 0.7
 
+    async def _send_image_pair(self, bot: WechatAPIClient, user_id: str, image_data: bytes, text: str, index: int,
+                               sent_contents: Set[str], image_path: Optional[str] = None) -> None:
+        """
+        发送一张图片及其关联文本
+        
+        Args:
+            bot: 微信API客户端
+            user_id: 接收者ID
+            image_data: 图片数据
+            text: 关联文本
+            index: 图片序号（从0开始）
+            sent_contents: 已发送的文本集合，用于避免发送重复内容
+            image_path: 图片文件路径，二进制发送失败时使用(可选)
+        """
+        # 1. 尝试直接从内存发送图片
+        try:
+            # 优先使用二进制数据直接发送图片，避免文件IO操作
+            await bot.send_image_message(user_id, image_data)
+            logger.info(f"使用二进制数据成功发送图片 #{index+1}")
+        except Exception as e:
+            logger.error(f"使用二进制数据发送图片失败: {str(e)}，尝试从文件读取")
+            try:
+                if not image_path:
+                    raise
+                # 如果直接发送失败，尝试从文件读取并发送
+                with open(image_path, "rb") as f:
+                    file_data = f.read()
+                    await bot.send_image_message(user_id, file_data)
+                    logger.info(f"使用文件数据成功发送图片 #{index+1}: {image_path}")
+            except Exception as e2:
+                logger.error(f"从文件发送图片也失败了: {str(e2)}")
+                await bot.send_text_message(user_id, f"图片 #{index+1} 发送失败，请查看日志")
+        
+        # 2. 如果有关联文本且不重复，则发送文本
+        if text and text not in sent_contents:
+            await bot.send_text_message(user_id, text)
+            sent_contents.add(text)
+            logger.info(f"发送图片 #{index+1} 的关联文本，长度: {len(text)}")
+    
     async def _send_alternating_content(self, bot: WechatAPIClient, message: dict, image_text_pairs: List[Tuple[bytes, str]], final_text: Optional[str]) -> None:
         """
         处理并发送图像和文本内容
@@ -2394,53 +5149,10 @@ class GeminiImageXXX(PluginBase):
         conversation_key = self._get_conversation_key(message)
         sent_contents = set()  # 用于避免发送重复内容
         
-        # 创建临时目录
-        os.makedirs(self.temp_dir, exist_ok=True)
-        
         try:
-            # 保存所有图片到本地（不先发送处理中提示，避免重复）
-            image_paths = []
+            # 按顺序发送图片和文本，图片直接从内存发送
             for i, (image_data, text) in enumerate(image_text_pairs):
-                # 生成图片文件名
-                timestamp = int(time.time())
-                random_str = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
-                filename = f"gemini_{timestamp}_{random_str}_{i}.png"
-                image_path = os.path.join(self.temp_dir, filename)
-                
-                # 保存图片
-                with open(image_path, "wb") as f:
-                    f.write(image_data)
-                    
-                image_paths.append((image_path, text))
-                logger.info(f"已保存生成的图片: {image_path}")
-            
-            # 按顺序发送图片和文本
-            for i, (image_path, text) in enumerate(image_paths):
-                # 1. 尝试直接从内存发送图片
-                image_idx = i
-                current_image_data = image_text_pairs[image_idx][0]
-                
-                try:
-                    # 优先使用二进制数据直接发送图片，避免文件IO操作
-                    await bot.send_image_message(user_id, current_image_data)
-                    logger.info(f"使用二进制数据成功发送图片 #{image_idx+1}")
-                except Exception as e:
-                    logger.error(f"使用二进制数据发送图片失败: {str(e)}，尝试从文件读取")
-                    try:
-                        # 如果直接发送失败，尝试从文件读取并发送
-                        with open(image_path, "rb") as f:
-                            file_data = f.read()
-                            await bot.send_image_message(user_id, file_data)
-                            logger.info(f"使用文件数据成功发送图片 #{image_idx+1}: {image_path}")
-                    except Exception as e2:
-                        logger.error(f"从文件发送图片也失败了: {str(e2)}")
-                        await bot.send_text_message(user_id, f"图片 #{image_idx+1} 发送失败，请查看日志")
-                
-                # 2. 如果有关联文本且不重复，则发送文本
-                if text and text not in sent_contents:
-                    await bot.send_text_message(user_id, text)
-                    sent_contents.add(text)
-                    logger.info(f"发送图片 #{image_idx+1} 的关联文本，长度: {len(text)}")
+                await self._send_image_pair(bot, user_id, image_data, text, i, sent_contents)
             
             # 3. 如果有最终文本且不重复，则发送
             if final_text and final_text not in sent_contents:
@@ -2448,24 +5160,15 @@ class GeminiImageXXX(PluginBase):
                 logger.info(f"发送最终文本，长度: {len(final_text)}")
             
             # 更新最后图片路径（如果有）
-            if image_paths:
-                last_image_path = image_paths[-1][0]
-                self.last_images[conversation_key] = last_image_path
+            if image_text_pairs:
+                last_image_path = self._store_image(image_text_pairs[-1][0])
+                self._set_last_image(conversation_key, last_image_path)
                 logger.info(f"更新用户 {user_id} 的最后图片路径: {last_image_path}")
                 
         except Exception as e:
             logger.error(f"处理和发送图像内容时出错: {str(e)}")
             logger.exception(e)
             await bot.send_text_message(user_id, "发送图片时出错，请查看日志")
-            
-        # 清理临时文件
-        try:
-            for image_path, _ in image_paths:
-                if os.path.exists(image_path) and image_path != self.last_images.get(conversation_key):
-                    os.remove(image_path)
-                    logger.debug(f"已清理临时图片文件: {image_path}")
-        except Exception as e:
-            logger.warning(f"清理临时图片文件时出错: {str(e)}")
 
     async def _download_image_via_api(self, bot: WechatAPIClient, message: dict) -> Optional[bytes]:
         """
@@ -2511,31 +5214,44 @@ class GeminiImageXXX(PluginBase):
         # payload["FromWxid"] = user_wxid # 同时添加FromWxid字段
 
         api_endpoint = f"{self.PAD_API_BASE_URL}/Tools/DownloadImg"
+        
+        # Pad API熔断时直接失败，不等待超时
+        breaker = self._get_breaker("pad")
+        if not breaker.allow():
+            logger.warning("Pad API已熔断，跳过通过API下载图片")
+            return None
         logger.info(f"尝试通过API下载图片: {api_endpoint}, Payload: {payload}")
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(api_endpoint, json=payload, timeout=30) as response:
-                    if response.status == 200:
-                        try:
-                            response_json = await response.json()
-                            if response_json.get("Success"):
-                                image_base64 = response_json.get("Data")
-                                if image_base64:
-                                    return base64.b64decode(image_base64)
-                                else:
-                                    logger.error(f"API下载图片成功，但响应中缺少 'Data' 字段。Response: {response_json}")
+            session = self._get_http_session()
+            async with session.post(api_endpoint, json=payload, timeout=30) as response:
+                if response.status >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if response.status == 200:
+                    try:
+                        response_json = await response.json()
+                        if response_json.get("Success"):
+                            image_base64 = response_json.get("Data")
+                            if image_base64:
+                                return base64.b64decode(image_base64)
                             else:
-                                error_msg = response_json.get("Msg", "未知错误")
-                                logger.error(f"API下载图片失败 (Success=false): {error_msg}. Response: {response_json}")
-                        except json.JSONDecodeError:
-                            resp_text = await response.text()
-                            logger.error(f"API下载图片响应JSON解析失败。Status: {response.status}, Response: {resp_text[:500]}")
-                        except Exception as e_json:
-                            logger.error(f"处理API下载图片响应时出错: {e_json}")
-                    else:
+                                logger.error(f"API下载图片成功，但响应中缺少 'Data' 字段。Response: {response_json}")
+                        else:
+                            error_msg = response_json.get("Msg", "未知错误")
+                            logger.error(f"API下载图片失败 (Success=false): {error_msg}. Response: {response_json}")
+                    except json.JSONDecodeError:
                         resp_text = await response.text()
-                        logger.error(f"API下载图片请求失败。Status: {response.status}, Response: {resp_text[:500]}")
+                        logger.error(f"API下载图片响应JSON解析失败。Status: {response.status}, Response: {resp_text[:500]}")
+                    except Exception as e_json:
+                        logger.error(f"处理API下载图片响应时出错: {e_json}")
+                else:
+                    resp_text = await response.text()
+                    logger.error(f"API下载图片请求失败。Status: {response.status}, Response: {resp_text[:500]}")
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e_http:
+            breaker.record_failure()
+            logger.error(f"API下载图片网络请求错误: {e_http}")
         except aiohttp.ClientError as e_http:
             logger.error(f"API下载图片网络请求错误: {e_http}")
         except Exception as e:
@@ -0,0 +1,149 @@
+"""_compress_image_sync 的耗时和内存基准
+
+用固定随机种子生成合成照片，分别用原来的完整解码加LANCZOS缩放（baseline）和当前的
+_compress_image_sync（current）压缩。每次运行都在独立的子进程中进行，峰值内存为
+压缩前后RSS峰值的增长。运行方式：
+
+    python tests/bench_compress.py
+    python tests/bench_compress.py --runs 5 --target 1024
+"""
+import argparse
+import io
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from framework_stubs import load_main
+
+IMPLEMENTATIONS = ("baseline", "current")
+
+# (名称, 宽, 高, 模式, 格式)
+CASES = [
+    ("12MP JPEG", 4000, 3000, "RGB", "JPEG"),
+    ("24MP JPEG", 6000, 4000, "RGB", "JPEG"),
+    ("48MP JPEG", 8000, 6000, "RGB", "JPEG"),
+    ("12MP PNG", 4000, 3000, "RGB", "PNG"),
+    ("12MP PNG RGBA", 4000, 3000, "RGBA", "PNG"),
+    ("12MP PNG P", 4000, 3000, "P", "PNG"),
+]
+
+
+def make_image(width: int, height: int, mode: str, format: str, seed: int = 1) -> bytes:
+    """生成带有平滑纹理的合成照片，相同参数每次生成相同的数据"""
+    rng = random.Random(seed)
+    tile = (max(1, width // 16), max(1, height // 16))
+    img = Image.frombytes("RGB", tile, rng.randbytes(tile[0] * tile[1] * 3)).resize((width, height), Image.BICUBIC)
+    if mode == "RGBA":
+        alpha = Image.linear_gradient("L").resize((width, height))
+        img.putalpha(alpha)
+    elif mode == "P":
+        img = img.quantize(256)
+    output = io.BytesIO()
+    if format == "JPEG":
+        img.save(output, format="JPEG", quality=90)
+    else:
+        img.save(output, format=format, compress_level=1)
+    return output.getvalue()
+
+
+def baseline_compress(image_data: bytes, max_size: int, quality: int, format: str):
+    """原来的压缩方式：完整解码，在原图尺寸上转换模式，再用LANCZOS缩放"""
+    img = Image.open(io.BytesIO(image_data))
+    if format == "JPEG" and img.mode != "RGB":
+        if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        else:
+            img = img.convert("RGB")
+    width, height = img.size
+    if width > max_size or height > max_size:
+        if width > height:
+            new_size = (max_size, int(height * (max_size / width)))
+        else:
+            new_size = (int(width * (max_size / height)), max_size)
+        img = img.resize(new_size, Image.LANCZOS)
+    output = io.BytesIO()
+    if format == "JPEG":
+        img.save(output, format=format, quality=quality, optimize=True)
+    else:
+        img.save(output, format=format, optimize=True)
+    return output.getvalue(), (width, height), img.size
+
+
+def peak_rss_mb() -> float:
+    """当前进程的RSS峰值(MB)
+    
+    子进程的 ru_maxrss 会继承父进程的值，Linux 上优先读取 /proc 中的 VmHWM。
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(path: str, impl: str, target: int, quality: int):
+    """在当前进程中用指定的实现压缩一张图片，输出耗时和RSS增长"""
+    compress = baseline_compress if impl == "baseline" else load_main()._compress_image_sync
+    with open(path, "rb") as f:
+        data = f.read()
+    base = peak_rss_mb()
+    start = time.perf_counter()
+    output, _, new_size = compress(data, target, quality, "JPEG")
+    elapsed = time.perf_counter() - start
+    peak = peak_rss_mb() - base
+    print(f"{elapsed * 1000:.0f} {peak:.0f} {new_size[0]}x{new_size[1]} {len(output)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", type=int, default=800, help="目标最大边长")
+    parser.add_argument("--quality", type=int, default=85, help="JPEG压缩质量")
+    parser.add_argument("--runs", type=int, default=3, help="每个用例运行次数，取耗时中位数")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--impl", choices=IMPLEMENTATIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args.case, args.impl, args.target, args.quality)
+        return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print(f"target {args.target}px, quality {args.quality}, median of {args.runs} runs")
+        print(f"{'input':<16}{'size':>8}  {'baseline':>18}  {'current':>18}  {'speedup':>7}  output")
+        for name, width, height, mode, format in CASES:
+            data = make_image(width, height, mode, format)
+            path = os.path.join(tmpdir, f"{width}x{height}-{mode}.{format.lower()}")
+            with open(path, "wb") as f:
+                f.write(data)
+            medians = {}
+            for impl in IMPLEMENTATIONS:
+                results = []
+                for _ in range(args.runs):
+                    out = subprocess.run(
+                        [sys.executable, __file__, "--case", path, "--impl", impl,
+                         "--target", str(args.target), "--quality", str(args.quality)],
+                        check=True, capture_output=True, text=True
+                    ).stdout.split()[-4:]
+                    results.append(out)
+                results.sort(key=lambda r: int(r[0]))
+                medians[impl] = results[len(results) // 2]
+            columns = [f"{int(medians[impl][0]):>6} ms /{int(medians[impl][1]):>4} MB" for impl in IMPLEMENTATIONS]
+            speedup = int(medians["baseline"][0]) / max(1, int(medians["current"][0]))
+            size, length = medians["current"][2:]
+            print(f"{name:<16}{len(data) / 1048576:>6.1f}MB  {columns[0]:>18}  {columns[1]:>18}  {speedup:>6.1f}x  {size} {length}B")
+
+
+if __name__ == "__main__":
+    main()
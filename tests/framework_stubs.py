@@ -0,0 +1,58 @@
+"""在没有 XXXBot 框架的环境中加载 main.py
+
+main.py 从框架导入 utils.decorators、utils.plugin_base 和 WechatAPI。框架不存在时
+在 sys.modules 中放入最小的替代模块，测试和基准只使用与框架无关的部分。
+"""
+import importlib.util
+import os
+import sys
+import types
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+
+def _decorator(*args, **kwargs):
+    return lambda func: func
+
+
+def _importable(*names: str) -> bool:
+    try:
+        for name in names:
+            importlib.import_module(name)
+    except ImportError:
+        return False
+    return True
+
+
+def install():
+    """框架模块无法导入时注册替代模块"""
+    if not _importable("utils.decorators", "utils.plugin_base"):
+        utils = types.ModuleType("utils")
+        utils.__path__ = []
+        utils.decorators = types.ModuleType("utils.decorators")
+        utils.decorators.on_text_message = _decorator
+        utils.decorators.on_image_message = _decorator
+        utils.decorators.schedule = _decorator
+        utils.plugin_base = types.ModuleType("utils.plugin_base")
+        utils.plugin_base.PluginBase = type("PluginBase", (), {})
+        sys.modules.update({
+            "utils": utils,
+            "utils.decorators": utils.decorators,
+            "utils.plugin_base": utils.plugin_base,
+        })
+    if not _importable("WechatAPI"):
+        wechat_api = types.ModuleType("WechatAPI")
+        wechat_api.WechatAPIClient = type("WechatAPIClient", (), {})
+        sys.modules["WechatAPI"] = wechat_api
+
+
+def load_main() -> types.ModuleType:
+    """按路径加载插件的 main.py"""
+    install()
+    module = sys.modules.get("gemini_image_main")
+    if module is None:
+        spec = importlib.util.spec_from_file_location("gemini_image_main", MAIN_PATH)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["gemini_image_main"] = module
+        spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,109 @@
+"""_call_gemini 的线路熔断与密钥池统计测试"""
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+
+from framework_stubs import load_main
+
+main = load_main()
+
+
+def _key_state(api_key):
+    return (api_key.in_flight, api_key.requests, api_key.successes, api_key.failures,
+            api_key.ejections, api_key.ejected_until, api_key.probing)
+
+
+def _plugin():
+    plugin = main.GeminiImageXXX()
+    plugin.api_key_pool = main.ApiKeyPool()
+    plugin.api_key_pool.add("key-one-0001")
+    plugin.api_key_pool.add("key-two-0002")
+    plugin.use_proxy_service = True
+    plugin.proxy_service_url = "http://127.0.0.1:9"
+    plugin.breaker_fallback_direct = False
+    return plugin
+
+
+def _open_breaker(plugin, route):
+    breaker = plugin._get_breaker(route)
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    assert breaker.state == main.CircuitBreaker.OPEN
+
+
+async def _call(plugin):
+    async def handler(response):
+        raise AssertionError("熔断时不应发出请求")
+    try:
+        with pytest.raises(main.CircuitOpenError):
+            await plugin._call_gemini("{}", handler, label="测试")
+    finally:
+        await plugin.http_session.close()
+
+
+def test_open_breaker_leaves_key_stats_unchanged():
+    async def run():
+        plugin = _plugin()
+        _open_breaker(plugin, "proxy")
+        before = [_key_state(k) for k in plugin.api_key_pool.keys]
+        await _call(plugin)
+        assert [_key_state(k) for k in plugin.api_key_pool.keys] == before
+        assert plugin.gemini_limiter.in_flight == 0
+    asyncio.run(run())
+
+
+def test_open_breaker_does_not_eject_probing_key():
+    async def run():
+        plugin = _plugin()
+        _open_breaker(plugin, "proxy")
+        # 暂停期满的密钥会被选中发送探测请求
+        api_key = plugin.api_key_pool.keys[0]
+        api_key.ejected_until = time.time() - 1
+        api_key.eject_seconds = 30
+        before = _key_state(api_key)
+        await _call(plugin)
+        assert _key_state(api_key) == before
+        assert not api_key.probing
+    asyncio.run(run())
+
+
+async def _run_against_status(status: int):
+    """向总是返回指定状态码的服务发送一个请求，返回服务收到的请求数和线路熔断器"""
+    hits = []
+
+    async def handle(request):
+        hits.append(request.path)
+        return web.Response(status=status, text="{}")
+
+    app = web.Application()
+    app.router.add_post("/v1beta/models/{name}", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    plugin = _plugin()
+    plugin.proxy_service_url = f"http://127.0.0.1:{port}"
+    plugin.retry_policy = main.RetryPolicy(max_attempts=5, base_delay=0, max_delay=0)
+    try:
+        with pytest.raises(main.RetryableStatusError):
+            await plugin._call_gemini("{}", lambda response: None, label="测试")
+    finally:
+        await plugin.http_session.close()
+        await runner.cleanup()
+    return len(hits), plugin._get_breaker("proxy")
+
+
+def test_overload_does_not_open_breaker():
+    hits, breaker = asyncio.run(_run_against_status(503))
+    assert hits == 5
+    assert breaker.state == main.CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+
+
+def test_server_errors_open_breaker():
+    hits, breaker = asyncio.run(_run_against_status(500))
+    assert hits == 5
+    assert breaker.state == main.CircuitBreaker.OPEN
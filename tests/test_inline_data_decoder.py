@@ -0,0 +1,101 @@
+"""InlineDataDecoder 的解析正确性和内存占用测试"""
+import base64
+import json
+import os
+import random
+import tracemalloc
+
+import pytest
+
+from framework_stubs import load_main
+
+main = load_main()
+
+
+def _decode(body: bytes, chunk_size: int):
+    decoder = main.InlineDataDecoder()
+    for start in range(0, len(body), chunk_size):
+        decoder.feed(body[start:start + chunk_size])
+    return decoder.close()
+
+
+def _response(data: str) -> bytes:
+    return json.dumps({
+        "candidates": [{
+            "content": {"parts": [
+                {"text": "here \"you\" go\\n"},
+                {"inlineData": {"mimeType": "image/png", "data": data}}
+            ]},
+            "finishReason": "STOP"
+        }]
+    }).encode()
+
+
+def _inline(result):
+    return result["candidates"][0]["content"]["parts"][1]["inlineData"]["data"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 64, 65536])
+def test_escaped_base64_matches_json_loads(chunk_size):
+    image = bytes(random.Random(chunk_size).randrange(256) for _ in range(1000))
+    encoded = base64.b64encode(image).decode()
+    # 合法JSON中Base64字符可能以 \/、=、+ 等形式转义，也可能夹带转义的换行
+    escaped = encoded[:100] + "\\n" + encoded[100:].replace("/", "\\/").replace("=", "\\u003d").replace("+", "\\u002B")
+    body = _response(encoded).replace(encoded.encode(), escaped.encode())
+    expected = json.loads(body)
+    
+    result = _decode(body, chunk_size)
+    assert _inline(result) == image
+    assert base64.b64decode(_inline(expected)) == image
+    assert result["candidates"][0]["content"]["parts"][0] == expected["candidates"][0]["content"]["parts"][0]
+
+
+def test_escaped_key_is_recognized():
+    image = b"\x89PNG-data"
+    body = _response(base64.b64encode(image).decode()).replace(b'"data"', b'"d\\u0061ta"')
+    assert _inline(_decode(body, 4)) == image
+
+
+@pytest.mark.parametrize("data", ["QUJD\\x", "QUJD\\u00zz", "QUJDRA"])
+def test_invalid_data_raises_json_decode_error(data):
+    body = _response("PLACEHOLDER").replace(b"PLACEHOLDER", data.encode())
+    with pytest.raises(json.JSONDecodeError):
+        _decode(body, 3)
+
+
+def _peak(func) -> int:
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_peak_memory_below_json_loads():
+    image = os.urandom(8 * 1024 * 1024)
+    prefix, suffix = _response("PLACEHOLDER").split(b"PLACEHOLDER")
+    step = 48 * 1024  # 3的倍数，分块编码结果可以直接拼接
+    
+    def chunks():
+        yield prefix
+        for start in range(0, len(image), step):
+            yield base64.b64encode(image[start:start + step])
+        yield suffix
+    
+    def decode_incrementally():
+        decoder = main.InlineDataDecoder()
+        for chunk in chunks():
+            decoder.feed(chunk)
+        assert _inline(decoder.close()) == image
+    
+    def decode_with_json_loads():
+        # 之前的做法：读取完整正文后整体解析，再解码Base64
+        body = b"".join(chunks())
+        assert base64.b64decode(_inline(json.loads(body))) == image
+    
+    incremental = _peak(decode_incrementally)
+    buffered = _peak(decode_with_json_loads)
+    # 增量解析只保留解码后的图片（缓冲区及取出的bytes），不保留正文和Base64字符串
+    assert incremental < 2.2 * len(image)
+    assert incremental < 0.7 * buffered